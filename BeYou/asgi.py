@@ -10,15 +10,20 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import chat.routing  # Ensure the chat app's routing is correctly referenced
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BeYou.settings')
 
+# Set up Django before importing anything that touches models or settings
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+from chat.auth import JWTAuthMiddleware
+import chat.routing  # Ensure the chat app's routing is correctly referenced
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    # Access tokens are checked locally, no session table lookup
+    "websocket": JWTAuthMiddleware(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
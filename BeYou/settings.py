@@ -41,7 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'users',
-    'chats',
+    'chat',
     'rest_framework',
     'rest_framework_simplejwt',
     'rest_framework_simplejwt.token_blacklist',
@@ -52,7 +52,8 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # simplejwt's JWTAuthentication plus access tokens revoked on logout
+        'users.authentication.RevocableJWTAuthentication',
     )
 }
 
@@ -89,15 +90,134 @@ WSGI_APPLICATION = 'BeYou.wsgi.application'
 
 ASGI_APPLICATION = 'your_project.asgi.application'
 
+# Deliveries to sockets in the same process skip Redis entirely; Redis only
+# carries traffic between processes (chat/layers.py). Set 'remote' to None for
+# a single-node deployment without Redis. Each process reads everything relayed
+# to it from one channel, which holds up to 'relay_capacity' messages.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.LocalFirstChannelLayer',
         'CONFIG': {
-            "hosts": [("127.0.0.1", 6379)],
+            'remote': {
+                'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {
+                    "hosts": [("127.0.0.1", 6379)],
+                },
+            },
+            'shard_size': 256,
+            'relay_capacity': 10000,
         },
     },
 }
 
+# Chat message persistence. With CHAT_WRITE_BEHIND on, messages are broadcast
+# immediately and bulk inserted by a background task; unflushed messages are
+# journaled under CHAT_WRITE_BEHIND_SPILL_DIR and replayed after a crash.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.2  # seconds
+CHAT_WRITE_BEHIND_FSYNC = False
+CHAT_WRITE_BEHIND_MAX_RETRIES = 5  # flushes before a failing batch is moved to failed/
+CHAT_WRITE_BEHIND_SPILL_DIR = os.path.join(BASE_DIR, 'var', 'chat_spill')
+# Unique per worker process across all hosts (0-1023). Required for write-behind,
+# which mints message ids and names its journal segments with it
+CHAT_WORKER_ID = int(os.environ['CHAT_WORKER_ID']) if 'CHAT_WORKER_ID' in os.environ else None
+
+# Typing indicators in group rooms are coalesced into one typing_batch event
+# per room every CHAT_TYPING_TICK seconds; idle typists expire after CHAT_TYPING_TTL
+CHAT_TYPING_TICK = 0.5
+CHAT_TYPING_TTL = 6.0
+
+# Read and delivery acknowledgements (chat/receipts.py) are cursors; the
+# newest per member is written and broadcast once every CHAT_RECEIPT_TICK seconds;
+# a batch is dropped after CHAT_RECEIPT_MAX_RETRIES consecutive failed writes
+CHAT_RECEIPT_TICK = 1.0
+CHAT_RECEIPT_MAX_RETRIES = 5
+
+# Presence (chat/presence.py): each worker renews leases for its connected users
+# every CHAT_PRESENCE_HEARTBEAT seconds; a user is offline once no lease is younger
+# than CHAT_PRESENCE_TTL. Without CHAT_PRESENCE_REDIS_URL presence is kept in process.
+CHAT_PRESENCE_HEARTBEAT = 5.0
+CHAT_PRESENCE_TTL = 20.0
+CHAT_PRESENCE_REDIS_URL = None
+
+# WebSocket handshakes (chat/auth.py) verify the JWT access token locally and read
+# user rows from a per-process cache, checked against a version stamp in the
+# WS_AUTH_CACHE_ALIAS cache that every user save replaces. Browsers, which cannot
+# set headers on a WebSocket, connect with a single-use ?ticket= from ws-ticket/
+# that expires after WS_TICKET_TTL seconds.
+WS_AUTH_USER_CACHE_SIZE = 10000
+WS_AUTH_USER_CACHE_TTL = 60.0  # seconds
+WS_AUTH_CACHE_ALIAS = 'shared'
+WS_TICKET_TTL = 30  # seconds
+
+# Friend, follow and block sets (users/social_graph.py) are cached per process for
+# up to SOCIAL_GRAPH_CACHE_SIZE users and reloaded after SOCIAL_GRAPH_CACHE_TTL seconds.
+# They serve presence visibility, suggestion filtering and repeat checks in the
+# relationship views; the mutations themselves are decided by the database
+SOCIAL_GRAPH_CACHE_SIZE = 10000
+SOCIAL_GRAPH_CACHE_TTL = 60.0
+
+# OTP mail (users/mailer.py) is sent from a background thread in batches of up to
+# OTP_EMAIL_BATCH_SIZE over one reused SMTP connection; a failed message is retried
+# OTP_EMAIL_MAX_RETRIES times with exponential backoff. Set OTP_EMAIL_ASYNC = False
+# to send inline.
+OTP_EMAIL_ASYNC = True
+OTP_EMAIL_BATCH_SIZE = 50
+OTP_EMAIL_BATCH_WINDOW = 0.1  # seconds
+OTP_EMAIL_MAX_RETRIES = 5
+OTP_EMAIL_RETRY_BACKOFF = 1.0  # seconds, doubled per attempt
+OTP_EMAIL_IDLE_TIMEOUT = 30.0  # seconds before the SMTP connection is closed
+
+# State that every process must agree on (OTP codes, recently blacklisted tokens,
+# cached profiles) goes to the 'shared' cache. Set SHARED_CACHE_REDIS_URL when
+# running more than one process; the locmem fallback is per process.
+SHARED_CACHE_REDIS_URL = os.environ.get('SHARED_CACHE_REDIS_URL')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': SHARED_CACHE_REDIS_URL,
+        'KEY_PREFIX': 'beyou',
+    } if SHARED_CACHE_REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shared',
+    },
+}
+
+# One-time codes (users/otp_store.py) live hashed in the OTP_CACHE_ALIAS cache with
+# a TTL instead of a table. At most OTP_MAX_ATTEMPTS guesses per OTP_LOCKOUT seconds,
+# whatever the number of codes issued; a new code at most every OTP_RESEND_INTERVAL.
+OTP_STORE = 'users.otp_store.CacheOTPStore'
+OTP_CACHE_ALIAS = 'shared'
+OTP_TTL = 300  # seconds
+OTP_MAX_ATTEMPTS = 5
+OTP_LOCKOUT = 900  # seconds
+OTP_RESEND_INTERVAL = 60  # seconds
+
+# Refresh token blacklist checks (users/token_blacklist.py) go through a per-process
+# Bloom filter rebuilt every JWT_BLACKLIST_FILTER_REFRESH seconds; tokens blacklisted
+# since the last rebuild are bridged through the JWT_BLACKLIST_CACHE_ALIAS cache
+JWT_BLACKLIST_FILTER_REFRESH = 300.0
+JWT_BLACKLIST_FILTER_ERROR_RATE = 0.01
+JWT_BLACKLIST_CACHE_ALIAS = 'shared'
+
+# Serialized profiles (users/profile_cache.py) are cached per user under a version
+# stamp that every profile or user save replaces; profiles whose picture previews
+# are not all available are cached for PROFILE_CACHE_PENDING_TTL seconds only
+PROFILE_CACHE_ALIAS = 'shared'
+PROFILE_CACHE_TTL = 600  # seconds
+PROFILE_CACHE_PENDING_TTL = 15  # seconds
+
+# Sockets that negotiate a batch subprotocol (see chat/framing.py) get their
+# events buffered for up to CHAT_BATCH_WINDOW seconds or CHAT_BATCH_MAX_EVENTS
+# events and sent as one array frame
+CHAT_BATCH_WINDOW = 0.005
+CHAT_BATCH_MAX_EVENTS = 100
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
@@ -147,6 +267,8 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
     'AUTH_HEADER_TYPES': ('Bearer',),
+    # Checks the blacklist through an in-memory Bloom filter (users/token_blacklist.py)
+    'TOKEN_REFRESH_SERIALIZER': 'users.serializers.CachedTokenRefreshSerializer',
 }
 
 # Internationalization
@@ -175,6 +297,24 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-
-
-
+# Resumable chat uploads (chat/uploads.py): chunks are streamed into
+# CHAT_UPLOAD_TEMP_DIR and moved into storage once the upload completes
+CHAT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHAT_UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+CHAT_UPLOAD_TEMP_DIR = os.path.join(MEDIA_ROOT, 'uploads_tmp')
+# Uploads without a chunk for this long are removed by purge_stale_uploads
+CHAT_UPLOAD_MAX_AGE = 24 * 60 * 60  # seconds
+
+# Image previews (chat/thumbnails.py): WebP variants of chat images and profile
+# pictures, bounded to these sizes, generated by a pool of worker processes
+THUMBNAIL_SIZES = {'thumb': 128, 'small': 320, 'medium': 720}
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_ASYNC = True
+
+# Media serving (chat/media.py): None streams files from Django; 'nginx' hands
+# them to an internal location via X-Accel-Redirect, 'xsendfile' sets
+# X-Sendfile for Apache/lighttpd
+MEDIA_SENDFILE_BACKEND = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+# Chat file URLs carry a signature valid for one to two MEDIA_URL_TTL periods
+MEDIA_URL_TTL = 6 * 60 * 60  # seconds
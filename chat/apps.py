@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 
 class ChatConfig(AppConfig):
+    # Write-behind messages carry 64-bit snowflake IDs
+    default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+    
+    def ready(self):
+        import chat.signals
@@ -0,0 +1,175 @@
+# chat/auth.py
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from users.token_blacklist import get_blacklist
+
+
+class TTLCache:
+    """Small thread-safe LRU whose entries expire after ttl seconds."""
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_users = None
+
+
+def get_user_cache():
+    global _users
+    if _users is None:
+        _users = TTLCache(
+            max_size=getattr(settings, 'WS_AUTH_USER_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'WS_AUTH_USER_CACHE_TTL', 60.0),
+        )
+    return _users
+
+
+def shared_cache():
+    return caches[getattr(settings, 'WS_AUTH_CACHE_ALIAS', 'shared')]
+
+
+def _version_key(user_id):
+    return f'ws-user-version:{user_id}'
+
+
+def _ticket_key(ticket):
+    return f'ws-ticket:{ticket}'
+
+
+def user_changed(user_id):
+    """
+    Make every process reload a user on their next handshake: this process
+    drops its copy, the others see the user's version stamp change.
+    """
+    get_user_cache().pop(user_id)
+    shared_cache().set(_version_key(user_id), uuid.uuid4().hex, timeout=int(get_user_cache().ttl * 2))
+
+
+def issue_ticket(user_id):
+    """
+    A single-use ticket for opening a WebSocket, valid for WS_TICKET_TTL
+    seconds. Browsers cannot set headers on a WebSocket, and a token in the
+    URL would end up in access logs; a ticket there is useless once used.
+    """
+    ticket = secrets.token_urlsafe(32)
+    shared_cache().set(_ticket_key(ticket), user_id, timeout=getattr(settings, 'WS_TICKET_TTL', 30))
+    return ticket
+
+
+def redeem_ticket(ticket):
+    # Whoever deletes the key first gets the user id; everyone else None
+    cache = shared_cache()
+    user_id = cache.get(_ticket_key(ticket))
+    if user_id is None or not cache.delete(_ticket_key(ticket)):
+        return None
+    return user_id
+
+
+def credentials_from_scope(scope):
+    """(access token, ticket) from the Authorization header or ?ticket=."""
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin1').split()
+            if len(parts) == 2 and parts[0] in api_settings.AUTH_HEADER_TYPES:
+                return parts[1], None
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    return None, query.get('ticket', [None])[0]
+
+
+def load_user(user_id):
+    """
+    The active user with this id, or None. Rows come from an in-process
+    cache, checked against the user's version stamp in the shared cache so a
+    change saved by any process (say, deactivation) is seen at once.
+    """
+    version = shared_cache().get(_version_key(user_id))
+    users = get_user_cache()
+    entry = users.get(user_id)
+    if entry is None or entry[0] != version:
+        user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is None:
+            return None
+        entry = (version, user)
+        users.set(user_id, entry)
+    user = entry[1]
+    return user if user.is_active else None
+
+
+def user_for_token(raw_token):
+    try:
+        token = AccessToken(raw_token)
+    except TokenError:
+        return None
+    # Access tokens are never in the blacklist table; logging out revokes them separately
+    jti = token.get(api_settings.JTI_CLAIM)
+    if jti and get_blacklist().access_revoked(jti):
+        return None
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    return load_user(user_id) if user_id is not None else None
+
+
+def authenticate(raw_token=None, ticket=None):
+    """
+    Return the user for an access token or a WebSocket ticket, or
+    AnonymousUser. Token signatures and expiry are checked locally and user
+    rows come from an in-process cache, so a warm handshake makes no
+    database query, only shared cache reads.
+    """
+    user = None
+    if raw_token:
+        user = user_for_token(raw_token)
+    elif ticket:
+        user_id = redeem_ticket(ticket)
+        user = load_user(user_id) if user_id is not None else None
+    return user or AnonymousUser()
+
+
+class JWTAuthMiddleware:
+    """
+    Puts the user of a simplejwt access token in scope['user'], in place of
+    AuthMiddlewareStack's session lookup.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope, user=await database_sync_to_async(authenticate)(*credentials_from_scope(scope)))
+        return await self.inner(scope, receive, send)
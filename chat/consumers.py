@@ -1,16 +1,50 @@
 # chat/consumers.py
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from .framing import (
+    ENCODING_MSGPACK, batch_max_events, batch_window, decode_frame,
+    encode_batch, encode_event, negotiate, packed_payload,
+)
 from .models import ChatRoom, Message
-from django.contrib.auth import get_user_model
+from .persistence import get_writer, write_behind_enabled
+from .presence import get_tracker, user_group
+from .receipts import get_coalescer as get_receipt_coalescer
+from .typing_status import get_coalescer
+from users import social_graph
 
-User = get_user_model()
+def entry_user_id(entry):
+    # Batch entries are {'user_id': ...} dicts, [user_id, message_id] pairs or bare ids
+    if isinstance(entry, dict):
+        return entry['user_id']
+    if isinstance(entry, list):
+        return entry[0]
+    return entry
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
+        self.user = self.scope['user']
+        
+        # Resolve membership and room metadata once per socket; membership
+        # changes are pushed to the group as room_members_changed events
+        self.room = await self.get_room() if self.user.is_authenticated else None
+        if self.room is None:
+            await self.close()
+            return
+        
+        # Users blocked either way are filtered out at fan-out, including
+        # their entries in typing and receipt batches; the set is loaded once
+        # here and kept current by block_changed events
+        self.blocked_ids = await self.get_blocked_ids()
+        
+        # Clients that offer a batch subprotocol get their events buffered
+        # for a few milliseconds and delivered as one array per frame
+        self.subprotocol, self.encoding = negotiate(self.scope.get('subprotocols', []))
+        self.outbox = []
+        self.outbox_flush = None
         
         # Join room group
         await self.channel_layer.group_add(
@@ -18,78 +52,208 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        if self.room['is_group']:
+            get_coalescer().join(self.room_group_name, self.user.id)
+        
+        # Presence is counted per socket in memory, no database write
+        await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+        get_tracker().connect(self.user.id)
+        self.present = True
+        
+        await self.accept(subprotocol=self.subprotocol)
+    
+    async def leave_presence(self):
+        if not getattr(self, 'present', False):
+            return
+        self.present = False
+        get_tracker().disconnect(self.user.id)
+        await self.channel_layer.group_discard(user_group(self.user.id), self.channel_name)
     
     async def disconnect(self, close_code):
+        await self.leave_presence()
+        if getattr(self, 'room', None) is None:
+            return
+        
+        if self.room['is_group']:
+            # Stops typing only when this was the user's last socket here
+            get_coalescer().leave(self.room_group_name, self.user.id, self.user.username)
+        
+        if self.outbox_flush is not None:
+            self.outbox_flush.cancel()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.room is None:
+            # Removed from the room; frames already queued are dropped
+            return
+        data = decode_frame(text_data, bytes_data)
         message_type = data.get('type', 'message')
         
         if message_type == 'message':
             message = data['message']
-            user_id = self.scope['user'].id
+            user_id = self.user.id
             
-            # Save message to database
-            message_id = await self.save_message(user_id, message)
+            if write_behind_enabled():
+                # ID is assigned now, the row is inserted by the background writer
+                message_id = await get_writer().enqueue(self.room_id, user_id, message)
+            else:
+                # Save message to database
+                message_id = await self.save_message(user_id, message)
             
-            # Send message to room group
+            # Send message to room group, encoded once for all receivers
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'chat_message',
+                encode_event('chat_message', {
+                    'type': 'message',
                     'message': message,
                     'user_id': user_id,
                     'message_id': message_id,
-                }
+                }, user_id=user_id)
             )
         
         elif message_type == 'typing':
-            user_id = self.scope['user'].id
-            username = self.scope['user'].username
+            user_id = self.user.id
+            username = self.user.username
             is_typing = data['is_typing']
             
+            if self.room['is_group']:
+                # Group rooms get one aggregated typing_batch per tick
+                get_coalescer().update(self.room_group_name, user_id, username, is_typing)
+                return
+            
             # Send typing status to room group
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'user_typing',
+                encode_event('user_typing', {
+                    'type': 'typing',
                     'user_id': user_id,
                     'username': username,
                     'is_typing': is_typing
-                }
+                }, user_id=user_id)
             )
     
+        elif message_type == 'ack':
+            # Cursor acknowledgement: the newest message id read and/or
+            # received; written and broadcast once per tick
+            try:
+                read = int(data['read']) if data.get('read') is not None else None
+                delivered = int(data['delivered']) if data.get('delivered') is not None else None
+            except (TypeError, ValueError):
+                return
+            get_receipt_coalescer().update(self.room_id, self.user.id, read, delivered)
+    
+    async def send_encoded(self, event):
+        # Forward a payload that the sender already encoded (see encode_event)
+        if self.encoding is None:
+            await self.send(text_data=event['text'])
+            return
+        
+        self.outbox.append(packed_payload(event) if self.encoding == ENCODING_MSGPACK else event['text'])
+        if len(self.outbox) >= batch_max_events():
+            await self.flush_outbox()
+        elif self.outbox_flush is None:
+            self.outbox_flush = asyncio.ensure_future(self.delayed_flush_outbox())
+    
+    async def delayed_flush_outbox(self):
+        await asyncio.sleep(batch_window())
+        self.outbox_flush = None
+        await self.flush_outbox()
+    
+    async def flush_outbox(self):
+        frames, self.outbox = self.outbox, []
+        if frames:
+            await self.send(**encode_batch(frames, self.encoding))
+    
     async def chat_message(self, event):
+        if event.get('user_id') in self.blocked_ids:
+            return
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'user_id': event['user_id'],
-            'message_id': event['message_id'],
-        }))
+        await self.send_encoded(event)
     
     async def user_typing(self, event):
+        if event.get('user_id') in self.blocked_ids:
+            return
         # Send typing status to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
+        await self.send_encoded(event)
+    
+    async def send_without_blocked(self, event, keys):
+        # Batches carry several users; the shared encoding is forwarded as is
+        # unless one of them is blocked, then this socket gets its own copy
+        if self.blocked_ids.isdisjoint(event.get('user_ids', ())):
+            await self.send_encoded(event)
+            return
+        payload = json.loads(event['text'])
+        for key in keys:
+            payload[key] = [entry for entry in payload[key] if entry_user_id(entry) not in self.blocked_ids]
+        if any(payload[key] for key in keys):
+            await self.send_encoded(encode_event(event['type'], payload))
+    
+    async def typing_batch(self, event):
+        # Send aggregated typing changes to WebSocket
+        await self.send_without_blocked(event, ('started', 'stopped'))
+    
+    async def read_receipts(self, event):
+        # Send coalesced read and delivery cursor moves to WebSocket
+        await self.send_without_blocked(event, ('read', 'delivered'))
+    
+    async def presence(self, event):
+        # Send friends' online/offline changes to WebSocket
+        await self.send_encoded(event)
+    
+    async def block_changed(self, event):
+        # Sent to both users by BlockUserView; never forwarded to the client.
+        # Keep this process's social graph in step for sockets opened later
+        if event['active']:
+            social_graph.block_added(event['blocker_id'], event['blocked_id'])
+        else:
+            social_graph.block_removed(event['blocker_id'], event['blocked_id'])
+        
+        other_id = event['blocked_id'] if event['blocker_id'] == self.user.id else event['blocker_id']
+        # 'blocked' is false only once neither user blocks the other
+        if event['blocked']:
+            self.blocked_ids = self.blocked_ids | {other_id}
+        else:
+            self.blocked_ids = self.blocked_ids - {other_id}
+    
+    async def room_members_changed(self, event):
+        if self.user.id in event['removed'] and self.room is not None:
+            # Removed from the room: stop receiving its messages right away
+            if self.room['is_group']:
+                get_coalescer().leave(self.room_group_name, self.user.id, self.user.username)
+            self.room = None
+            await self.leave_presence()
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+            await self.close()
+    
+    async def room_updated(self, event):
+        if self.room is not None:
+            self.room.update(event['room'])
+    
+    @database_sync_to_async
+    def get_room(self):
+        return ChatRoom.objects.filter(
+            id=self.room_id, members=self.user
+        ).values('id', 'name', 'is_group').first()
+    
+    @database_sync_to_async
+    def get_blocked_ids(self):
+        # From the database: a stale cache entry would let a block slip through
+        return social_graph.block_ids(self.user.id)
     
     @database_sync_to_async
     def save_message(self, user_id, message):
-        user = User.objects.get(id=user_id)
-        room = ChatRoom.objects.get(id=self.room_id)
+        # Membership was checked in connect(), so no lookups are needed here
         message_obj = Message.objects.create(
-            room=room,
-            sender=user,
+            room_id=self.room_id,
+            sender_id=user_id,
             content=message
         )
         return message_obj.id
@@ -0,0 +1,81 @@
+# chat/framing.py
+import json
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; it normally comes with channels_redis
+    msgpack = None
+
+# Clients opt in to batched frames by offering one of these WebSocket
+# subprotocols. A batched frame is a JSON array (text frame) or a msgpack
+# array (binary frame) of the events that would otherwise be sent one by one.
+SUBPROTOCOL_BATCH_MSGPACK = 'beyou.batch.msgpack'
+SUBPROTOCOL_BATCH_JSON = 'beyou.batch.json'
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+
+
+def batch_window():
+    return getattr(settings, 'CHAT_BATCH_WINDOW', 0.005)
+
+
+def batch_max_events():
+    return getattr(settings, 'CHAT_BATCH_MAX_EVENTS', 100)
+
+
+def negotiate(subprotocols):
+    """
+    Return (subprotocol, encoding) for the offered subprotocols, or
+    (None, None) for clients that want one JSON event per frame.
+    """
+    if SUBPROTOCOL_BATCH_MSGPACK in subprotocols and msgpack is not None:
+        return SUBPROTOCOL_BATCH_MSGPACK, ENCODING_MSGPACK
+    if SUBPROTOCOL_BATCH_JSON in subprotocols:
+        return SUBPROTOCOL_BATCH_JSON, ENCODING_JSON
+    return None, None
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    if text_data is not None:
+        return json.loads(text_data)
+    if msgpack is None:
+        raise ValueError('Binary frames require msgpack')
+    return msgpack.unpackb(bytes_data, raw=False)
+
+
+def encode_event(handler, payload, **extra):
+    """
+    Build a channel layer event whose client payload is already encoded.
+
+    The sender pays for one JSON encoding and every receiving consumer
+    forwards the result untouched, instead of each of them re-serializing
+    the same dict. Only JSON travels through the layer; the msgpack form is
+    made on demand by packed_payload(). extra carries fields that consumers
+    need for routing decisions but that are not sent to clients.
+    """
+    return {'type': handler, 'text': json.dumps(payload), **extra}
+
+
+def packed_payload(event):
+    """
+    The msgpack encoding of an encode_event() payload, made by the first
+    msgpack receiver and cached on the event. Local receivers share one
+    event dict (see chat/layers.py), so this costs one transcode per process
+    that has msgpack clients, and nothing where none negotiated it.
+    """
+    packed = event.get('packed')
+    if packed is None:
+        packed = event['packed'] = msgpack.packb(json.loads(event['text']), use_bin_type=True)
+    return packed
+
+
+def encode_batch(frames, encoding):
+    """
+    Return the kwargs for AsyncWebsocketConsumer.send() for a list of
+    pre-encoded events, joining them without decoding.
+    """
+    if encoding == ENCODING_MSGPACK:
+        return {'bytes_data': msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)}
+    return {'text_data': '[' + ','.join(frames) + ']'}
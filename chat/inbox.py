@@ -0,0 +1,148 @@
+# chat/inbox.py
+from collections import defaultdict
+from django.db import connection, transaction
+from django.db.models import F, Q
+from .models import ChatRoom, Message, RoomReadState
+
+PREVIEW_LENGTH = 100
+
+# Unread counts stop here; past it the exact number does not matter
+UNREAD_LIMIT = 100
+
+# Only the columns the room list returns are read from the table
+ROOM_FIELDS = (
+    'id', 'name', 'is_group', 'last_message_id', 'last_message_sender_id',
+    'last_message_preview', 'last_activity',
+)
+
+
+def message_preview(content, file_name=None):
+    if content:
+        return content[:PREVIEW_LENGTH]
+    return file_name or ''
+
+
+def record_messages(messages):
+    """
+    Fold new messages into the denormalized inbox columns.
+
+    messages are dicts with room_id, id, sender_id, created_at and preview.
+    Per room this is one UPDATE of the room's last message and one forward
+    only UPDATE per sender, who has read everything up to their own message.
+    Other members' rows are never written: their unread count is derived
+    from their read cursor when the inbox is listed, so a message costs the
+    same in a room of two and a room of thousands.
+    """
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message['room_id']].append(message)
+
+    with transaction.atomic():
+        for room_id, room_messages in by_room.items():
+            room_messages.sort(key=lambda message: (message['created_at'], message['id']))
+            latest = room_messages[-1]
+
+            # Write-behind batches can land out of order, never move backwards
+            ChatRoom.objects.filter(id=room_id).filter(
+                Q(last_activity__isnull=True) | Q(last_activity__lte=latest['created_at'])
+            ).update(
+                last_message_id=latest['id'],
+                last_message_sender_id=latest['sender_id'],
+                last_message_preview=latest['preview'],
+                last_activity=latest['created_at'],
+            )
+
+            senders = {}
+            for message in room_messages:
+                senders[message['sender_id']] = max(senders.get(message['sender_id'], 0), message['id'])
+            for sender_id, message_id in senders.items():
+                advance_cursors(room_id, sender_id, message_id)
+
+
+def advance_cursors(room_id, user_id, message_id):
+    """Move a member's read and delivered cursors forward to message_id."""
+    states = RoomReadState.objects.filter(room_id=room_id, user_id=user_id)
+    states.filter(
+        Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id)
+    ).update(last_read_message_id=message_id)
+    return states.filter(
+        Q(last_delivered_message_id__isnull=True) | Q(last_delivered_message_id__lt=message_id)
+    ).update(last_delivered_message_id=message_id)
+
+
+def unread_counts(cursors):
+    """
+    {room_id: unread} for {room_id: (last_read_message_id, last_message_id)}.
+
+    Only rooms whose last message is past the cursor are counted, all in one
+    query of index-only range scans on (room, id). Each scan stops after
+    UNREAD_LIMIT rows, so a dormant member of a busy room costs no more than
+    anyone else; clients show UNREAD_LIMIT as "99+". A member's own messages
+    are never past their cursor, so nothing needs excluding.
+    """
+    ranges = [
+        (room_id, read or 0)
+        for room_id, (read, last_id) in cursors.items()
+        if last_id is not None and (read is None or read < last_id)
+    ]
+    if not ranges:
+        return {}
+    table = connection.ops.quote_name(Message._meta.db_table)
+    # LIMIT is not allowed in every backend's UNION members, but it is in
+    # derived tables
+    scans = ' UNION ALL '.join(
+        f'SELECT room_id FROM (SELECT room_id FROM {table} WHERE room_id = %s AND id > %s LIMIT %s) AS room_{index}'
+        for index in range(len(ranges))
+    )
+    params = [param for room_id, read in ranges for param in (room_id, read, UNREAD_LIMIT)]
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT room_id, COUNT(*) FROM ({scans}) AS unread GROUP BY room_id', params)
+        return dict(cursor.fetchall())
+
+
+def add_members(room_id, user_ids):
+    # New members start caught up: history from before they joined is not unread
+    last_id = ChatRoom.objects.filter(id=room_id).values_list('last_message_id', flat=True).first()
+    RoomReadState.objects.bulk_create(
+        [
+            RoomReadState(room_id=room_id, user_id=user_id, last_read_message_id=last_id, last_delivered_message_id=last_id)
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def remove_members(room_id, user_ids):
+    RoomReadState.objects.filter(room_id=room_id, user_id__in=list(user_ids)).delete()
+
+
+def mark_read(room_id, user_id, message_id, last_message_id):
+    """Move the read cursor forward only; returns the unread count left."""
+    state, created = RoomReadState.objects.get_or_create(
+        room_id=room_id, user_id=user_id,
+        defaults={'last_read_message_id': message_id, 'last_delivered_message_id': message_id},
+    )
+    read = message_id
+    if not created:
+        advance_cursors(room_id, user_id, message_id)
+        if state.last_read_message_id is not None:
+            read = max(read, state.last_read_message_id)
+    return read, unread_counts({room_id: (read, last_message_id)}).get(room_id, 0)
+
+
+def list_rooms(user):
+    """
+    The user's rooms, most recently active first, each with its last message
+    and unread count. Three queries however many rooms the user is in.
+    """
+    rooms = list(
+        ChatRoom.objects.filter(members=user)
+        .order_by(F('last_activity').desc(nulls_last=True), '-id')
+        .values(*ROOM_FIELDS)
+    )
+    reads = dict(RoomReadState.objects.filter(user=user).values_list('room_id', 'last_read_message_id'))
+    unread = unread_counts({room['id']: (reads.get(room['id']), room['last_message_id']) for room in rooms})
+    for room in rooms:
+        room['last_read_message_id'] = reads.get(room['id'])
+        room['unread_count'] = unread.get(room['id'], 0)
+    return rooms
@@ -0,0 +1,271 @@
+# chat/layers.py
+import asyncio
+import logging
+import time
+import uuid
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+RELAY_SEND = 'layer.relay.send'
+RELAY_GROUP = 'layer.relay.group'
+
+
+class LocalFirstChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that delivers inside the process first.
+
+    Sockets in this process get messages straight onto their asyncio queue:
+    no serialization, no copy, no network hop. Messages are therefore shared
+    between receivers and must be treated as read-only, which is how the chat
+    consumers already use them (see chat/framing.py).
+
+    Cross-process traffic goes through an optional remote layer, normally
+    channels_redis. The remote layer never sees individual sockets: each
+    process joins a remote group once, with one relay channel, as soon as it
+    has a local member, and fans the relayed message out locally. A room with
+    thousands of members is a handful of processes in Redis.
+
+    Local group membership is split into shards of shard_size channels, and
+    group_send yields to the event loop between shards, so fanning out to a
+    huge room does not stall every other socket in the process.
+
+    The relay channel carries every message for the process, so the remote
+    layer is given relay_capacity for it instead of the per-socket default,
+    and remote group memberships are re-added every group_expiry / 2 seconds
+    for as long as the process has local members. Local queues whose
+    consumer has stopped receiving for expiry seconds are dropped, together
+    with their group memberships.
+
+    Without a remote layer this is a single-node layer. For tests, a shared
+    InMemoryChannelLayer works as a local fake Redis between several
+    instances.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote=None, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, shard_size=256, relay_capacity=10000, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.shard_size = shard_size
+        if isinstance(remote, dict):
+            remote = import_string(remote['BACKEND'])(**remote.get('CONFIG', {}))
+        if remote is not None:
+            # Relay channels take the whole process's traffic, not one socket's
+            remote.channel_capacity = remote.compile_capacities({'layer.relay.*': relay_capacity}) + list(
+                remote.channel_capacity
+            )
+        self.remote = remote
+        self.process_id = uuid.uuid4().hex[:12]
+        self.relay_channel = f'layer.relay.{self.process_id}'
+        # channel name -> asyncio.Queue, for channels created in this process
+        self.channels = {}
+        # channel name -> monotonic time it was created or last received from
+        self._last_seen = {}
+        # channel name -> receive() calls waiting on it
+        self._receiving = {}
+        self._last_clean = 0
+        # group -> list of shards, each a set of local channel names
+        self.groups = {}
+        # group -> time this process last (re)joined the remote group
+        self.remote_groups = {}
+        self._relay_task = None
+        self._refresh_task = None
+
+    # Routing helpers
+
+    def _process_of(self, channel):
+        # Process-specific names look like '<prefix><process_id>!<suffix>'
+        if '!' not in channel:
+            return None
+        return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+            self._last_seen[channel] = time.monotonic()
+        return queue
+
+    def _deliver(self, channel, message):
+        if channel in self.channels or self._process_of(channel) is None:
+            queue = self._queue(channel)
+        else:
+            # A socket of this process that has gone away; nobody will read it
+            return
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait(message)
+
+    def _clean_expired(self):
+        # At most once a second: drop queues nobody has received from in expiry seconds
+        now = time.monotonic()
+        if now - self._last_clean < 1:
+            return
+        self._last_clean = now
+        cutoff = now - self.expiry
+        expired = {
+            channel for channel, seen in self._last_seen.items()
+            if seen < cutoff and channel not in self._receiving
+        }
+        if not expired:
+            return
+        for channel in expired:
+            self.channels.pop(channel, None)
+            del self._last_seen[channel]
+        for group, shards in list(self.groups.items()):
+            for shard in shards:
+                shard -= expired
+            shards[:] = [shard for shard in shards if shard]
+            if not shards:
+                del self.groups[group]
+                # The remote membership lapses on its own once it stops being refreshed
+                self.remote_groups.pop(group, None)
+
+    def _start_relay(self):
+        if self.remote is not None and self._relay_task is None:
+            loop = asyncio.get_running_loop()
+            self._relay_task = loop.create_task(self._relay())
+            self._refresh_task = loop.create_task(self._refresh_groups())
+
+    async def _refresh_groups(self):
+        # Remote memberships expire after group_expiry; renew them well before
+        while True:
+            await asyncio.sleep(self.group_expiry / 2)
+            for group in list(self.remote_groups):
+                try:
+                    await self.remote.group_add(group, self.relay_channel)
+                    self.remote_groups[group] = time.time()
+                except Exception:
+                    logger.exception('Refreshing remote group %s failed', group)
+
+    async def _relay(self):
+        while True:
+            try:
+                message = await self.remote.receive(self.relay_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Channel layer relay receive failed')
+                await asyncio.sleep(1)
+                continue
+            if message['type'] == RELAY_SEND:
+                try:
+                    self._deliver(message['channel'], message['message'])
+                except ChannelFull:
+                    logger.warning('Dropped relayed message for full channel %s', message['channel'])
+            elif message['type'] == RELAY_GROUP and message['origin'] != self.process_id:
+                await self._fan_out(message['group'], message['message'])
+
+    async def _fan_out(self, group, message):
+        for index, shard in enumerate(list(self.groups.get(group, ()))):
+            if index:
+                await asyncio.sleep(0)
+            for channel in list(shard):
+                try:
+                    self._deliver(channel, message)
+                except ChannelFull:
+                    # Same as other layers: a full receiver just misses group messages
+                    pass
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._clean_expired()
+        process_id = self._process_of(channel)
+        if process_id == self.process_id or self.remote is None:
+            self._deliver(channel, message)
+        elif process_id is not None:
+            await self.remote.send(f'layer.relay.{process_id}', {
+                'type': RELAY_SEND, 'channel': channel, 'message': message,
+            })
+        else:
+            await self.remote.send(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if self._process_of(channel) != self.process_id and self.remote is not None:
+            # A general channel shared between processes
+            return await self.remote.receive(channel)
+        queue = self._queue(channel)
+        self._receiving[channel] = self._receiving.get(channel, 0) + 1
+        try:
+            return await queue.get()
+        finally:
+            waiting = self._receiving.pop(channel) - 1
+            if waiting:
+                self._receiving[channel] = waiting
+            if channel in self._last_seen:
+                self._last_seen[channel] = time.monotonic()
+
+    async def new_channel(self, prefix='specific.'):
+        self._start_relay()
+        self._clean_expired()
+        channel = f'{prefix}{self.process_id}!{uuid.uuid4().hex}'
+        self._queue(channel)
+        return channel
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        shards = self.groups.setdefault(group, [])
+        if not any(channel in shard for shard in shards):
+            for shard in shards:
+                if len(shard) < self.shard_size:
+                    shard.add(channel)
+                    break
+            else:
+                shards.append({channel})
+        if self.remote is not None:
+            # Join the remote group once per process, refreshed before it expires
+            joined = self.remote_groups.get(group)
+            if joined is None or time.time() - joined > self.group_expiry / 2:
+                self._start_relay()
+                await self.remote.group_add(group, self.relay_channel)
+                self.remote_groups[group] = time.time()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        shards = self.groups.get(group)
+        if shards is None:
+            return
+        for shard in shards:
+            shard.discard(channel)
+        shards[:] = [shard for shard in shards if shard]
+        if not shards:
+            del self.groups[group]
+            if self.remote_groups.pop(group, None) is not None:
+                await self.remote.group_discard(group, self.relay_channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        self._clean_expired()
+        await self._fan_out(group, message)
+        if self.remote is not None:
+            await self.remote.group_send(group, {
+                'type': RELAY_GROUP, 'group': group, 'origin': self.process_id, 'message': message,
+            })
+
+    async def flush(self):
+        self.channels = {}
+        self._last_seen = {}
+        self.groups = {}
+        self.remote_groups = {}
+        if self.remote is not None:
+            await self.remote.flush()
+
+    async def close(self):
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+            self._refresh_task.cancel()
+            self._relay_task = self._refresh_task = None
+        if self.remote is not None and hasattr(self.remote, 'close'):
+            await self.remote.close()
@@ -0,0 +1,108 @@
+# chat/management/commands/bench_broadcast.py
+import asyncio
+import json
+import time
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.framing import ENCODING_JSON, encode_batch, encode_event
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def sample_payload(i):
+    return {
+        'type': 'message',
+        'message': 'The quick brown fox jumps over the lazy dog ' * 4,
+        'user_id': 42,
+        'message_id': 1000000 + i,
+    }
+
+
+def per_receiver_event(i):
+    # What the sender used to put on the layer: the raw fields
+    return {'type': 'chat_message', **sample_payload(i)}
+
+
+def per_receiver_forward(event):
+    # ...and what every consumer then did with them
+    return json.dumps({
+        'type': 'message',
+        'message': event['message'],
+        'user_id': event['user_id'],
+        'message_id': event['message_id'],
+    })
+
+
+def encode_once_event(i):
+    return encode_event('chat_message', sample_payload(i), user_id=42)
+
+
+def encode_once_forward(event):
+    return event['text']
+
+
+def wire_size(event):
+    # What channels_redis puts in Redis for this event
+    return len(msgpack.packb(event, use_bin_type=True)) if msgpack is not None else len(json.dumps(event))
+
+
+async def broadcast(layer, group_size, rounds, make_event, forward):
+    """
+    CPU seconds for rounds group_sends to group_size receivers, including the
+    layer's own serialization and every receiver's receive() and forward().
+    """
+    group = f'bench_{time.monotonic_ns()}'
+    channels = [await layer.new_channel('bench.') for _ in range(group_size)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+    try:
+        start = time.process_time()
+        for i in range(rounds):
+            await layer.group_send(group, make_event(i))
+            for channel in channels:
+                forward(await layer.receive(channel))
+        return time.process_time() - start
+    finally:
+        for channel in channels:
+            await layer.group_discard(group, channel)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare per-broadcast CPU time of per-receiver vs encode-once serialization, '
+        'measured through the configured channel layer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000', help='Comma separated group sizes')
+        parser.add_argument('--rounds', type=int, default=20, help='Broadcasts per group size')
+        parser.add_argument('--layer', default='default', help='CHANNEL_LAYERS alias to send through')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        rounds = options['rounds']
+        layer = get_channel_layer(options['layer'])
+        # Receivers are created per size; raise the per-channel limit so none is full
+        layer.capacity = max(layer.capacity, rounds)
+
+        # Sanity check: forwarded bytes are identical to what consumers used to send
+        event = encode_once_event(0)
+        assert json.loads(encode_batch([event['text']], ENCODING_JSON)['text_data'])[0] == sample_payload(0)
+        self.stdout.write(
+            f'layer: {type(layer).__name__}, bytes per event on the wire: '
+            f'per-receiver {wire_size(per_receiver_event(0))}, encode-once {wire_size(event)}'
+        )
+
+        async def run():
+            self.stdout.write(f"{'members':>8} {'per-receiver ms':>16} {'encode-once ms':>15} {'saved':>7}")
+            for size in sizes:
+                before = await broadcast(layer, size, rounds, per_receiver_event, per_receiver_forward) / rounds * 1000
+                after = await broadcast(layer, size, rounds, encode_once_event, encode_once_forward) / rounds * 1000
+                saved = (1 - after / before) * 100 if before else 0
+                self.stdout.write(f'{size:>8} {before:>16.3f} {after:>15.3f} {saved:>6.1f}%')
+
+        asyncio.run(run())
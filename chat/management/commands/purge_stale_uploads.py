@@ -0,0 +1,14 @@
+# chat/management/commands/purge_stale_uploads.py
+from django.core.management.base import BaseCommand
+from chat.uploads import purge_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads that saw no chunk for a while, and orphaned temp files. Run from cron.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None, help='Seconds without a chunk (default CHAT_UPLOAD_MAX_AGE)')
+
+    def handle(self, *args, **options):
+        count = purge_stale_uploads(options['max_age'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} stale uploads'))
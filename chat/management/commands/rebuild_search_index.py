@@ -0,0 +1,33 @@
+# chat/management/commands/rebuild_search_index.py
+from django.core.management.base import BaseCommand
+from chat.models import Message
+from chat.search import index_messages
+
+
+class Command(BaseCommand):
+    help = 'Index chat messages for search, e.g. messages sent before the index existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help='Only index messages in this room')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(content__isnull=True).exclude(content='')
+        if options['room'] is not None:
+            messages = messages.filter(room_id=options['room'])
+        batch_size = options['batch_size']
+
+        # Walk the primary key in batches so memory use stays flat
+        count = 0
+        last_id = 0
+        while True:
+            batch = list(
+                messages.filter(id__gt=last_id).order_by('id')
+                .values('id', 'room_id', 'sender_id', 'content')[:batch_size]
+            )
+            if not batch:
+                break
+            index_messages(batch, batch_size)
+            count += len(batch)
+            last_id = batch[-1]['id']
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} messages'))
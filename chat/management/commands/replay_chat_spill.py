@@ -0,0 +1,25 @@
+# chat/management/commands/replay_chat_spill.py
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.persistence import replay_spill
+
+
+class Command(BaseCommand):
+    help = (
+        'Insert chat messages left in the write-behind spill directory by '
+        'workers that exited before flushing. Run while the ASGI workers are stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', type=int, help='Only replay segments written by this worker id')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 500))
+
+    def handle(self, *args, **options):
+        spill_dir = getattr(settings, 'CHAT_WRITE_BEHIND_SPILL_DIR', os.path.join(settings.BASE_DIR, 'var', 'chat_spill'))
+        if not os.path.isdir(spill_dir):
+            self.stdout.write('No spill directory, nothing to replay')
+            return
+        pattern = f"{options['worker_id']}-*.jsonl" if options['worker_id'] is not None else '*.jsonl'
+        count = replay_spill(spill_dir, pattern=pattern, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Replayed {count} messages'))
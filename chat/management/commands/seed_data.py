@@ -0,0 +1,105 @@
+# chat/management/commands/seed_data.py
+import os
+import uuid
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from chat import seeding
+from chat.models import ChatRoom
+from chat.snowflake import get_worker_id
+
+KINDS = ('users', 'rooms', 'members', 'messages')
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk load users (with profiles), rooms, memberships and messages for load testing, '
+        'either generated or streamed from users/rooms/members/messages .jsonl or .csv files '
+        'in --from-dir. Rows are inserted with bulk_create in chunks; no per-row signals run. '
+        'Message ids are minted with --worker-id, which no running worker may be using.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-dir', help='Import <kind>.jsonl or <kind>.csv files from this directory')
+        parser.add_argument('--users', type=int, default=0, help='Users to generate')
+        parser.add_argument('--rooms', type=int, default=0, help='Rooms to generate')
+        parser.add_argument('--room-size', type=int, default=5, help='Members per generated room')
+        parser.add_argument('--messages-per-room', type=int, default=0, help='Messages to generate per room')
+        parser.add_argument('--password', help='Password of generated users; unusable if omitted')
+        parser.add_argument('--seed', default='beyou', help='Random seed for generated data')
+        parser.add_argument('--chunk-size', type=int, default=seeding.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--worker-id', type=int, help='Snowflake worker id for message ids; defaults to CHAT_WORKER_ID')
+
+    def progress(self, kind):
+        def report(total):
+            self.stdout.write(f'\r{kind}: {total}', ending='')
+            self.stdout.flush()
+        return report
+
+    def load(self, kind, rows, insert, chunk_size):
+        total = seeding.load(rows, insert, chunk_size, progress=self.progress(kind))
+        self.stdout.write(self.style.SUCCESS(f'\r{kind}: {total} inserted'))
+
+    def message_loader(self, options):
+        try:
+            worker_id = options['worker_id'] if options['worker_id'] is not None else get_worker_id()
+            return seeding.MessageLoader(worker_id)
+        except (ImproperlyConfigured, ValueError) as e:
+            raise CommandError(f'{e} (or pass --worker-id)')
+
+    def load_messages(self, rows, loader, chunk_size):
+        self.load('messages', rows, loader, chunk_size)
+        # Inbox columns and senders' cursors, once for the whole load
+        loader.finish()
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if options['from_dir']:
+            self.import_dir(options['from_dir'], chunk_size, options)
+        else:
+            self.generate(options, chunk_size)
+
+    def import_dir(self, directory, chunk_size, options):
+        paths = {}
+        for kind in KINDS:
+            for extension in ('.jsonl', '.csv'):
+                path = os.path.join(directory, kind + extension)
+                if os.path.exists(path):
+                    paths[kind] = path
+        if not paths:
+            raise CommandError(f'No users, rooms, members or messages .jsonl/.csv files in {directory}')
+        loader = self.message_loader(options) if 'messages' in paths else None
+
+        # Parents before children, so every foreign key already exists
+        if 'users' in paths:
+            self.load('users', seeding.read_rows(paths['users']), seeding.insert_users, chunk_size)
+        if 'rooms' in paths:
+            self.load('rooms', seeding.read_rows(paths['rooms']), seeding.insert_rooms, chunk_size)
+        if 'members' in paths:
+            self.load('members', seeding.read_rows(paths['members']), seeding.insert_members, chunk_size)
+        if loader is not None:
+            self.load_messages(seeding.read_rows(paths['messages']), loader, chunk_size)
+
+    def generate(self, options, chunk_size):
+        if options['users'] <= 0:
+            raise CommandError('Pass --users (and optionally --rooms, --messages-per-room) or --from-dir')
+        loader = self.message_loader(options) if options['rooms'] > 0 and options['messages_per_room'] > 0 else None
+
+        # Ids are assigned by the database, so nothing races with live
+        # inserts; this run's rows are found again by a unique tag
+        tag = uuid.uuid4().hex[:8]
+        self.load('users', seeding.generated_users(tag, options['users'], options['password']),
+                  seeding.insert_users, chunk_size)
+        if options['rooms'] <= 0:
+            return
+        user_ids = seeding.generated_user_ids(tag)
+
+        after_id = seeding.max_id(ChatRoom)
+        room_size, seed = options['room_size'], options['seed']
+        self.load('rooms', seeding.generated_rooms(tag, options['rooms'], room_size),
+                  seeding.insert_rooms, chunk_size)
+        room_ids = seeding.generated_room_ids(tag, after_id)
+        self.load('members', seeding.generated_members(room_ids, user_ids, room_size, seed),
+                  seeding.insert_members, chunk_size)
+        if loader is not None:
+            self.load_messages(seeding.generated_messages(room_ids, user_ids, room_size, options['messages_per_room'], seed),
+                               loader, chunk_size)
@@ -0,0 +1,213 @@
+# chat/media.py
+import mimetypes
+import os
+import posixpath
+import re
+import time
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import content_disposition_header
+from .storage import digest_from_name
+
+BLOCK_SIZE = 64 * 1024
+
+# Only these trees are served; anything else under MEDIA_ROOT (e.g. the
+# resumable upload temp dir) is never exposed
+SERVED_PREFIXES = ('chat_files/', 'profile_pics/', 'previews/')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+IMMUTABLE = 'private, max-age=31536000, immutable'
+
+
+class MediaNotFound(Exception):
+    pass
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def normalize_name(path):
+    """Return the storage name for a request path, or raise MediaNotFound."""
+    name = posixpath.normpath(path or '')
+    if name.startswith(('/', '..')) or '/../' in name or not name.startswith(SERVED_PREFIXES):
+        raise MediaNotFound(path)
+    return name
+
+
+def source_name(name):
+    """The file a preview was generated from; other names map to themselves."""
+    if name.startswith('previews/'):
+        return posixpath.dirname(name[len('previews/'):])
+    return name
+
+
+def url_ttl():
+    return getattr(settings, 'MEDIA_URL_TTL', 6 * 60 * 60)
+
+
+def _signature(source, expires):
+    return salted_hmac('chat.media.url', f'{source}:{expires}').hexdigest()
+
+
+def sign_url(url, name):
+    """
+    Append an expiring signature to a media URL, so <img> and <video> tags,
+    which cannot send an Authorization header, can load it. The signature
+    covers the source file, so one signs a file and all of its previews.
+    Expiry is rounded up to a whole TTL period, which keeps the URL (and so
+    the browser cache entry) stable for at least one period.
+    """
+    ttl = url_ttl()
+    expires = (int(time.time()) // ttl + 2) * ttl
+    query = urlencode({'expires': expires, 'signature': _signature(source_name(name), expires)})
+    return f'{url}?{query}'
+
+
+def signature_valid(name, params):
+    try:
+        expires = int(params.get('expires', ''))
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return constant_time_compare(params.get('signature', ''), _signature(source_name(name), expires))
+
+
+def file_etag(name, stat):
+    # Content-addressed files are named after their SHA-256, which makes a
+    # strong validator that costs nothing to compute
+    digest = digest_from_name(name)
+    if digest:
+        return f'"{digest}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def cache_control(name):
+    if digest_from_name(name):
+        return IMMUTABLE
+    if source_name(name).startswith('profile_pics/'):
+        return 'public, no-cache'
+    return 'private, no-cache'
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def parse_range(header, size):
+    """
+    Parse a single 'bytes=start-end' range into (start, end) with end
+    exclusive. Returns None when the whole file should be sent, including for
+    multi-range requests, which a server is allowed to ignore.
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+def iter_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def sendfile_backend():
+    return getattr(settings, 'MEDIA_SENDFILE_BACKEND', None)
+
+
+def serve_file(request, name, file_name=None):
+    """
+    Serve a file under MEDIA_ROOT with ETag, If-None-Match and single-range
+    support. With MEDIA_SENDFILE_BACKEND set, the body is left to the front
+    server (nginx X-Accel-Redirect or X-Sendfile), which also answers Range
+    requests itself. Otherwise whole files go out through FileResponse, which
+    the server can send with sendfile(); ranges are streamed in blocks.
+    """
+    path = default_storage.path(name)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise MediaNotFound(name)
+
+    etag = file_etag(name, stat)
+    headers = {'ETag': etag, 'Cache-Control': cache_control(name), 'Accept-Ranges': 'bytes'}
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type, _ = mimetypes.guess_type(file_name or name)
+    content_type = content_type or 'application/octet-stream'
+    backend = sendfile_backend()
+
+    if backend == 'nginx':
+        response = HttpResponse(content_type=content_type)
+        prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + name
+    elif backend == 'xsendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        byte_range = None
+        # A stale If-Range means the client's partial copy is outdated, so
+        # it gets the whole file instead
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range.strip() == etag:
+            try:
+                byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{stat.st_size}'
+                return response
+
+        if byte_range and byte_range != (0, stat.st_size):
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_range(path, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end - 1}/{stat.st_size}'
+            response['Content-Length'] = str(end - start)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+
+    for header, value in headers.items():
+        response[header] = value
+    if file_name:
+        response['Content-Disposition'] = content_disposition_header(False, file_name)
+    return response
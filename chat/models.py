@@ -1,12 +1,26 @@
 # chat/models.py
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
+import uuid
+from .storage import chat_file_storage
 
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255)
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='chat_rooms')
+    # Denormalized from the newest message so the inbox never reads the
+    # messages table; kept up to date by chat/inbox.py
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_sender_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=255, blank=True, default='')
+    last_activity = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity', 'id'], name='chat_room_activity_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -15,9 +29,89 @@ class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField(blank=True, null=True)
-    file = models.FileField(upload_to='chat_files/', blank=True, null=True)
+    # Content addressed: identical uploads share one file, see chat/storage.py
+    file = models.FileField(upload_to='chat_files/', storage=chat_file_storage, blank=True, null=True)
     file_name = models.CharField(max_length=255, blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: write-behind inserts carry the time the message was sent
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of a room's history (see chat/pagination.py)
+            models.Index(fields=['room', 'created_at', 'id'], name='chat_msg_room_created_idx'),
+            # Unread counts and receipt validation: index-only ranges past a cursor
+            models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+            # Authorizes media requests that come without a signed URL (see MediaView)
+            models.Index(fields=['file'], name='chat_msg_file_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
+
+class ChunkedUpload(models.Model):
+    """An in-progress resumable upload; see chat/uploads.py."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='uploads')
+    uploader = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chunked_uploads')
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Bytes received so far; the next chunk must start at this offset
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last chunk written; abandoned uploads are purged by purge_stale_uploads
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.size})"
+
+class StoredBlob(models.Model):
+    """Reference count for a content-addressed file shared by messages."""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+class RoomReadState(models.Model):
+    """
+    A member's read and delivery cursors for a room; see chat/inbox.py and
+    chat/receipts.py. Receipts are cursors, not rows per message, and the
+    unread count is derived from the read cursor.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='room_read_states')
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+    last_delivered_message_id = models.BigIntegerField(null=True, blank=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_read_state_user_room_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id} (read up to {self.last_read_message_id})"
+
+class MessageTerm(models.Model):
+    """
+    Posting in the message search index: one row per distinct term per
+    message, maintained by chat/search.py. Room and sender are copied in so
+    filtered searches are answered from the index alone.
+    """
+    term = models.CharField(max_length=64)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='terms')
+    room_id = models.BigIntegerField()
+    sender_id = models.BigIntegerField()
+    # Term frequency normalized by message length, summed into the rank
+    weight = models.FloatField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'room_id', 'message'], name='chat_term_room_idx'),
+            models.Index(fields=['term', 'sender_id', 'message'], name='chat_term_sender_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.term} in {self.message_id}"
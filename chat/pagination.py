@@ -0,0 +1,82 @@
+# chat/pagination.py
+import base64
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+# Only the columns the history API returns are read from the table
+MESSAGE_FIELDS = ('id', 'sender_id', 'content', 'file', 'file_name', 'created_at')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, message_id = raw.rsplit('|', 1)
+        created_at = parse_datetime(created_at)
+        message_id = int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor')
+    # Ids past BIGINT would fail in the database instead
+    if created_at is None or not 0 < message_id < 2 ** 63:
+        raise InvalidCursor('Invalid cursor')
+    return created_at, message_id
+
+
+def parse_page_size(value):
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise InvalidCursor('Invalid limit')
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def paginate_messages(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Keyset pagination over (created_at, id).
+
+    Each page is a range scan on the (room, created_at, id) index that starts
+    at the cursor, so the cost of a page does not depend on how deep into the
+    history it is. Rows are returned oldest first.
+    """
+    queryset = queryset.values(*MESSAGE_FIELDS)
+
+    if after:
+        created_at, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+        ).order_by('created_at', 'id')
+        rows = list(queryset[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        if before:
+            created_at, message_id = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+            )
+        queryset = queryset.order_by('-created_at', '-id')
+        rows = list(queryset[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+    return {
+        'results': rows,
+        'has_more': has_more,
+        # Fetch older messages with ?before=, newer ones with ?after=
+        'before': encode_cursor(rows[0]) if rows else None,
+        'after': encode_cursor(rows[-1]) if rows else None,
+    }
@@ -0,0 +1,292 @@
+# chat/persistence.py
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .inbox import message_preview, record_messages
+from .models import Message
+from .search import index_messages
+from .snowflake import get_worker_id, next_id
+
+logger = logging.getLogger(__name__)
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def direct_message_id():
+    """
+    The id for a message inserted directly rather than through the writer.
+    With write-behind on it is a snowflake too: an AUTO_INCREMENT value would
+    push the counter into the snowflake range, where later auto ids could
+    collide with buffered messages.
+    """
+    return next_id() if write_behind_enabled() else None
+
+
+def _entry_to_message(entry):
+    return Message(
+        id=entry['id'],
+        room_id=entry['room_id'],
+        sender_id=entry['sender_id'],
+        content=entry['content'],
+        created_at=parse_datetime(entry['created_at']),
+    )
+
+
+def insert_entries(entries, batch_size, replay=False):
+    """
+    Bulk insert journal entries. Live batches are inserted as they are: ids
+    are unique per worker, so a conflict is a real error and must fail the
+    batch rather than drop messages. A replayed journal may hold rows that
+    were already committed before a crash; with replay=True those are
+    skipped by id.
+    """
+    messages = [_entry_to_message(entry) for entry in entries]
+    with transaction.atomic():
+        if replay:
+            existing = set(Message.objects.filter(
+                id__in=[message.id for message in messages]
+            ).values_list('id', flat=True))
+            # Already counted in the inbox and indexed
+            messages = [message for message in messages if message.id not in existing]
+        Message.objects.bulk_create(messages, batch_size=batch_size)
+        # bulk_create sends no post_save, so the inbox is updated here
+        record_messages([
+            {
+                'room_id': message.room_id,
+                'id': message.id,
+                'sender_id': message.sender_id,
+                'created_at': message.created_at,
+                'preview': message_preview(message.content),
+            }
+            for message in messages
+        ])
+        index_messages([
+            {'id': message.id, 'room_id': message.room_id, 'sender_id': message.sender_id, 'content': message.content}
+            for message in messages
+        ], batch_size, replace=False)
+
+
+def read_segment(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A torn final line from a crash mid-write
+                logger.warning('Skipping unreadable line in %s', path)
+    return entries
+
+
+def replay_spill(spill_dir, pattern='*.jsonl', batch_size=500):
+    """
+    Insert every entry found in spill segments matching pattern and delete
+    the segments. Returns the number of entries replayed.
+    """
+    count = 0
+    for path in sorted(glob.glob(os.path.join(spill_dir, pattern))):
+        entries = read_segment(path)
+        if entries:
+            insert_entries(entries, batch_size, replay=True)
+        os.remove(path)
+        count += len(entries)
+    return count
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages.
+
+    enqueue() hands out a snowflake ID immediately and appends the message to
+    an on-disk journal segment. Journal writes, fsyncs and rotations run on
+    one dedicated thread, in order, so the event loop never waits on the
+    disk; a message is acknowledged once its line is written. A background
+    task bulk inserts the buffer
+    every flush_interval seconds or as soon as batch_size messages are
+    waiting. A segment is only deleted after its messages are committed, so
+    anything left on disk after a crash is replayed on the next start by the
+    worker with the same id. A batch that still fails after max_retries
+    flushes is dropped from memory and its segments are moved to failed/
+    for replay_chat_spill once the cause is fixed.
+    """
+
+    def __init__(self, spill_dir, worker_id, batch_size=500, flush_interval=0.2, fsync=False, max_retries=5):
+        self.spill_dir = spill_dir
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_retries = max_retries
+        self._buffer = []
+        self._replay = []
+        self._failures = 0
+        self._journal = None
+        self._journal_path = None
+        self._journal_entries = 0
+        self._lock_file = None
+        self._segment_seq = 0
+        self._pending_segments = []
+        self._wake = None
+        self._task = None
+        # One thread, so journal operations happen in the order they were asked for
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-journal')
+
+    def _segment_path(self, seq):
+        return os.path.join(self.spill_dir, f'{self.worker_id}-{seq:012d}.jsonl')
+
+    def _open_segment(self):
+        self._segment_seq += 1
+        path = self._segment_path(self._segment_seq)
+        self._journal = open(path, 'a')
+        self._journal_path = path
+        self._journal_entries = 0
+
+    def _rotate(self):
+        # An empty segment holds nothing to commit; keep writing to it
+        if self._journal is not None and not self._journal_entries:
+            return
+        if self._journal is not None:
+            self._journal.close()
+            self._pending_segments.append(self._journal_path)
+        self._open_segment()
+
+    def _lock_worker_id(self):
+        # Segments are named by worker id; a second live process with the
+        # same id would replay and delete this one's journal
+        self._lock_file = open(os.path.join(self.spill_dir, f'{self.worker_id}.lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise ImproperlyConfigured(f'CHAT_WORKER_ID {self.worker_id} is already in use by another process')
+
+    def start(self):
+        if self._task is not None:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._lock_worker_id()
+        # Pick up where a crashed process with the same worker id left off
+        leftovers = sorted(glob.glob(os.path.join(self.spill_dir, f'{self.worker_id}-*.jsonl')))
+        for path in leftovers:
+            self._replay.extend(read_segment(path))
+            self._pending_segments.append(path)
+        if leftovers:
+            self._segment_seq = int(os.path.basename(leftovers[-1]).split('-')[1].split('.')[0])
+        self._open_segment()
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._replay:
+            self._wake.set()
+
+    def _append(self, line):
+        self._journal.write(line)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_entries += 1
+
+    def _in_io_thread(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    async def enqueue(self, room_id, sender_id, content):
+        self.start()
+        entry = {
+            'id': next_id(),
+            'room_id': int(room_id),
+            'sender_id': sender_id,
+            'content': content,
+            'created_at': timezone.now().isoformat(),
+        }
+        # Buffered and queued for the journal in the same step: a flush that
+        # takes this entry rotates the segment only after its line is written
+        written = self._in_io_thread(self._append, json.dumps(entry) + '\n')
+        self._buffer.append(entry)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+        await written
+        return entry['id']
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._buffer or self._replay:
+                await self.flush()
+
+    def _give_up(self, count):
+        failed_dir = os.path.join(self.spill_dir, 'failed')
+        os.makedirs(failed_dir, exist_ok=True)
+        for path in self._pending_segments:
+            try:
+                os.replace(path, os.path.join(failed_dir, os.path.basename(path)))
+            except FileNotFoundError:
+                pass
+        logger.error(
+            'Dropped %d chat messages after %d failed flushes; segments moved to %s',
+            count, self.max_retries, failed_dir,
+        )
+        self._pending_segments = []
+        self._replay = []
+        self._failures = 0
+
+    def _remove_pending_segments(self):
+        for path in self._pending_segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._pending_segments = []
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        await self._in_io_thread(self._rotate)
+        try:
+            if self._replay:
+                await database_sync_to_async(insert_entries)(self._replay, self.batch_size, replay=True)
+                self._replay = []
+            if batch:
+                await database_sync_to_async(insert_entries)(batch, self.batch_size)
+        except Exception:
+            self._failures += 1
+            logger.exception('Failed to flush %d chat messages (attempt %d)', len(batch) + len(self._replay), self._failures)
+            if self._failures >= self.max_retries:
+                await self._in_io_thread(self._give_up, len(batch) + len(self._replay))
+                return
+            # Keep the batch (and its segments) and retry on the next tick
+            self._buffer = batch + self._buffer
+            return
+        self._failures = 0
+        await self._in_io_thread(self._remove_pending_segments)
+
+
+_writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            spill_dir=getattr(settings, 'CHAT_WRITE_BEHIND_SPILL_DIR', os.path.join(settings.BASE_DIR, 'var', 'chat_spill')),
+            worker_id=get_worker_id(),
+            batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 500),
+            flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.2),
+            fsync=getattr(settings, 'CHAT_WRITE_BEHIND_FSYNC', False),
+            max_retries=getattr(settings, 'CHAT_WRITE_BEHIND_MAX_RETRIES', 5),
+        )
+    return _writer
@@ -0,0 +1,230 @@
+# chat/presence.py
+import asyncio
+import logging
+import time
+import uuid
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from users import social_graph
+from .framing import encode_event
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis normally comes with channels_redis
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    # Every socket of a user joins this group; it carries their friends'
+    # presence and changes to who they have blocked
+    return f'user_{user_id}'
+
+
+class LocalPresenceStore:
+    """
+    In-process stand-in for the shared presence store, for development and
+    single-worker deployments. Same interface and TTL semantics as
+    RedisPresenceStore: a user is online while any worker's lease on them
+    has not expired.
+    """
+
+    def __init__(self):
+        # user_id -> {worker_id: expires_at}
+        self._leases = {}
+
+    async def heartbeat(self, worker_id, user_ids, ttl):
+        expires_at = time.time() + ttl
+        for user_id in user_ids:
+            self._leases.setdefault(user_id, {})[worker_id] = expires_at
+
+    async def remove(self, worker_id, user_ids):
+        for user_id in user_ids:
+            leases = self._leases.get(user_id)
+            if leases is not None:
+                leases.pop(worker_id, None)
+                if not leases:
+                    del self._leases[user_id]
+
+    async def online(self, user_ids):
+        now = time.time()
+        return {
+            user_id for user_id in user_ids
+            if any(expires_at > now for expires_at in self._leases.get(user_id, {}).values())
+        }
+
+
+class RedisPresenceStore:
+    """
+    Presence shared by all workers. Each user is a sorted set of the workers
+    holding a socket for them, scored by lease expiry, so a crashed worker's
+    users go offline on their own once its leases run out. Every call is one
+    pipelined round trip however many users it covers.
+    """
+
+    def __init__(self, url, prefix='presence'):
+        self.client = aioredis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f'{self.prefix}:{user_id}'
+
+    async def heartbeat(self, worker_id, user_ids, ttl):
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                key = self._key(user_id)
+                pipe.zadd(key, {worker_id: now + ttl})
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+
+    async def remove(self, worker_id, user_ids):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrem(self._key(user_id), worker_id)
+            await pipe.execute()
+
+    async def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self._key(user_id), f'({now}', '+inf')
+            counts = await pipe.execute()
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+
+def friend_pairs(user_ids):
+    from friendship.models import Friend
+    # Friendships are stored in both directions, so one side is enough
+    return list(Friend.objects.filter(from_user_id__in=list(user_ids)).values_list('from_user_id', 'to_user_id'))
+
+
+def visible_presence(user_id, user_ids):
+    """The ids among user_ids whose presence user_id may see: friends and themselves."""
+    # Polled by every open client; the cached friend set is close enough
+    return {other_id for other_id in user_ids if other_id == user_id or social_graph.are_friends(user_id, other_id)}
+
+
+class PresenceTracker:
+    """
+    Counts this worker's sockets per user and keeps their leases alive.
+
+    connect() and disconnect() only touch the in-memory shard. Every
+    heartbeat the worker renews the leases of everyone connected to it in one
+    store call and releases users whose last socket closed. Users who came
+    online or went offline anywhere since the last beat are announced to
+    their online friends, one presence event per friend per beat holding only
+    the changes. No database writes are involved.
+    """
+
+    def __init__(self, store, worker_id, heartbeat=10.0, ttl=30.0):
+        self.store = store
+        self.worker_id = str(worker_id)
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        # user_id -> number of open sockets on this worker
+        self._sockets = {}
+        self._arrived = set()
+        self._left = set()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def connect(self, user_id):
+        self.start()
+        count = self._sockets.get(user_id, 0)
+        self._sockets[user_id] = count + 1
+        if count == 0:
+            if user_id in self._left:
+                # Reconnected within a beat: nothing changed
+                self._left.discard(user_id)
+            else:
+                self._arrived.add(user_id)
+
+    def disconnect(self, user_id):
+        count = self._sockets.get(user_id, 0) - 1
+        if count > 0:
+            self._sockets[user_id] = count
+            return
+        self._sockets.pop(user_id, None)
+        if user_id in self._arrived:
+            self._arrived.discard(user_id)
+        else:
+            self._left.add(user_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.beat()
+            except Exception:
+                logger.exception('Presence heartbeat failed')
+
+    async def beat(self):
+        arrived, self._arrived = self._arrived, set()
+        left, self._left = self._left, set()
+
+        # Only users not already online through another worker are news
+        already_online = await self.store.online(arrived) if arrived else set()
+        await self.store.heartbeat(self.worker_id, list(self._sockets), self.ttl)
+        if left:
+            await self.store.remove(self.worker_id, left)
+        still_online = await self.store.online(left) if left else set()
+
+        changes = {user_id: True for user_id in arrived - already_online}
+        changes.update({user_id: False for user_id in left - still_online})
+        if changes:
+            await self.announce(changes)
+
+    async def announce(self, changes):
+        pairs = await database_sync_to_async(friend_pairs)(changes)
+        by_friend = {}
+        for user_id, friend_id in pairs:
+            by_friend.setdefault(friend_id, {})[user_id] = changes[user_id]
+        if not by_friend:
+            return
+        # Offline friends have nobody listening, skip them
+        listening = await self.store.online(by_friend)
+        channel_layer = get_channel_layer()
+        for friend_id in listening:
+            updates = by_friend[friend_id]
+            await channel_layer.group_send(user_group(friend_id), encode_event('presence', {
+                'type': 'presence',
+                'online': [user_id for user_id, online in updates.items() if online],
+                'offline': [user_id for user_id, online in updates.items() if not online],
+            }))
+
+
+_store = None
+_tracker = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        url = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', None)
+        if url and aioredis is not None:
+            _store = RedisPresenceStore(url)
+        else:
+            _store = LocalPresenceStore()
+    return _store
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = PresenceTracker(
+            get_store(),
+            # Leases only need an owner unique to this process for its lifetime;
+            # a restarted worker must not inherit (or release) old leases
+            worker_id=uuid.uuid4().hex,
+            heartbeat=getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 10.0),
+            ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 30.0),
+        )
+    return _tracker
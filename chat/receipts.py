@@ -0,0 +1,182 @@
+# chat/receipts.py
+import asyncio
+import logging
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from .framing import encode_event
+from .models import ChatRoom, RoomReadState
+from .persistence import write_behind_enabled
+from .snowflake import max_id_at
+
+logger = logging.getLogger(__name__)
+
+# Workers on other hosts may mint ids slightly ahead of this clock
+MAX_CLOCK_SKEW = 60
+
+
+def merge_cursor(current, message_id):
+    # Cursors only ever move forward
+    if message_id is None:
+        return current
+    if current is None:
+        return message_id
+    return max(current, message_id)
+
+
+def valid_cursor(message_id):
+    """
+    Whether a client supplied id can be a message id. With write-behind, acks
+    arrive before the insert, so they can't be checked against the room's
+    last message; anything past what could have been minted by now
+    (including values that overflow BIGINT) is rejected instead.
+    """
+    return 0 < message_id <= max_id_at(time.time() + MAX_CLOCK_SKEW)
+
+
+def clamp_cursors(cursors):
+    """
+    Without write-behind every message is in the database before its id is
+    sent, so no cursor may pass the room's last message. Ids are
+    auto-increment then, far below the snowflake bound valid_cursor checks,
+    and a cursor moved past them would stay ahead of every future message.
+    """
+    last = dict(
+        ChatRoom.objects.filter(id__in={room_id for room_id, _ in cursors}).values_list('id', 'last_message_id')
+    )
+    clamped = {}
+    for (room_id, user_id), (read, delivered) in cursors.items():
+        last_message_id = last.get(room_id)
+        if last_message_id is None:
+            continue
+        clamped[room_id, user_id] = (
+            min(read, last_message_id) if read is not None else None,
+            min(delivered, last_message_id) if delivered is not None else None,
+        )
+    return clamped
+
+
+def write_cursors(cursors):
+    """
+    Persist {(room_id, user_id): (read, delivered)} and return the subset
+    that actually moved forward. Reading a message implies it was delivered.
+    One conditional UPDATE per cursor, after one read of the rooms' last
+    message ids when write-behind is off; unread counts are derived from the
+    read cursor when the inbox is listed (see chat/inbox.py).
+    """
+    if not write_behind_enabled():
+        cursors = clamp_cursors(cursors)
+    moved = {}
+    with transaction.atomic():
+        for (room_id, user_id), (read, delivered) in cursors.items():
+            delivered = merge_cursor(delivered, read)
+            states = RoomReadState.objects.filter(room_id=room_id, user_id=user_id)
+            read_moved = delivered_moved = 0
+            if read is not None:
+                read_moved = states.filter(
+                    Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=read)
+                ).update(last_read_message_id=read)
+            if delivered is not None:
+                delivered_moved = states.filter(
+                    Q(last_delivered_message_id__isnull=True) | Q(last_delivered_message_id__lt=delivered)
+                ).update(last_delivered_message_id=delivered)
+            if read_moved or delivered_moved:
+                moved[room_id, user_id] = (read if read_moved else None, delivered if delivered_moved else None)
+    return moved
+
+
+def receipts_event(cursors):
+    """One compact event per room: [user_id, message_id] pairs per kind."""
+    return encode_event('read_receipts', {
+        'type': 'receipts',
+        'read': [[user_id, read] for user_id, (read, _) in cursors.items() if read is not None],
+        'delivered': [[user_id, delivered] for user_id, (_, delivered) in cursors.items() if delivered is not None],
+    }, user_ids=list(cursors))
+
+
+class ReceiptCoalescer:
+    """
+    Collects read and delivery acknowledgements and writes them once per tick.
+
+    An acknowledgement is a cursor (the newest message a member has read or
+    received in a room), so any number of acks from a member within a tick
+    collapse into one row update. Every tick the moved cursors are written
+    in one transaction and each affected room gets a single read_receipts
+    event. Storage and write volume scale with members, not with messages.
+    """
+
+    def __init__(self, tick=1.0, max_retries=5):
+        self.tick = tick
+        self.max_retries = max_retries
+        # (room_id, user_id) -> (read, delivered) not yet written
+        self._pending = {}
+        self._failures = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def update(self, room_id, user_id, read=None, delivered=None):
+        if read is not None and not valid_cursor(read):
+            read = None
+        if delivered is not None and not valid_cursor(delivered):
+            delivered = None
+        if read is None and delivered is None:
+            return
+        self.start()
+        key = (int(room_id), user_id)
+        current_read, current_delivered = self._pending.get(key, (None, None))
+        self._pending[key] = (merge_cursor(current_read, read), merge_cursor(current_delivered, delivered))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                # Never let one bad tick end receipt delivery for the process
+                logger.exception('Receipt flush failed')
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            moved = await database_sync_to_async(write_cursors)(batch)
+        except Exception:
+            self._failures += 1
+            if self._failures >= self.max_retries:
+                # A batch that keeps failing would otherwise be retried forever
+                logger.exception('Dropping %d read cursors after %d failed writes', len(batch), self._failures)
+                self._failures = 0
+                return
+            # Merge the batch back so the next tick retries it
+            logger.exception('Failed to write %d read cursors', len(batch))
+            for (room_id, user_id), (read, delivered) in batch.items():
+                self.update(room_id, user_id, read, delivered)
+            return
+        self._failures = 0
+
+        by_room = {}
+        for (room_id, user_id), cursor in moved.items():
+            by_room.setdefault(room_id, {})[user_id] = cursor
+        channel_layer = get_channel_layer()
+        for room_id, cursors in by_room.items():
+            await channel_layer.group_send(f'chat_{room_id}', receipts_event(cursors))
+
+
+_coalescer = None
+
+
+def get_coalescer():
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = ReceiptCoalescer(
+            tick=getattr(settings, 'CHAT_RECEIPT_TICK', 1.0),
+            max_retries=getattr(settings, 'CHAT_RECEIPT_MAX_RETRIES', 5),
+        )
+    return _coalescer
@@ -0,0 +1,114 @@
+# chat/search.py
+import re
+from collections import Counter
+from django.db import transaction
+from django.db.models import Count, Sum
+from .models import ChatRoom, Message, MessageTerm
+from .pagination import MESSAGE_FIELDS
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+MAX_QUERY_TERMS = 8
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'is', 'it', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was', 'with',
+))
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def tokenize(text):
+    return [
+        token for token in TOKEN_RE.findall((text or '').lower())
+        if MIN_TERM_LENGTH <= len(token) <= MAX_TERM_LENGTH and token not in STOPWORDS
+    ]
+
+
+def postings(message_id, room_id, sender_id, content):
+    counts = Counter(tokenize(content))
+    total = sum(counts.values())
+    return [
+        MessageTerm(term=term, message_id=message_id, room_id=room_id, sender_id=sender_id, weight=count / total)
+        for term, count in counts.items()
+    ]
+
+
+def index_messages(messages, batch_size=1000, replace=True):
+    """
+    Add messages to the search index. messages are dicts with id, room_id,
+    sender_id and content. With replace, postings of messages that were
+    indexed before are replaced, so edits and rebuilds do not leave stale or
+    duplicate terms; messages just inserted have none, and skip the DELETE.
+    """
+    rows = []
+    for message in messages:
+        rows.extend(postings(message['id'], message['room_id'], message['sender_id'], message['content']))
+    with transaction.atomic():
+        if replace:
+            MessageTerm.objects.filter(message_id__in=[message['id'] for message in messages]).delete()
+        MessageTerm.objects.bulk_create(rows, batch_size=batch_size)
+
+
+def parse_search_page(page, limit):
+    try:
+        page = max(1, int(page or 1))
+        limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise InvalidQuery('Invalid page or limit')
+    return page, limit
+
+
+def search_messages(user, query, room_id=None, sender_id=None, page=1, limit=DEFAULT_PAGE_SIZE):
+    """
+    Ranked search over the rooms the user is a member of.
+
+    Only index rows for the query terms are read: every term must match, and
+    messages are ranked by the summed normalized term frequency, newest first
+    on ties. One query finds the page of ids, one loads those messages.
+    """
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        raise InvalidQuery('Query has no searchable words')
+
+    rooms = ChatRoom.objects.filter(members=user).values('id')
+    if room_id is not None:
+        rooms = rooms.filter(id=room_id)
+
+    matches = MessageTerm.objects.filter(term__in=terms, room_id__in=rooms)
+    if sender_id is not None:
+        matches = matches.filter(sender_id=sender_id)
+
+    offset = (page - 1) * limit
+    ranked = list(
+        matches.values('message_id')
+        .annotate(matched=Count('term'), score=Sum('weight'))
+        .filter(matched=len(terms))
+        .order_by('-score', '-message_id')
+        .values_list('message_id', 'score')[offset:offset + limit + 1]
+    )
+    has_more = len(ranked) > limit
+    ranked = ranked[:limit]
+
+    rows = {
+        row['id']: row
+        for row in Message.objects.filter(id__in=[message_id for message_id, _ in ranked]).values('room_id', *MESSAGE_FIELDS)
+    }
+    results = []
+    for message_id, score in ranked:
+        row = rows.get(message_id)
+        if row is not None:
+            row['score'] = score
+            results.append(row)
+
+    return {
+        'results': results,
+        'page': page,
+        'has_more': has_more,
+    }
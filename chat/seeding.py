@@ -0,0 +1,262 @@
+# chat/seeding.py
+import csv
+import functools
+import json
+import random
+from datetime import timedelta
+from itertools import islice
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from users.models import Profile
+from .inbox import advance_cursors, message_preview
+from .models import ChatRoom, Message, MessageTerm, RoomReadState
+from .search import postings
+from .snowflake import SnowflakeGenerator
+
+DEFAULT_CHUNK_SIZE = 5000
+
+TRUE_VALUES = {'1', 'true', 'yes', 't', 'y'}
+
+WORDS = (
+    'hello', 'there', 'how', 'are', 'you', 'doing', 'today', 'see', 'later', 'meeting',
+    'lunch', 'weekend', 'photo', 'plans', 'great', 'thanks', 'sure', 'maybe', 'tomorrow', 'call',
+)
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_rows(path):
+    """Stream dicts from a .jsonl or .csv file, one line at a time."""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+@functools.lru_cache(maxsize=1024)
+def hash_password(raw):
+    # A hash costs tens of milliseconds by design; seeded users mostly share
+    # a handful of passwords, so each distinct one is hashed once
+    return make_password(raw)
+
+
+def max_id(model):
+    return model.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def insert_users(rows):
+    """
+    Insert users and their profiles. rows are dicts with email, username and
+    optionally id, password (raw), password_hash and is_verified; without an
+    id the database assigns one.
+
+    bulk_create sends no post_save, so the Profile rows the signal would
+    have made are created here in the same transaction. MySQL does not
+    return primary keys from a bulk insert, so they are read back by email.
+    """
+    User = get_user_model()
+    users = []
+    for row in rows:
+        password = row.get('password_hash') or hash_password(row.get('password') or None)
+        users.append(User(
+            id=_int(row.get('id')),
+            email=row['email'],
+            username=row['username'],
+            password=password,
+            is_verified=_bool(row.get('is_verified', False)),
+        ))
+    with transaction.atomic():
+        User.objects.bulk_create(users, batch_size=len(users))
+        user_ids = User.objects.filter(email__in=[user.email for user in users]).values_list('id', flat=True)
+        Profile.objects.bulk_create([Profile(user_id=user_id) for user_id in user_ids], batch_size=len(users))
+    return len(users)
+
+
+def insert_rooms(rows):
+    rooms = [
+        ChatRoom(id=_int(row.get('id')), name=row['name'], is_group=_bool(row.get('is_group', False)))
+        for row in rows
+    ]
+    ChatRoom.objects.bulk_create(rooms, batch_size=len(rooms))
+    return len(rooms)
+
+
+def insert_members(rows):
+    """rows are dicts with room_id and user_id."""
+    Membership = ChatRoom.members.through
+    pairs = [(_int(row['room_id']), _int(row['user_id'])) for row in rows]
+    with transaction.atomic():
+        Membership.objects.bulk_create(
+            [Membership(chatroom_id=room_id, user_id=user_id) for room_id, user_id in pairs],
+            batch_size=len(pairs), ignore_conflicts=True,
+        )
+        # No m2m_changed either, so the inbox rows are made here too
+        RoomReadState.objects.bulk_create(
+            [RoomReadState(room_id=room_id, user_id=user_id) for room_id, user_id in pairs],
+            batch_size=len(pairs), ignore_conflicts=True,
+        )
+    return len(pairs)
+
+
+class MessageLoader:
+    """
+    Inserts messages for seed_data, one chunk per call. rows are dicts with
+    room_id, sender_id, content and optionally id and created_at (ISO 8601).
+
+    Each chunk is one bulk_create of the messages and one of their search
+    postings, nothing else: unlike the live write-behind path there is no
+    inbox UPDATE per room and sender and no postings to replace, as the ids
+    are new. The newest message per room and per sender is remembered, and
+    finish() writes the rooms' last message columns and the senders' read
+    cursors once, after the last chunk.
+
+    Rows without an id get one from a snowflake generator for worker_id,
+    which must not be in use by any running worker.
+    """
+
+    def __init__(self, worker_id):
+        self.ids = SnowflakeGenerator(worker_id)
+        # room_id -> (created_at, id, sender_id, preview) of its newest message
+        self.latest = {}
+        # (room_id, sender_id) -> newest message id
+        self.senders = {}
+
+    def __call__(self, rows):
+        now = timezone.now()
+        messages = []
+        terms = []
+        for row in rows:
+            created_at = row.get('created_at')
+            message = Message(
+                id=_int(row.get('id')) or self.ids.next_id(),
+                room_id=_int(row['room_id']),
+                sender_id=_int(row['sender_id']),
+                content=row.get('content') or '',
+                created_at=parse_datetime(created_at) if created_at else now,
+            )
+            messages.append(message)
+            terms.extend(postings(message.id, message.room_id, message.sender_id, message.content))
+            latest = self.latest.get(message.room_id)
+            if latest is None or (message.created_at, message.id) > latest[:2]:
+                self.latest[message.room_id] = (
+                    message.created_at, message.id, message.sender_id, message_preview(message.content),
+                )
+            key = (message.room_id, message.sender_id)
+            self.senders[key] = max(self.senders.get(key, 0), message.id)
+        with transaction.atomic():
+            Message.objects.bulk_create(messages, batch_size=len(messages))
+            MessageTerm.objects.bulk_create(terms, batch_size=DEFAULT_CHUNK_SIZE)
+        return len(messages)
+
+    def finish(self, batch_size=1000):
+        rooms = list(self.latest.items())
+        for start in range(0, len(rooms), batch_size):
+            with transaction.atomic():
+                for room_id, (created_at, message_id, sender_id, preview) in rooms[start:start + batch_size]:
+                    # Live messages that arrived meanwhile may be newer
+                    ChatRoom.objects.filter(id=room_id).filter(
+                        Q(last_activity__isnull=True) | Q(last_activity__lte=created_at)
+                    ).update(
+                        last_message_id=message_id,
+                        last_message_sender_id=sender_id,
+                        last_message_preview=preview,
+                        last_activity=created_at,
+                    )
+        senders = list(self.senders.items())
+        for start in range(0, len(senders), batch_size):
+            with transaction.atomic():
+                # Senders have read their own messages
+                for (room_id, sender_id), message_id in senders[start:start + batch_size]:
+                    advance_cursors(room_id, sender_id, message_id)
+
+
+def generated_users(tag, count, password):
+    # The tag makes every run's emails unique; ids are left to the database
+    for index in range(count):
+        yield {
+            'email': f'seed-{tag}-{index}@example.com',
+            'username': f'seed-{tag}-{index}',
+            'password': password,
+            'is_verified': True,
+        }
+
+
+def generated_user_ids(tag):
+    User = get_user_model()
+    # A range scan of the unique email index
+    return list(User.objects.filter(email__startswith=f'seed-{tag}-').order_by('id').values_list('id', flat=True))
+
+
+def generated_rooms(tag, count, room_size):
+    for index in range(count):
+        yield {'name': f'Seed room {tag}-{index}', 'is_group': room_size > 2}
+
+
+def generated_room_ids(tag, after_id):
+    # Rooms created by others meanwhile are in the id range too, the name tells them apart
+    return list(
+        ChatRoom.objects.filter(id__gt=after_id, name__startswith=f'Seed room {tag}-')
+        .order_by('id').values_list('id', flat=True)
+    )
+
+
+def room_members(room_id, user_ids, room_size, seed):
+    # Derived from the room id, so members never have to be kept in memory
+    return random.Random(f'{seed}:{room_id}').sample(user_ids, min(room_size, len(user_ids)))
+
+
+def generated_members(room_ids, user_ids, room_size, seed):
+    for room_id in room_ids:
+        for user_id in room_members(room_id, user_ids, room_size, seed):
+            yield {'room_id': room_id, 'user_id': user_id}
+
+
+def generated_messages(room_ids, user_ids, room_size, per_room, seed):
+    # Room by room, so each chunk touches few rooms' inbox rows
+    start = timezone.now() - timedelta(days=30)
+    for room_id in room_ids:
+        rng = random.Random(f'{seed}:{room_id}:messages')
+        members = room_members(room_id, user_ids, room_size, seed)
+        sent_at = start
+        for _ in range(per_room):
+            sent_at += timedelta(seconds=rng.randint(1, 600))
+            yield {
+                'room_id': room_id,
+                'sender_id': rng.choice(members),
+                'content': ' '.join(rng.choices(WORDS, k=rng.randint(2, 12))),
+                'created_at': sent_at.isoformat(),
+            }
+
+
+def load(rows, insert, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Insert rows chunk_size at a time; only one chunk is ever in memory."""
+    total = 0
+    for chunk in chunked(rows, chunk_size):
+        total += insert(chunk)
+        if progress is not None:
+            progress(total)
+    return total
@@ -0,0 +1,157 @@
+# chat/signals.py
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .auth import user_changed
+from .inbox import add_members, message_preview, record_messages, remove_members
+from .models import ChatRoom, Message, StoredBlob
+from .search import index_messages
+from .storage import digest_from_name
+from .thumbnails import delete_variants, is_image, schedule_variants
+
+
+def send_to_room(room_id, event):
+    # Deliver only once the change is committed, so consumers never act on a
+    # membership change that was rolled back
+    channel_layer = get_channel_layer()
+    transaction.on_commit(
+        lambda: async_to_sync(channel_layer.group_send)(f'chat_{room_id}', event)
+    )
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def room_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    
+    if action == 'pre_clear':
+        # pk_set is not provided for clear(), read it before the rows go away
+        if reverse:
+            pk_set = set(instance.chat_rooms.values_list('id', flat=True))
+        else:
+            pk_set = set(instance.members.values_list('id', flat=True))
+    
+    added = action == 'post_add'
+    if reverse:
+        # user.chat_rooms.add/remove(...): one user, many rooms
+        for room_id in pk_set:
+            send_to_room(room_id, {
+                'type': 'room_members_changed',
+                'added': [instance.pk] if added else [],
+                'removed': [] if added else [instance.pk],
+            })
+    else:
+        send_to_room(instance.pk, {
+            'type': 'room_members_changed',
+            'added': list(pk_set) if added else [],
+            'removed': [] if added else list(pk_set),
+        })
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def update_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    # Every member has a read state row holding their cursors
+    if action == 'post_add':
+        if reverse:
+            for room_id in pk_set:
+                add_members(room_id, [instance.pk])
+        else:
+            add_members(instance.pk, pk_set)
+    elif action == 'post_remove':
+        if reverse:
+            for room_id in pk_set:
+                remove_members(room_id, [instance.pk])
+        else:
+            remove_members(instance.pk, pk_set)
+    elif action == 'post_clear':
+        if reverse:
+            instance.room_read_states.all().delete()
+        else:
+            instance.read_states.all().delete()
+
+
+@receiver(post_save, sender=Message)
+def update_inbox(sender, instance, created, **kwargs):
+    if not created:
+        return
+    record_messages([{
+        'room_id': instance.room_id,
+        'id': instance.id,
+        'sender_id': instance.sender_id,
+        'created_at': instance.created_at,
+        'preview': message_preview(instance.content, instance.file_name),
+    }])
+
+
+@receiver(post_save, sender=Message)
+def update_search_index(sender, instance, created, update_fields=None, **kwargs):
+    if not created and update_fields is not None and 'content' not in update_fields:
+        return
+    if not created or instance.content:
+        index_messages([{
+            'id': instance.id,
+            'room_id': instance.room_id,
+            'sender_id': instance.sender_id,
+            'content': instance.content,
+        }], replace=not created)
+
+
+@receiver(post_save, sender=ChatRoom)
+def room_updated(sender, instance, created, **kwargs):
+    if created:
+        return
+    send_to_room(instance.pk, {
+        'type': 'room_updated',
+        'room': {'name': instance.name, 'is_group': instance.is_group},
+    })
+
+
+# Content-addressed attachments are shared between messages, so a file is
+# only removed from storage when the last message referencing it is deleted.
+# References are taken by ContentAddressedStorage.save() (chat/storage.py)
+
+
+@receiver(post_save, sender=Message)
+def generate_previews(sender, instance, created, **kwargs):
+    if created and is_image(instance.file):
+        schedule_variants(instance.file)
+
+
+def delete_unreferenced_blob(storage, digest, name):
+    with transaction.atomic():
+        # Locks the row, or the gap where it would be: an upload of the same
+        # bytes either took a new reference before this (keep the file) or
+        # waits until the file is gone and stores it again
+        if StoredBlob.objects.select_for_update().filter(sha256=digest).exists():
+            return
+        storage.delete(name)
+        delete_variants(storage, name)
+
+
+@receiver(post_delete, sender=Message)
+def release_blob_reference(sender, instance, **kwargs):
+    digest = digest_from_name(instance.file.name if instance.file else None)
+    if digest is None:
+        return
+    with transaction.atomic():
+        blob = StoredBlob.objects.select_for_update().filter(sha256=digest).first()
+        if blob is None:
+            return
+        if blob.ref_count > 1:
+            StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+            return
+        blob.delete()
+    storage = instance.file.storage
+    name = blob.name
+    transaction.on_commit(lambda: delete_unreferenced_blob(storage, digest, name))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def forget_cached_user(sender, instance, **kwargs):
+    # WebSocket auth caches user rows; every process reloads it on change
+    pk = instance.pk
+    transaction.on_commit(lambda: user_changed(pk))
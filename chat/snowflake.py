@@ -0,0 +1,66 @@
+# chat/snowflake.py
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# 41 bits of milliseconds since EPOCH_MS, 10 bits of worker id, 12 bits of sequence.
+# IDs are roughly time ordered and unique across workers without a DB round trip.
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker_id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            if now < self._last_ms:
+                # Clock went backwards; keep issuing from the last timestamp
+                now = self._last_ms
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, wait for the next one
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def max_id_at(timestamp):
+    """The largest id any worker can have minted by timestamp (in seconds)."""
+    return ((int(timestamp * 1000) - EPOCH_MS + 1) << (WORKER_BITS + SEQUENCE_BITS)) - 1
+
+
+def get_worker_id():
+    # Must be unique across every process on every host: two workers sharing
+    # an id mint the same message ids and share journal segments
+    worker_id = getattr(settings, 'CHAT_WORKER_ID', None)
+    if worker_id is None:
+        raise ImproperlyConfigured('Set CHAT_WORKER_ID to a value unique to this worker process')
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ImproperlyConfigured(f'CHAT_WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+    return worker_id
+
+
+_generator = None
+
+
+def next_id():
+    global _generator
+    if _generator is None:
+        _generator = SnowflakeGenerator(get_worker_id())
+    return _generator.next_id()
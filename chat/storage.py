@@ -0,0 +1,90 @@
+# chat/storage.py
+import hashlib
+import posixpath
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+
+BLOCK_SIZE = 64 * 1024
+PREFIX = 'chat_files/cas'
+
+
+def content_sha256(content):
+    # Uploads that were already hashed (e.g. chunked uploads) carry the digest
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+    hasher = hashlib.sha256()
+    content.seek(0)
+    for block in content.chunks(BLOCK_SIZE):
+        hasher.update(block)
+    content.seek(0)
+    return hasher.hexdigest()
+
+
+def blob_name(digest):
+    return posixpath.join(PREFIX, digest[:2], digest)
+
+
+def digest_from_name(name):
+    """Return the sha256 for a content-addressed file name, else None."""
+    if name and name.startswith(PREFIX + '/'):
+        return posixpath.basename(name)
+    return None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores each distinct file once, under a name derived from its SHA-256.
+
+    The name passed in by the caller is ignored. Saving bytes that are
+    already stored costs one hash and no write; the caller gets the existing
+    name back. Files are never overwritten or renamed, and deleting is left to
+    the reference counting in chat/signals.py since one file can back many
+    messages.
+
+    Every save takes one reference on the blob's StoredBlob row. The dedup
+    decision and the increment happen under that row's lock in one
+    transaction, so releasing the last reference concurrently cannot delete
+    the file this caller is about to point a message at. Create the message
+    in the same transaction as the save, so a failed insert also gives the
+    reference back.
+    """
+
+    def save(self, name, content, max_length=None):
+        from .models import StoredBlob
+        if content is None:
+            raise ValueError('Storage.save() requires content')
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = content_sha256(content)
+        name = blob_name(digest)
+        with transaction.atomic():
+            StoredBlob.objects.select_for_update().get_or_create(sha256=digest, defaults={'name': name})
+            if not self.exists(name):
+                try:
+                    self._save(name, content)
+                except FileExistsError:
+                    # Another request stored the same bytes in the meantime
+                    pass
+            StoredBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Same name means same content, so never pick another name; _save()
+        # asks for one when the file appeared concurrently, and save() treats
+        # that as a successful dedup
+        if self.exists(name):
+            raise FileExistsError(name)
+        return name
+
+
+_storage = None
+
+
+def chat_file_storage():
+    global _storage
+    if _storage is None:
+        _storage = ContentAddressedStorage()
+    return _storage
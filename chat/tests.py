@@ -1,3 +1,938 @@
-from django.test import TestCase
+import asyncio
+import base64
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from . import framing, seeding, thumbnails
+from .auth import authenticate, credentials_from_scope, get_user_cache, issue_ticket
+from .consumers import ChatConsumer
+from .inbox import list_rooms, mark_read
+from .layers import LocalFirstChannelLayer
+from .media import sign_url
+from .models import ChatRoom, ChunkedUpload, Message, MessageTerm, RoomReadState, StoredBlob
+from .persistence import MessageWriter, insert_entries, read_segment, replay_spill
+from .presence import LocalPresenceStore, get_tracker, visible_presence
+from .receipts import ReceiptCoalescer, receipts_event, write_cursors
+from .routing import websocket_urlpatterns
+from .snowflake import SnowflakeGenerator, get_worker_id
+from .typing_status import TypingCoalescer
+from .uploads import purge_stale_uploads, temp_path, upload_lock
+from users.social_graph import get_graph
 
-# Create your tests here.
+User = get_user_model()
+
+LOCAL_LAYERS = {'default': {'BACKEND': 'chat.layers.LocalFirstChannelLayer'}}
+
+
+class MediaRootMixin:
+    """Local filesystem storage in a throwaway MEDIA_ROOT, no Redis."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root,
+            CHAT_UPLOAD_TEMP_DIR=os.path.join(media_root, 'uploads_tmp'),
+            CHANNEL_LAYERS=LOCAL_LAYERS,
+            THUMBNAIL_ASYNC=False,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+def make_user(name):
+    return User.objects.create_user(email=f'{name}@example.com', username=name, password='pw')
+
+
+def make_room(*members, name='room', is_group=False):
+    room = ChatRoom.objects.create(name=name, is_group=is_group)
+    room.members.add(*members)
+    return room
+
+
+def entry(message_id, room, sender, content='hi'):
+    return {
+        'id': message_id,
+        'room_id': room.id,
+        'sender_id': sender.id,
+        'content': content,
+        'created_at': timezone.now().isoformat(),
+    }
+
+
+class WorkerIdTests(TestCase):
+    @override_settings(CHAT_WORKER_ID=None)
+    def test_missing_worker_id_fails_fast(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_worker_id()
+
+    @override_settings(CHAT_WORKER_ID=2048)
+    def test_out_of_range_worker_id_fails_fast(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_worker_id()
+
+
+class InsertEntriesTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.room = make_room(self.alice)
+
+    def test_live_insert_does_not_hide_id_conflicts(self):
+        insert_entries([entry(1001, self.room, self.alice)], 100)
+        with self.assertRaises(IntegrityError):
+            insert_entries([entry(1001, self.room, self.alice, 'other')], 100)
+
+    def test_replay_skips_committed_rows(self):
+        insert_entries([entry(1001, self.room, self.alice)], 100)
+        insert_entries([entry(1001, self.room, self.alice), entry(1002, self.room, self.alice)], 100, replay=True)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', flat=True)), [1001, 1002])
+
+    def test_replay_spill_reads_and_removes_segments(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            path = os.path.join(spill_dir, '7-000000000001.jsonl')
+            with open(path, 'w') as f:
+                f.write('{"id": 2001, "room_id": %d, "sender_id": %d, "content": "x", "created_at": "%s"}\n' % (
+                    self.room.id, self.alice.id, timezone.now().isoformat(),
+                ))
+                f.write('{"id": 20')  # torn line from a crash
+            self.assertEqual(replay_spill(spill_dir), 1)
+            self.assertFalse(os.path.exists(path))
+        self.assertTrue(Message.objects.filter(id=2001).exists())
+
+
+class SeedingTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = make_room(self.alice, self.bob)
+
+    def test_loader_defers_inbox_writes_to_finish(self):
+        loader = seeding.MessageLoader(worker_id=7)
+        rows = [{'room_id': self.room.id, 'sender_id': self.alice.id, 'content': f'hello {i}'} for i in range(3)]
+        self.assertEqual(seeding.load(rows, loader, chunk_size=2), 3)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 3)
+        self.assertTrue(MessageTerm.objects.exists())
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.last_message_id)
+
+        loader.finish()
+        newest = Message.objects.filter(room=self.room).order_by('-id').first()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, newest.id)
+        state = RoomReadState.objects.get(room=self.room, user=self.alice)
+        self.assertEqual(state.last_read_message_id, newest.id)
+        self.assertEqual({room['id']: room['unread_count'] for room in list_rooms(self.bob)}[self.room.id], 3)
+
+    @override_settings(CHAT_WORKER_ID=None)
+    def test_command_needs_a_worker_id_for_messages(self):
+        with self.assertRaises(CommandError):
+            call_command('seed_data', users=2, rooms=1, messages_per_room=1, stdout=io.StringIO())
+        call_command('seed_data', users=2, rooms=1, messages_per_room=2, room_size=2, worker_id=7,
+                     stdout=io.StringIO())
+        room = ChatRoom.objects.get(name__startswith='Seed room ')
+        self.assertEqual(room.members.count(), 2)
+        self.assertEqual(Message.objects.filter(room=room).count(), 2)
+
+    def test_generated_ids_come_from_the_database(self):
+        seeding.load(seeding.generated_users('t1', 2, None), seeding.insert_users)
+        user_ids = seeding.generated_user_ids('t1')
+        self.assertEqual(len(user_ids), 2)
+        self.assertTrue(all(user_id > self.bob.id for user_id in user_ids))
+        self.assertEqual(
+            sorted(User.objects.filter(id__in=user_ids).values_list('profile__user_id', flat=True)), user_ids,
+        )
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.room = make_room(self.alice)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.url = f'/api/chat/rooms/{self.room.id}/messages/'
+        start = timezone.now() - timedelta(hours=1)
+        # Three messages share a timestamp; their ids decide the order
+        times = [start, start + timedelta(minutes=1), start + timedelta(minutes=1), start + timedelta(minutes=1),
+                 start + timedelta(minutes=2)]
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.alice, content=str(i), created_at=created_at).id
+            for i, created_at in enumerate(times)
+        ]
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages_back_through_ties_without_gaps_or_repeats(self):
+        newest = self.page(limit=2)
+        self.assertEqual(([row['id'] for row in newest['results']], newest['has_more']), (self.ids[3:], True))
+        middle = self.page(limit=2, before=newest['before'])
+        self.assertEqual(([row['id'] for row in middle['results']], middle['has_more']), (self.ids[1:3], True))
+        oldest = self.page(limit=2, before=middle['before'])
+        self.assertEqual(([row['id'] for row in oldest['results']], oldest['has_more']), (self.ids[:1], False))
+
+    def test_pages_forward_from_a_cursor(self):
+        oldest = self.page(limit=1, before=self.page(limit=4)['before'])
+        self.assertEqual([row['id'] for row in oldest['results']], self.ids[:1])
+        newer = self.page(limit=2, after=oldest['after'])
+        self.assertEqual(([row['id'] for row in newer['results']], newer['has_more']), (self.ids[1:3], True))
+        newest = self.page(limit=2, after=newer['after'])
+        self.assertEqual(([row['id'] for row in newest['results']], newest['has_more']), (self.ids[3:], False))
+        self.assertEqual(self.page(after=newest['after'])['results'], [])
+
+    def test_malformed_cursors_are_client_errors(self):
+        def cursor(raw):
+            return base64.urlsafe_b64encode(raw).decode()
+
+        for bad in ('!!!', cursor(b'no separator'), cursor(b'yesterday|1'), cursor(b'2024-01-01T00:00:00|x'),
+                    cursor(b'2024-13-45T00:00:00|1'), cursor(b'2024-01-01T00:00:00|' + str(10 ** 30).encode()),
+                    cursor(b'\xff\xfe|1')):
+            self.assertEqual(self.client.get(self.url, {'before': bad}).status_code, 400, bad)
+            self.assertEqual(self.client.get(self.url, {'after': bad}).status_code, 400, bad)
+        both = self.page()['before']
+        self.assertEqual(self.client.get(self.url, {'before': both, 'after': both}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 'x'}).status_code, 400)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = make_room(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def say(self, content, room=None, sender=None):
+        return Message.objects.create(room=room or self.room, sender=sender or self.bob, content=content).id
+
+    def search(self, query, **params):
+        response = self.client.get('/api/chat/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def ids(self, query, **params):
+        return [row['id'] for row in self.search(query, **params)['results']]
+
+    def test_rooms_the_user_has_left_are_not_searched(self):
+        here = self.say('lunch today')
+        left = make_room(self.alice, self.bob, name='left')
+        self.say('lunch secret', room=left)
+        left.members.remove(self.alice)
+        self.say('lunch elsewhere', room=make_room(self.bob, name='other'))
+        self.assertEqual(self.ids('lunch'), [here])
+
+    def test_every_term_must_match(self):
+        both = self.say('lunch tomorrow')
+        self.say('lunch today')
+        self.say('see you tomorrow')
+        self.assertEqual(self.ids('tomorrow lunch'), [both])
+        self.assertEqual(self.ids('lunch dinner'), [])
+
+    def test_ranked_by_term_frequency_then_newest(self):
+        diluted = self.say('lunch plans for today maybe')
+        focused = self.say('lunch lunch')
+        older_half = self.say('lunch tomorrow')
+        newer_half = self.say('lunch later')
+        self.assertEqual(self.ids('lunch'), [focused, newer_half, older_half, diluted])
+
+    def test_pages(self):
+        ids = [self.say(f'lunch number{i}') for i in range(5)]
+        first = self.search('lunch', limit=2)
+        self.assertEqual(([row['id'] for row in first['results']], first['has_more']), (ids[:2:-1], True))
+        last = self.search('lunch', limit=2, page=3)
+        self.assertEqual(([row['id'] for row in last['results']], last['has_more']), ([ids[0]], False))
+        self.assertEqual(self.client.get('/api/chat/search/', {'q': 'lunch', 'page': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/chat/search/', {'q': 'the'}).status_code, 400)
+
+    def test_new_messages_are_indexed_without_a_delete(self):
+        with CaptureQueriesContext(connection) as queries:
+            message_id = self.say('lunch today')
+        self.assertFalse([query for query in queries if query['sql'].startswith('DELETE')])
+        Message.objects.filter(id=message_id).update(content='dinner today')
+        message = Message.objects.get(id=message_id)
+        message.save(update_fields=['content'])
+        self.assertEqual(self.ids('lunch'), [])
+        self.assertEqual(self.ids('dinner'), [message_id])
+
+
+class MessageWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        self.writer = MessageWriter(self.spill_dir, worker_id=7, flush_interval=60)
+
+    def tearDown(self):
+        self.writer._io.shutdown()
+        if self.writer._lock_file is not None:
+            self.writer._lock_file.close()
+
+    async def test_journal_is_written_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        threads = []
+        append = self.writer._append
+
+        def record(line):
+            threads.append(threading.current_thread())
+            append(line)
+
+        with mock.patch.object(self.writer, '_append', side_effect=record), \
+                mock.patch('chat.persistence.next_id', side_effect=[101, 102]):
+            self.assertEqual(await self.writer.enqueue(3, 5, 'hi'), 101)
+            self.assertEqual(await self.writer.enqueue(3, 5, 'there'), 102)
+        self.writer._task.cancel()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+        [segment] = glob.glob(os.path.join(self.spill_dir, '7-*.jsonl'))
+        self.assertEqual([entry['id'] for entry in read_segment(segment)], [101, 102])
+
+        with mock.patch('chat.persistence.insert_entries') as insert:
+            await self.writer.flush()
+        self.assertEqual([entry['id'] for entry in insert.call_args.args[0]], [101, 102])
+        self.assertFalse(os.path.exists(segment))
+
+
+class TypingCoalescerTests(SimpleTestCase):
+    async def test_disconnect_keeps_typing_while_another_socket_is_open(self):
+        coalescer = TypingCoalescer(tick=60)
+        coalescer.join('chat_1', 5)
+        coalescer.join('chat_1', 5)
+        coalescer.update('chat_1', 5, 'bob', True)
+        coalescer._task.cancel()
+        coalescer.leave('chat_1', 5, 'bob')
+        self.assertIn(5, coalescer._current['chat_1'])
+        coalescer.leave('chat_1', 5, 'bob')
+        self.assertNotIn(5, coalescer._current.get('chat_1', {}))
+
+    async def test_failed_broadcast_is_retried_next_tick(self):
+        coalescer = TypingCoalescer(tick=60)
+        layer = mock.Mock()
+        layer.group_send = mock.AsyncMock(side_effect=[Exception('ChannelFull'), None])
+        with mock.patch('chat.typing_status.get_channel_layer', return_value=layer):
+            coalescer.update('chat_1', 5, 'bob', True)
+            coalescer._task.cancel()
+            await coalescer.flush()
+            await coalescer.flush()
+        self.assertEqual(layer.group_send.await_count, 2)
+        event = json.loads(layer.group_send.await_args.args[1]['text'])
+        self.assertEqual(event['started'], [{'user_id': 5, 'username': 'bob'}])
+
+
+class ReceiptCoalescerTests(SimpleTestCase):
+    async def test_ids_that_cannot_exist_are_ignored(self):
+        coalescer = ReceiptCoalescer(tick=60)
+        coalescer.update(1, 5, read=10 ** 20, delivered=-3)
+        coalescer.update(1, 6, read=0)
+        self.assertEqual(coalescer._pending, {})
+        message_id = SnowflakeGenerator(1).next_id()
+        coalescer.update(1, 5, read=message_id)
+        coalescer._task.cancel()
+        self.assertEqual(coalescer._pending, {(1, 5): (message_id, None)})
+
+    async def test_failing_batch_is_dropped_after_max_retries(self):
+        coalescer = ReceiptCoalescer(tick=60, max_retries=2)
+        with mock.patch('chat.receipts.write_cursors', side_effect=Exception('deadlock')):
+            coalescer.update(1, 5, read=SnowflakeGenerator(1).next_id())
+            coalescer._task.cancel()
+            await coalescer.flush()
+            self.assertIn((1, 5), coalescer._pending)
+            await coalescer.flush()
+        self.assertEqual(coalescer._pending, {})
+
+
+@override_settings(CHANNEL_LAYERS=LOCAL_LAYERS)
+class ChatConsumerTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.mallory = make_user('mallory')
+        self.room = make_room(self.alice, self.bob, is_group=True)
+
+    def communicator(self, user):
+        # channels.testing needs daphne; the raw ASGI messages are enough here
+        return ApplicationCommunicator(URLRouter(websocket_urlpatterns), {
+            'type': 'websocket', 'path': f'/ws/chat/{self.room.id}/', 'query_string': b'',
+            'headers': [], 'subprotocols': [], 'user': user,
+        })
+
+    async def connect(self, communicator):
+        await communicator.send_input({'type': 'websocket.connect'})
+        return (await communicator.receive_output())['type'] == 'websocket.accept'
+
+    async def send_json(self, communicator, data):
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_only_members_can_connect(self):
+        from django.contrib.auth.models import AnonymousUser
+        for user in (self.mallory, AnonymousUser()):
+            self.assertFalse(await self.connect(self.communicator(user)))
+        communicator = self.communicator(self.bob)
+        self.assertTrue(await self.connect(communicator))
+        await self.disconnect(communicator)
+
+    async def test_batch_subprotocol_is_accepted(self):
+        communicator = self.communicator(self.bob)
+        communicator.scope['subprotocols'] = ['graphql-ws', framing.SUBPROTOCOL_BATCH_JSON]
+        await communicator.send_input({'type': 'websocket.connect'})
+        accepted = await communicator.receive_output()
+        self.assertEqual((accepted['type'], accepted['subprotocol']), ('websocket.accept', framing.SUBPROTOCOL_BATCH_JSON))
+        await self.disconnect(communicator)
+
+    async def test_frames_after_removal_are_dropped(self):
+        communicator = self.communicator(self.bob)
+        self.assertTrue(await self.connect(communicator))
+        removed = {'type': 'room_members_changed', 'added': [], 'removed': [self.bob.id]}
+        await get_channel_layer().group_send(f'chat_{self.room.id}', removed)
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+
+        # Already on their way when the socket was removed
+        await self.send_json(communicator, {'type': 'typing', 'is_typing': True})
+        await self.send_json(communicator, {'type': 'message', 'message': 'still here?'})
+        await get_channel_layer().group_send(f'chat_{self.room.id}', removed)
+        self.assertTrue(await communicator.receive_nothing())
+        await self.disconnect(communicator)
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+
+
+class BlockedBatchEntriesTests(SimpleTestCase):
+    def consumer(self, blocked_ids):
+        consumer = ChatConsumer()
+        consumer.blocked_ids = frozenset(blocked_ids)
+        consumer.encoding = None
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    def sent(self, consumer):
+        return json.loads(consumer.send.await_args.kwargs['text_data'])
+
+    async def test_typing_from_blocked_users_is_dropped(self):
+        event = framing.encode_event('typing_batch', {
+            'type': 'typing_batch', 'started': [{'user_id': 5, 'username': 'bob'}, {'user_id': 6, 'username': 'eve'}],
+            'stopped': [6],
+        }, user_ids=[5, 6, 6])
+        consumer = self.consumer({6})
+        await consumer.typing_batch(event)
+        self.assertEqual(self.sent(consumer), {
+            'type': 'typing_batch', 'started': [{'user_id': 5, 'username': 'bob'}], 'stopped': [],
+        })
+        # Shared encoding is untouched for everyone else
+        self.assertIn('eve', event['text'])
+
+    async def test_batch_of_only_blocked_users_is_not_sent(self):
+        consumer = self.consumer({6})
+        await consumer.read_receipts(receipts_event({6: (10, 10)}))
+        consumer.send.assert_not_awaited()
+        await consumer.read_receipts(receipts_event({5: (10, None), 6: (10, 10)}))
+        self.assertEqual(self.sent(consumer), {'type': 'receipts', 'read': [[5, 10]], 'delivered': []})
+
+
+class EncodeEventTests(SimpleTestCase):
+    def test_only_json_goes_through_the_layer(self):
+        event = framing.encode_event('chat_message', {'message': 'hi'}, user_id=3)
+        self.assertEqual(event, {'type': 'chat_message', 'text': '{"message": "hi"}', 'user_id': 3})
+
+    @unittest.skipIf(framing.msgpack is None, 'msgpack is not installed')
+    def test_packed_payload_is_made_once_and_cached(self):
+        event = framing.encode_event('chat_message', {'message': 'hi'})
+        packed = framing.packed_payload(event)
+        self.assertEqual(framing.msgpack.unpackb(packed, raw=False), json.loads(event['text']))
+        self.assertIs(framing.packed_payload(event), packed)
+
+
+class BatchFramingTests(SimpleTestCase):
+    def consumer(self, encoding):
+        consumer = ChatConsumer()
+        consumer.blocked_ids = frozenset()
+        consumer.encoding = encoding
+        consumer.outbox = []
+        consumer.outbox_flush = None
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    def events(self, count):
+        return [framing.encode_event('chat_message', {'type': 'message', 'message_id': i}) for i in range(count)]
+
+    def test_negotiation_prefers_msgpack_and_falls_back(self):
+        both = [framing.SUBPROTOCOL_BATCH_JSON, framing.SUBPROTOCOL_BATCH_MSGPACK]
+        self.assertEqual(framing.negotiate([framing.SUBPROTOCOL_BATCH_JSON]), (framing.SUBPROTOCOL_BATCH_JSON, 'json'))
+        self.assertEqual(framing.negotiate([]), (None, None))
+        self.assertEqual(framing.negotiate(['graphql-ws']), (None, None))
+        with mock.patch('chat.framing.msgpack', None):
+            self.assertEqual(framing.negotiate(both), (framing.SUBPROTOCOL_BATCH_JSON, 'json'))
+            self.assertEqual(framing.negotiate([framing.SUBPROTOCOL_BATCH_MSGPACK]), (None, None))
+        if framing.msgpack is not None:
+            self.assertEqual(framing.negotiate(both), (framing.SUBPROTOCOL_BATCH_MSGPACK, 'msgpack'))
+
+    def test_json_batch_is_an_array_of_the_events(self):
+        frames = [event['text'] for event in self.events(2)]
+        batch = framing.encode_batch(frames, framing.ENCODING_JSON)
+        self.assertEqual(json.loads(batch['text_data']), [json.loads(frame) for frame in frames])
+
+    @unittest.skipIf(framing.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_batch_is_an_array_of_the_events(self):
+        events = self.events(2)
+        batch = framing.encode_batch([framing.packed_payload(event) for event in events], framing.ENCODING_MSGPACK)
+        self.assertEqual(
+            framing.msgpack.unpackb(batch['bytes_data'], raw=False), [json.loads(event['text']) for event in events],
+        )
+
+    async def test_without_negotiation_every_event_is_its_own_frame(self):
+        consumer = self.consumer(None)
+        for event in self.events(2):
+            await consumer.chat_message(event)
+        self.assertEqual(
+            [call.kwargs['text_data'] for call in consumer.send.await_args_list], [event['text'] for event in self.events(2)],
+        )
+
+    @override_settings(CHAT_BATCH_MAX_EVENTS=3, CHAT_BATCH_WINDOW=60)
+    async def test_full_batch_is_sent_without_waiting(self):
+        consumer = self.consumer(framing.ENCODING_JSON)
+        for event in self.events(4):
+            await consumer.chat_message(event)
+        consumer.outbox_flush.cancel()
+        [call] = consumer.send.await_args_list
+        self.assertEqual([event['message_id'] for event in json.loads(call.kwargs['text_data'])], [0, 1, 2])
+        self.assertEqual(len(consumer.outbox), 1)
+
+    @override_settings(CHAT_BATCH_MAX_EVENTS=100, CHAT_BATCH_WINDOW=0.01)
+    async def test_batch_is_sent_at_the_end_of_the_window(self):
+        consumer = self.consumer(framing.ENCODING_JSON)
+        for event in self.events(2):
+            await consumer.chat_message(event)
+        consumer.send.assert_not_awaited()
+        await consumer.outbox_flush
+        [call] = consumer.send.await_args_list
+        self.assertEqual([event['message_id'] for event in json.loads(call.kwargs['text_data'])], [0, 1])
+        self.assertIsNone(consumer.outbox_flush)
+
+    @unittest.skipIf(framing.msgpack is None, 'msgpack is not installed')
+    @override_settings(CHAT_BATCH_MAX_EVENTS=2)
+    async def test_msgpack_sockets_get_binary_frames(self):
+        consumer = self.consumer(framing.ENCODING_MSGPACK)
+        for event in self.events(2):
+            await consumer.chat_message(event)
+        consumer.outbox_flush.cancel()
+        frame = consumer.send.await_args.kwargs['bytes_data']
+        self.assertEqual([event['message_id'] for event in framing.msgpack.unpackb(frame, raw=False)], [0, 1])
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    data = b'0123456789abcdefghij'
+
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.room = make_room(self.alice)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.base = f'/api/chat/rooms/{self.room.id}/uploads/'
+
+    def start(self, **extra):
+        payload = {'file_name': 'notes.txt', 'size': len(self.data), 'sha256': sha256(self.data), **extra}
+        return self.client.post(self.base, payload, format='json')
+
+    def put(self, upload_id, start, end, chunk_sha=None):
+        chunk = self.data[start:end]
+        return self.client.put(
+            f'{self.base}{upload_id}/', data=chunk, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(self.data)}',
+            HTTP_X_CHUNK_SHA256=chunk_sha if chunk_sha is not None else sha256(chunk),
+        )
+
+    def test_upload_in_chunks_and_complete(self):
+        upload_id = self.start().data['upload_id']
+        self.assertEqual(self.put(upload_id, 0, 8).data['received'], 8)
+        # Resending a chunk that was already stored is a conflict, not a rewrite
+        self.assertEqual(self.put(upload_id, 0, 8).status_code, 409)
+        self.assertEqual(self.put(upload_id, 8, 20).data['received'], 20)
+
+        response = self.client.post(f'{self.base}{upload_id}/complete/')
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get(id=response.data['message_id'])
+        with message.file.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_checksums_are_required(self):
+        self.assertEqual(self.start(sha256='').status_code, 400)
+        upload_id = self.start().data['upload_id']
+        self.assertEqual(self.put(upload_id, 0, 8, chunk_sha='').status_code, 400)
+        self.assertEqual(self.put(upload_id, 0, 8, chunk_sha=sha256(b'other')).status_code, 400)
+        self.assertEqual(ChunkedUpload.objects.get(id=upload_id).received, 0)
+
+    def test_locked_upload_is_a_conflict(self):
+        upload_id = self.start().data['upload_id']
+        upload = ChunkedUpload.objects.get(id=upload_id)
+        with upload_lock(upload):
+            self.assertEqual(self.put(upload_id, 0, 8).status_code, 409)
+        self.assertEqual(ChunkedUpload.objects.get(id=upload_id).received, 0)
+        self.assertEqual(self.put(upload_id, 0, 8).status_code, 200)
+
+    def test_chunk_after_complete_is_not_found(self):
+        upload_id = self.start().data['upload_id']
+        self.put(upload_id, 0, 8)
+
+        def complete_meanwhile(upload, *args):
+            # The complete request won the race: row and temp file are gone
+            os.remove(temp_path(upload))
+            ChunkedUpload.objects.filter(id=upload.id).delete()
+            with upload_lock(upload):
+                pass
+
+        with mock.patch('chat.views.write_chunk', side_effect=complete_meanwhile):
+            response = self.put(upload_id, 8, 20)
+        self.assertEqual(response.status_code, 404)
+
+    def test_complete_rechecks_membership(self):
+        upload_id = self.start().data['upload_id']
+        self.put(upload_id, 0, 20)
+        self.room.members.remove(self.alice)
+        self.assertEqual(self.client.post(f'{self.base}{upload_id}/complete/').status_code, 404)
+        self.assertFalse(Message.objects.exists())
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_file_messages_get_snowflake_ids_with_write_behind(self):
+        upload_id = self.start().data['upload_id']
+        self.put(upload_id, 0, 20)
+        with mock.patch('chat.persistence.next_id', side_effect=[2 ** 50, 2 ** 50 + 1]):
+            completed = self.client.post(f'{self.base}{upload_id}/complete/')
+            posted = self.client.post(
+                f'/api/chat/rooms/{self.room.id}/upload/', {'file': ContentFile(b'x', name='x.txt')}, format='multipart',
+            )
+        self.assertEqual((completed.status_code, posted.status_code), (201, 201))
+        self.assertEqual([completed.data['message_id'], posted.data['message_id']], [2 ** 50, 2 ** 50 + 1])
+
+    def test_purge_removes_abandoned_uploads(self):
+        upload_id = self.start().data['upload_id']
+        upload = ChunkedUpload.objects.get(id=upload_id)
+        self.assertEqual(purge_stale_uploads(max_age=3600), 0)
+        self.assertEqual(purge_stale_uploads(max_age=3600, now=timezone.now() + timedelta(hours=2)), 1)
+        self.assertFalse(os.path.exists(temp_path(upload)))
+
+
+class ContentAddressedStorageTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.room = make_room(self.alice)
+
+    def attach(self, data=b'same bytes'):
+        return Message.objects.create(room=self.room, sender=self.alice, file=ContentFile(data, name='a.txt'), file_name='a.txt')
+
+    def test_identical_files_share_one_blob(self):
+        first, second = self.attach(), self.attach()
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(StoredBlob.objects.get().ref_count, 2)
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        first, second = self.attach(), self.attach()
+        storage, name = first.file.storage, first.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_upload_during_release_keeps_the_file(self):
+        message = self.attach()
+        storage, name = message.file.storage, message.file.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            message.delete()
+        # Same bytes stored again before the deleter's on_commit ran
+        again = self.attach()
+        for callback in callbacks:
+            callback()
+        self.assertEqual(again.file.name, name)
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(StoredBlob.objects.get().ref_count, 1)
+
+
+def png_bytes(size=(400, 300)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ThumbnailTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.room = make_room(self.alice)
+
+    def attach(self, data, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(room=self.room, sender=self.alice, file=ContentFile(data, name=name), file_name=name)
+
+    def test_images_are_sniffed_not_trusted_by_name(self):
+        self.assertTrue(thumbnails.is_image(self.attach(png_bytes(), 'photo.bin').file))
+        self.assertFalse(thumbnails.is_image(self.attach(b'PK\x03\x04 not an image', 'photo.png').file))
+
+    def test_previews_are_generated_and_removed_with_the_blob(self):
+        message = self.attach(png_bytes(), 'photo.png')
+        storage, name = message.file.storage, message.file.name
+        self.assertEqual(set(thumbnails.variant_urls(storage, name, only_existing=True)), set(thumbnails.variant_sizes()))
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+        self.assertEqual(thumbnails.variant_urls(storage, name, only_existing=True), {})
+
+    def test_worker_pool_is_spawned(self):
+        executor = thumbnails.get_executor()
+        self.assertEqual(executor._mp_context.get_start_method(), 'spawn')
+
+
+class MediaViewTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('alice')
+        self.mallory = make_user('mallory')
+        self.room = make_room(self.alice)
+        self.message = Message.objects.create(
+            room=self.room, sender=self.alice, file=ContentFile(b'secret', name='a.txt'), file_name='a.txt',
+        )
+        self.path = '/media/' + self.message.file.name
+
+    def test_signed_url_needs_no_authorization_header(self):
+        response = self.client.get(sign_url(self.path, self.message.file.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'secret')
+
+    def test_unsigned_or_tampered_urls_are_refused(self):
+        self.assertEqual(self.client.get(self.path).status_code, 404)
+        signed = sign_url(self.path, self.message.file.name)
+        self.assertEqual(self.client.get(signed[:-1] + ('0' if signed[-1] != '0' else '1')).status_code, 404)
+        with override_settings(MEDIA_URL_TTL=1), mock.patch('chat.media.time.time', return_value=0):
+            expired = sign_url(self.path, self.message.file.name)
+        self.assertEqual(self.client.get(expired).status_code, 404)
+
+    def test_members_can_fetch_with_a_token(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        self.assertEqual(client.get(self.path).status_code, 200)
+        client.force_authenticate(self.mallory)
+        self.assertEqual(client.get(self.path).status_code, 404)
+
+
+@override_settings(CHANNEL_LAYERS=LOCAL_LAYERS)
+class InboxTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = make_room(self.alice, self.bob)
+        insert_entries([entry(i, self.room, self.alice) for i in (101, 102, 103)], 100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+        self.read_url = f'/api/chat/rooms/{self.room.id}/read/'
+
+    def unread(self, user):
+        return {room['id']: room['unread_count'] for room in list_rooms(user)}[self.room.id]
+
+    def test_unread_is_derived_from_the_read_cursor(self):
+        self.assertEqual(self.unread(self.bob), 3)
+        self.assertEqual(self.unread(self.alice), 0)
+        # Only the sender's row is written per message
+        state = RoomReadState.objects.get(room=self.room, user=self.bob)
+        self.assertIsNone(state.last_read_message_id)
+
+    def test_unread_counts_stop_at_the_limit(self):
+        other = make_room(self.alice, self.bob, name='other')
+        insert_entries([entry(201, other, self.alice)], 100)
+        with mock.patch('chat.inbox.UNREAD_LIMIT', 2), self.assertNumQueries(3):
+            rooms = {room['id']: room['unread_count'] for room in list_rooms(self.bob)}
+        self.assertEqual(rooms, {self.room.id: 2, other.id: 1})
+
+    def test_new_members_start_caught_up(self):
+        carol = make_user('carol')
+        self.room.members.add(carol)
+        self.assertEqual(self.unread(carol), 0)
+
+    def test_mark_read_only_moves_forward(self):
+        self.assertEqual(mark_read(self.room.id, self.bob.id, 103, 103), (103, 0))
+        self.assertEqual(mark_read(self.room.id, self.bob.id, 101, 103), (103, 0))
+        self.assertEqual(self.unread(self.bob), 0)
+
+    def test_acks_are_clamped_to_the_last_message_without_write_behind(self):
+        # Far past every auto-increment id, yet a valid snowflake
+        ack = SnowflakeGenerator(1).next_id()
+        self.assertEqual(write_cursors({(self.room.id, self.bob.id): (ack, ack)}), {(self.room.id, self.bob.id): (103, 103)})
+        insert_entries([entry(104, self.room, self.alice)], 100)
+        self.assertEqual(self.unread(self.bob), 1)
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_acks_may_run_ahead_of_write_behind_inserts(self):
+        ack = SnowflakeGenerator(1).next_id()
+        self.assertEqual(write_cursors({(self.room.id, self.bob.id): (ack, None)}), {(self.room.id, self.bob.id): (ack, ack)})
+
+    def test_read_view_reports_what_is_left(self):
+        response = self.client.post(self.read_url, {'message_id': 102}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread_count'], 1)
+        # Past the newest message is clamped to it
+        response = self.client.post(self.read_url, {'message_id': 10 ** 20}, format='json')
+        self.assertEqual(response.data['last_read_message_id'], 103)
+
+    def test_read_view_rejects_bad_message_ids(self):
+        for message_id in ('abc', -1, [1]):
+            response = self.client.post(self.read_url, {'message_id': message_id}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_create_room_validates_members_and_is_group(self):
+        url = '/api/chat/rooms/'
+        response = self.client.post(url, {'name': 'x', 'members': 5}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {'name': 'x', 'members': [self.alice.id], 'is_group': 'false'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(ChatRoom.objects.get(id=response.data['id']).is_group)
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        from friendship.models import Friend
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.mallory = make_user('mallory')
+        get_graph().clear()
+        self.addCleanup(get_graph().clear)
+        Friend.objects.create(from_user=self.alice, to_user=self.bob)
+        Friend.objects.create(from_user=self.bob, to_user=self.alice)
+        self.store = LocalPresenceStore()
+        async_to_sync(self.store.heartbeat)('w1', [self.bob.id, self.mallory.id], 30)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_only_friends_presence_is_reported(self):
+        ids = f'{self.bob.id},{self.mallory.id},{self.alice.id}'
+        with mock.patch('chat.views.get_store', return_value=self.store):
+            response = self.client.get(f'/api/chat/presence/?ids={ids}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {str(self.alice.id): False, str(self.bob.id): True})
+
+    def test_visibility_is_served_from_the_social_graph_cache(self):
+        user_ids = [self.bob.id, self.mallory.id]
+        self.assertEqual(visible_presence(self.alice.id, user_ids), {self.bob.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(visible_presence(self.alice.id, user_ids), {self.bob.id})
+
+    @override_settings(CHAT_WORKER_ID=None)
+    def test_leases_are_owned_by_a_per_process_id(self):
+        with mock.patch('chat.presence._tracker', None), mock.patch('chat.presence._store', self.store):
+            first = get_tracker()
+        with mock.patch('chat.presence._tracker', None), mock.patch('chat.presence._store', self.store):
+            second = get_tracker()
+        self.assertNotEqual(first.worker_id, second.worker_id)
+
+
+class LocalFirstChannelLayerTests(SimpleTestCase):
+    """Two processes' layers sharing an InMemoryChannelLayer as a fake Redis."""
+
+    def make_layers(self, **config):
+        from channels.layers import InMemoryChannelLayer
+        redis = InMemoryChannelLayer()
+        return redis, LocalFirstChannelLayer(remote=redis, **config), LocalFirstChannelLayer(remote=redis, **config)
+
+    async def test_group_send_reaches_other_processes(self):
+        redis, first, second = self.make_layers()
+        try:
+            here, there = await first.new_channel(), await second.new_channel()
+            await first.group_add('chat_1', here)
+            await second.group_add('chat_1', there)
+            await first.group_send('chat_1', {'type': 'chat.message', 'text': 'hi'})
+            self.assertEqual((await first.receive(here))['text'], 'hi')
+            self.assertEqual((await asyncio.wait_for(second.receive(there), 1))['text'], 'hi')
+        finally:
+            await first.close()
+            await second.close()
+
+    async def test_relay_channel_has_its_own_capacity(self):
+        redis, first, second = self.make_layers(relay_capacity=5000)
+        self.assertEqual(redis.get_capacity(first.relay_channel), 5000)
+        self.assertEqual(redis.get_capacity('specific.other'), redis.capacity)
+
+    async def test_remote_membership_is_refreshed_while_members_remain(self):
+        redis, first, second = self.make_layers(group_expiry=0.1)
+        try:
+            channel = await first.new_channel()
+            await first.group_add('chat_1', channel)
+            with mock.patch.object(redis, 'group_add', wraps=redis.group_add) as group_add:
+                await asyncio.sleep(0.2)
+            group_add.assert_awaited_with('chat_1', first.relay_channel)
+        finally:
+            await first.close()
+
+    async def test_idle_queues_expire_and_unknown_channels_are_not_created(self):
+        layer = LocalFirstChannelLayer(expiry=0)
+        await layer.send(f'specific.{layer.process_id}!gone', {'type': 'x'})
+        self.assertEqual(layer.channels, {})
+        channel = await layer.new_channel()
+        await layer.group_add('chat_1', channel)
+        layer._last_seen[channel] -= 1
+        layer._last_clean = 0
+        await layer.group_send('chat_1', {'type': 'x'})
+        self.assertNotIn(channel, layer.channels)
+        self.assertNotIn('chat_1', layer.groups)
+
+
+class WebSocketAuthTests(TestCase):
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        from django.core.cache import caches
+        caches['shared'].clear()
+        self.alice = make_user('alice')
+        self.addCleanup(get_user_cache().pop, self.alice.id)
+        self.access = RefreshToken.for_user(self.alice).access_token
+
+    def test_revoked_access_token_is_refused(self):
+        from users.token_blacklist import get_blacklist
+        self.assertEqual(authenticate(str(self.access)), self.alice)
+        get_blacklist().revoke_access(self.access['jti'], self.access['exp'])
+        self.assertFalse(authenticate(str(self.access)).is_authenticated)
+
+    def test_deactivation_elsewhere_is_seen_at_once(self):
+        self.assertTrue(authenticate(str(self.access)).is_active)
+        stale = get_user_cache().get(self.alice.id)
+        self.alice.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.save()
+        # Another process still holds the old row under the old stamp
+        get_user_cache().set(self.alice.id, stale)
+        self.assertFalse(authenticate(str(self.access)).is_authenticated)
+
+    def test_tickets_are_single_use_and_tokens_stay_out_of_urls(self):
+        ticket = issue_ticket(self.alice.id)
+        scope = {'headers': [], 'query_string': f'ticket={ticket}&token={self.access}'.encode()}
+        self.assertEqual(credentials_from_scope(scope), (None, ticket))
+        self.assertEqual(authenticate(*credentials_from_scope(scope)), self.alice)
+        self.assertFalse(authenticate(*credentials_from_scope(scope)).is_authenticated)
@@ -0,0 +1,142 @@
+# chat/thumbnails.py
+import logging
+import multiprocessing
+import os
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = {'thumb': 128, 'small': 320, 'medium': 720}
+
+
+def variant_sizes():
+    return getattr(settings, 'THUMBNAIL_SIZES', DEFAULT_SIZES)
+
+
+# Leading bytes of the formats Pillow is asked to decode
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff',          # JPEG
+    b'\x89PNG\r\n\x1a\n',     # PNG
+    b'GIF87a', b'GIF89a',
+    b'BM',                    # BMP
+    b'II*\x00', b'MM\x00*',   # TIFF
+)
+
+
+def is_image(field_file):
+    """
+    Sniff the stored bytes rather than trusting the client's file name, so a
+    renamed archive is never handed to the decoder and a real image with an
+    odd name still gets previews.
+    """
+    if not field_file:
+        return False
+    try:
+        with field_file.storage.open(field_file.name, 'rb') as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+def variant_name(source_name, label):
+    # Derived from the source name alone, so URLs can be handed out before
+    # the variants exist and no extra column is needed to find them
+    return posixpath.join('previews', source_name, f'{label}.webp')
+
+
+def delete_variants(storage, source_name):
+    for label in variant_sizes():
+        storage.delete(variant_name(source_name, label))
+
+
+def variants_ready(storage, source_name):
+    # Variants are written in variant_sizes() order, each renamed into place
+    # when complete, so the last one existing means all of them do: one stat
+    # instead of one per size
+    labels = list(variant_sizes())
+    return bool(labels) and storage.exists(variant_name(source_name, labels[-1]))
+
+
+def variant_urls(storage, source_name, only_existing=False):
+    if only_existing and not variants_ready(storage, source_name):
+        return {}
+    return {label: storage.url(variant_name(source_name, label)) for label in variant_sizes()}
+
+
+def render_variants(source_path, targets):
+    """
+    Runs in a worker process: write a WebP thumbnail for every (max_side,
+    target_path) pair. Only touches the filesystem, never the database.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for max_side, target_path in targets:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            variant = image.copy()
+            variant.thumbnail((max_side, max_side))
+            # Write under a temporary name so readers never see a partial file
+            temp_path = target_path + '.tmp'
+            variant.save(temp_path, 'WEBP', quality=80, method=4)
+            os.replace(temp_path, target_path)
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: a forked child would inherit the ASGI server's
+        # event loop, database connections and threads
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.warning('Thumbnail generation failed', exc_info=future.exception())
+
+
+def _submit(source_path, targets):
+    global _executor
+    if not getattr(settings, 'THUMBNAIL_ASYNC', True):
+        render_variants(source_path, targets)
+        return
+    try:
+        get_executor().submit(render_variants, source_path, targets).add_done_callback(_log_failure)
+    except BrokenProcessPool:
+        # A worker died (e.g. on a malformed image); start a fresh pool
+        _executor = None
+        get_executor().submit(render_variants, source_path, targets).add_done_callback(_log_failure)
+
+
+def schedule_variants(field_file):
+    """
+    Queue preview generation for an image FieldFile once the current
+    transaction commits. Returns immediately; variants that already exist
+    (e.g. for a deduplicated attachment) are not generated again.
+    """
+    storage = field_file.storage
+    source_name = field_file.name
+    targets = [
+        (size, storage.path(variant_name(source_name, label)))
+        for label, size in variant_sizes().items()
+        if not storage.exists(variant_name(source_name, label))
+    ]
+    if targets:
+        source_path = storage.path(source_name)
+        transaction.on_commit(lambda: _submit(source_path, targets))
@@ -0,0 +1,127 @@
+# chat/typing_status.py
+import asyncio
+import logging
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .framing import encode_event
+
+logger = logging.getLogger(__name__)
+
+
+class TypingCoalescer:
+    """
+    Collapses typing frames into one group_send per room per tick.
+
+    Consumers only record state here. Every tick, each room whose state
+    changed gets a single typing_batch event with the users who started and
+    stopped typing since the last tick. A start and a stop inside the same
+    tick cancel out, repeated starts only refresh the expiry, and a user who
+    stops sending frames is dropped after ttl seconds. A user with several
+    sockets in a room only stops typing on disconnect once the last of them
+    has closed.
+    """
+
+    def __init__(self, tick=0.5, ttl=6.0):
+        self.tick = tick
+        self.ttl = ttl
+        # room group -> {user_id: (username, expires_at)} as last reported by sockets
+        self._current = {}
+        # room group -> {user_id: username} as last broadcast to the room
+        self._published = {}
+        self._dirty = set()
+        # (room group, user_id) -> open sockets in this process
+        self._sockets = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def join(self, room_group_name, user_id):
+        key = (room_group_name, user_id)
+        self._sockets[key] = self._sockets.get(key, 0) + 1
+
+    def leave(self, room_group_name, user_id, username):
+        key = (room_group_name, user_id)
+        remaining = self._sockets.get(key, 1) - 1
+        if remaining > 0:
+            self._sockets[key] = remaining
+            return
+        self._sockets.pop(key, None)
+        self.update(room_group_name, user_id, username, False)
+
+    def update(self, room_group_name, user_id, username, is_typing):
+        self.start()
+        current = self._current.setdefault(room_group_name, {})
+        if is_typing:
+            current[user_id] = (username, time.monotonic() + self.ttl)
+        elif current.pop(user_id, None) is None:
+            return
+        self._dirty.add(room_group_name)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                # Never let one bad tick end typing delivery for the process
+                logger.exception('Typing flush failed')
+
+    def _diff(self, room_group_name, now):
+        current = self._current.get(room_group_name, {})
+        for user_id in [uid for uid, (_, expires_at) in current.items() if expires_at <= now]:
+            del current[user_id]
+        published = self._published.get(room_group_name, {})
+        started = [
+            {'user_id': user_id, 'username': username}
+            for user_id, (username, _) in current.items() if user_id not in published
+        ]
+        stopped = [user_id for user_id in published if user_id not in current]
+        if current:
+            self._published[room_group_name] = {uid: name for uid, (name, _) in current.items()}
+        else:
+            self._current.pop(room_group_name, None)
+            self._published.pop(room_group_name, None)
+        return started, stopped
+
+    async def flush(self):
+        now = time.monotonic()
+        # Rooms with anyone typing are revisited every tick to expire idle typists
+        rooms = self._dirty | set(self._current)
+        self._dirty = set()
+        channel_layer = get_channel_layer()
+        for room_group_name in rooms:
+            published = self._published.get(room_group_name)
+            started, stopped = self._diff(room_group_name, now)
+            if not (started or stopped):
+                continue
+            try:
+                await channel_layer.group_send(room_group_name, encode_event('typing_batch', {
+                    'type': 'typing_batch',
+                    'started': started,
+                    'stopped': stopped,
+                }, user_ids=[entry['user_id'] for entry in started] + stopped))
+            except Exception:
+                # E.g. ChannelFull: forget this broadcast so the room is
+                # diffed against what it last received and retried next tick
+                logger.warning('Typing broadcast to %s failed', room_group_name, exc_info=True)
+                if published is None:
+                    self._published.pop(room_group_name, None)
+                else:
+                    self._published[room_group_name] = published
+                self._dirty.add(room_group_name)
+
+
+_coalescer = None
+
+
+def get_coalescer():
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = TypingCoalescer(
+            tick=getattr(settings, 'CHAT_TYPING_TICK', 0.5),
+            ttl=getattr(settings, 'CHAT_TYPING_TTL', 6.0),
+        )
+    return _coalescer
@@ -0,0 +1,201 @@
+# chat/uploads.py
+import fcntl
+import hashlib
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+
+# Request bodies and files are processed in blocks of this size, so memory use
+# per upload is constant no matter how large the chunk or file is
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadConflict(UploadError):
+    """Another request is writing or completing the same upload."""
+
+
+def max_chunk_size():
+    return getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+
+
+def max_upload_size():
+    return getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024)
+
+
+def max_upload_age():
+    return getattr(settings, 'CHAT_UPLOAD_MAX_AGE', 24 * 60 * 60)
+
+
+def parse_sha256(value, what):
+    value = (value or '').strip().lower()
+    if not SHA256_RE.match(value):
+        raise UploadError(f'{what} must be a hex SHA-256 digest')
+    return value
+
+
+def temp_dir():
+    return getattr(settings, 'CHAT_UPLOAD_TEMP_DIR', os.path.join(settings.MEDIA_ROOT, 'uploads_tmp'))
+
+
+def temp_path(upload):
+    return os.path.join(temp_dir(), f'{upload.id}.part')
+
+
+def parse_content_range(header, size):
+    """Parse 'bytes start-end/total' into (start, end) with end exclusive."""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        raise UploadError('Content-Range header must look like "bytes start-end/total"')
+    start, last, total = (int(group) for group in match.groups())
+    if total != size or start > last or last >= size:
+        raise UploadError('Content-Range does not fit the upload')
+    if last - start + 1 > max_chunk_size():
+        raise UploadError(f'Chunks may be at most {max_chunk_size()} bytes')
+    return start, last + 1
+
+
+def create_temp_file(upload):
+    os.makedirs(temp_dir(), exist_ok=True)
+    open(temp_path(upload), 'wb').close()
+
+
+@contextmanager
+def upload_lock(upload):
+    """
+    Hold an exclusive lock on the upload's temp file, or raise UploadConflict
+    at once if another request has it. Writing a chunk and completing the
+    upload both run under it, so no two requests touch the file together.
+    """
+    try:
+        f = open(temp_path(upload), 'r+b')
+    except FileNotFoundError:
+        raise UploadConflict('Upload is being completed or was discarded')
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict('Another request is writing this upload')
+        yield f
+
+
+def write_chunk(upload, stream, start, end, expected_sha256):
+    """
+    Stream end - start bytes from stream into the upload's temp file at
+    offset start and advance upload.received to end.
+
+    The offset is claimed before any byte is written: under upload_lock the
+    resume offset is re-read from the database and must still equal start.
+    Raises UploadConflict if it moved or the file is locked, UploadError if
+    the body is short or does not match expected_sha256; in both cases
+    received is left alone, so bytes past it are simply overwritten by the
+    retry.
+    """
+    from .models import ChunkedUpload
+    expected_sha256 = parse_sha256(expected_sha256, 'X-Chunk-SHA256')
+    with upload_lock(upload) as f:
+        received = ChunkedUpload.objects.filter(id=upload.id).values_list('received', flat=True).first()
+        if received != start:
+            raise UploadConflict('Chunk does not start at the resume offset')
+        digest = hashlib.sha256()
+        remaining = end - start
+        f.seek(start)
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            f.write(block)
+            digest.update(block)
+            remaining -= len(block)
+        if remaining:
+            raise UploadError('Request body is shorter than Content-Range')
+        if digest.hexdigest() != expected_sha256:
+            raise UploadError('Chunk checksum mismatch')
+        f.flush()
+        ChunkedUpload.objects.filter(id=upload.id, received=start).update(received=end, updated_at=timezone.now())
+        upload.received = end
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TemporaryFile(File):
+    # FileSystemStorage moves files that expose temporary_file_path() instead
+    # of copying them, so finalizing does not rewrite the data
+    def __init__(self, file, name=None, sha256=None):
+        super().__init__(file, name)
+        self.sha256 = sha256
+    
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def store_upload(upload, sha256=None):
+    """
+    Move a completed upload into the chat file storage and return its name.
+    Passing the already computed sha256 saves the storage from hashing again.
+    """
+    from .models import Message
+    storage = Message._meta.get_field('file').storage
+    path = temp_path(upload)
+    with open(path, 'rb') as f:
+        name = storage.save(
+            os.path.join('chat_files', os.path.basename(upload.file_name)),
+            TemporaryFile(f, name=upload.file_name, sha256=sha256),
+        )
+    if os.path.exists(path):
+        os.remove(path)
+    return name
+
+
+def discard_upload(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def purge_stale_uploads(max_age=None, now=None):
+    """
+    Delete uploads that saw no chunk for max_age seconds, their temp files,
+    and temp files that no longer have an upload. Returns the number of
+    uploads deleted.
+    """
+    from .models import ChunkedUpload
+    max_age = max_upload_age() if max_age is None else max_age
+    now = now or timezone.now()
+    stale = ChunkedUpload.objects.filter(updated_at__lt=now - timedelta(seconds=max_age))
+    count = 0
+    for upload in stale.iterator():
+        discard_upload(upload)
+        upload.delete()
+        count += 1
+
+    # Leftovers of uploads deleted while their file was still being written
+    directory = temp_dir()
+    if os.path.isdir(directory):
+        live = {f'{upload_id}.part' for upload_id in ChunkedUpload.objects.values_list('id', flat=True)}
+        cutoff = time.time() - max_age
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.part') and entry.name not in live and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    return count
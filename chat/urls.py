@@ -1,12 +1,20 @@
 from django.urls import path
 from .views import (
     ChatRoomListCreateView, ChatRoomDetailView,
-    MessageListView, FileUploadView
+    MessageListView, FileUploadView, RoomReadView, PresenceView, MessageSearchView, WebSocketTicketView,
+    ChunkedUploadInitView, ChunkedUploadView, ChunkedUploadCompleteView,
 )
 
 urlpatterns = [
     path('rooms/', ChatRoomListCreateView.as_view(), name='chat-rooms'),
     path('rooms/<int:room_id>/', ChatRoomDetailView.as_view(), name='chat-room-detail'),
+    path('search/', MessageSearchView.as_view(), name='chat-search'),
+    path('presence/', PresenceView.as_view(), name='chat-presence'),
+    path('ws-ticket/', WebSocketTicketView.as_view(), name='chat-ws-ticket'),
+    path('rooms/<int:room_id>/read/', RoomReadView.as_view(), name='chat-room-read'),
     path('rooms/<int:room_id>/messages/', MessageListView.as_view(), name='chat-messages'),
     path('rooms/<int:room_id>/upload/', FileUploadView.as_view(), name='file-upload'),
+    path('rooms/<int:room_id>/uploads/', ChunkedUploadInitView.as_view(), name='chunked-upload-init'),
+    path('rooms/<int:room_id>/uploads/<uuid:upload_id>/', ChunkedUploadView.as_view(), name='chunked-upload'),
+    path('rooms/<int:room_id>/uploads/<uuid:upload_id>/complete/', ChunkedUploadCompleteView.as_view(), name='chunked-upload-complete'),
 ]
@@ -2,11 +2,257 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
-from .models import ChatRoom, Message
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.http import Http404
+from .auth import issue_ticket
+from .framing import encode_event
+from .inbox import ROOM_FIELDS, list_rooms, mark_read
+from .media import MediaNotFound, normalize_name, serve_file, sign_url, signature_valid, source_name
+from .models import ChatRoom, ChunkedUpload, Message, RoomReadState
+from .presence import get_store, visible_presence
+from .receipts import receipts_event
+from .search import InvalidQuery, parse_search_page, search_messages
+from .pagination import InvalidCursor, paginate_messages, parse_page_size
+from .persistence import direct_message_id
+from .thumbnails import is_image, variant_urls
+from .uploads import (
+    UploadConflict, UploadError, create_temp_file, discard_upload, file_sha256, max_chunk_size,
+    max_upload_size, parse_content_range, parse_sha256, store_upload, temp_path, upload_lock, write_chunk,
+)
 import os
 
+def parse_bool(value, default=False):
+    # JSON bodies carry real booleans; form posts carry strings like "false"
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('true', '1', 'yes', 'on'):
+        return True
+    if value in ('false', '0', 'no', 'off'):
+        return False
+    raise ValueError(value)
+
+class ChatRoomListCreateView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        # Inbox: last message from denormalized columns, unread from the cursors
+        return Response(list_rooms(request.user))
+    
+    def post(self, request):
+        name = request.data.get('name')
+        if not name:
+            return Response({'error': 'name is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        members = request.data.get('members') or []
+        try:
+            if not isinstance(members, list):
+                raise TypeError
+            member_ids = {int(member_id) for member_id in members}
+        except (TypeError, ValueError):
+            return Response({'error': 'members must be a list of user ids'}, status=status.HTTP_400_BAD_REQUEST)
+        member_ids.add(request.user.id)
+        
+        try:
+            is_group = parse_bool(request.data.get('is_group'), default=len(member_ids) > 2)
+        except ValueError:
+            return Response({'error': 'is_group must be true or false'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        found = set(get_user_model().objects.filter(id__in=member_ids).values_list('id', flat=True))
+        if found != member_ids:
+            return Response({'error': 'Unknown user ids', 'missing': sorted(member_ids - found)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        room = ChatRoom.objects.create(name=name, is_group=is_group)
+        room.members.add(*member_ids)
+        
+        data = {field: getattr(room, field) for field in ROOM_FIELDS}
+        data.update(unread_count=0, last_read_message_id=None, members=sorted(member_ids))
+        return Response(data, status=status.HTTP_201_CREATED)
+
+class ChatRoomDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, room_id):
+        room = ChatRoom.objects.filter(id=room_id, members=request.user).values(*ROOM_FIELDS).first()
+        if room is None:
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        room['members'] = list(ChatRoom.members.through.objects.filter(chatroom_id=room_id).values_list('user_id', flat=True))
+        # Every member's cursors, so clients can render receipts for any message
+        room['receipts'] = list(RoomReadState.objects.filter(room_id=room_id).values(
+            'user_id', 'last_read_message_id', 'last_delivered_message_id'
+        ))
+        return Response(room)
+    
+    def put(self, request, room_id):
+        try:
+            room = ChatRoom.objects.get(id=room_id, members=request.user)
+        except ChatRoom.DoesNotExist:
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        
+        name = request.data.get('name')
+        if name:
+            room.name = name
+            room.save(update_fields=['name'])
+        return Response({field: getattr(room, field) for field in ROOM_FIELDS})
+
+class RoomReadView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, room_id):
+        room = ChatRoom.objects.filter(id=room_id, members=request.user).values('last_message_id').first()
+        if room is None:
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        
+        last_message_id = room['last_message_id']
+        message_id = request.data.get('message_id')
+        try:
+            message_id = last_message_id if message_id in (None, '') else int(message_id)
+        except (TypeError, ValueError):
+            return Response({'error': 'message_id must be a message id'}, status=status.HTTP_400_BAD_REQUEST)
+        if message_id is None:
+            return Response({'room_id': room_id, 'last_read_message_id': None, 'unread_count': 0})
+        if message_id <= 0:
+            return Response({'error': 'message_id must be a message id'}, status=status.HTTP_400_BAD_REQUEST)
+        # A cursor never points past the newest message
+        if last_message_id is not None:
+            message_id = min(message_id, last_message_id)
+        
+        read, unread = mark_read(room_id, request.user.id, message_id, last_message_id)
+        
+        async_to_sync(get_channel_layer().group_send)(
+            f'chat_{room_id}', receipts_event({request.user.id: (read, read)})
+        )
+        return Response({'room_id': room_id, 'last_read_message_id': read, 'unread_count': unread})
+
+class WebSocketTicketView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    # Browsers connect with ws/chat/<room>/?ticket=<ticket>; single use
+    def post(self, request):
+        return Response({'ticket': issue_ticket(request.user.id)}, status=status.HTTP_201_CREATED)
+
+class PresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    # Bulk lookup: GET presence/?ids=1,2,3; only friends (and yourself) are
+    # reported, other ids are left out of the response
+    max_ids = 500
+    
+    def get(self, request):
+        try:
+            user_ids = {int(user_id) for user_id in request.query_params.get('ids', '').split(',') if user_id}
+        except ValueError:
+            return Response({'error': 'ids must be a comma separated list of user ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(user_ids) > self.max_ids:
+            return Response({'error': f'At most {self.max_ids} ids per request'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        user_ids = visible_presence(request.user.id, user_ids) if user_ids else set()
+        online = async_to_sync(get_store().online)(user_ids) if user_ids else set()
+        return Response({str(user_id): user_id in online for user_id in sorted(user_ids)})
+
+def add_file_urls(request, rows):
+    # Rows come from .values(); the storage name becomes a signed URL that
+    # <img> and <video> tags can load without an Authorization header
+    for row in rows:
+        name = row.pop('file', None)
+        row['file_url'] = request.build_absolute_uri(sign_url(settings.MEDIA_URL + name, name)) if name else None
+    return rows
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    # GET search/?q=words[&room=<id>][&sender=<user id>][&page=&limit=]
+    def get(self, request):
+        try:
+            room_id = request.query_params.get('room')
+            sender_id = request.query_params.get('sender')
+            page, limit = parse_search_page(request.query_params.get('page'), request.query_params.get('limit'))
+            results = search_messages(
+                request.user,
+                request.query_params.get('q', ''),
+                room_id=int(room_id) if room_id else None,
+                sender_id=int(sender_id) if sender_id else None,
+                page=page,
+                limit=limit,
+            )
+        except InvalidQuery as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({'error': 'room and sender must be ids'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        add_file_urls(request, results['results'])
+        return Response(results)
+
+class MessageListView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, room_id):
+        if not ChatRoom.objects.filter(id=room_id, members=request.user).exists():
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        if before and after:
+            return Response({'error': 'Use either before or after, not both'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            page = paginate_messages(
+                Message.objects.filter(room_id=room_id),
+                before=before,
+                after=after,
+                limit=parse_page_size(request.query_params.get('limit')),
+            )
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        add_file_urls(request, page['results'])
+        return Response(page)
+
+def send_file_message(request, message):
+    # Get the file URL
+    name = message.file.name
+    file_url = request.build_absolute_uri(sign_url(settings.MEDIA_URL + name, name))
+    
+    # Preview URLs are known up front; the images are generated in the background.
+    # One signature covers the file and its previews
+    previews = {}
+    if is_image(message.file):
+        previews = {
+            label: request.build_absolute_uri(sign_url(url, name))
+            for label, url in variant_urls(message.file.storage, name).items()
+        }
+    
+    # Send the file message via channels
+    channel_layer = get_channel_layer()
+    room_group_name = f'chat_{message.room_id}'
+    
+    async_to_sync(channel_layer.group_send)(
+        room_group_name,
+        encode_event('chat_message', {
+            'type': 'message',
+            'message': '',
+            'user_id': request.user.id,
+            'message_id': message.id,
+            'file_url': file_url,
+            'file_name': message.file_name,
+            'previews': previews,
+        }, user_id=request.user.id)
+    )
+    
+    return {
+        'message_id': message.id,
+        'file_url': file_url,
+        'file_name': message.file_name,
+        'previews': previews,
+    }
+
 class FileUploadView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -18,43 +264,181 @@ class FileUploadView(APIView):
             if not file:
                 return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Create a new message with the uploaded file
-            message = Message.objects.create(
-                room=room,
-                sender=request.user,
-                file=file,
-                file_name=file.name
-            )
+            # Create a new message with the uploaded file; the blob reference
+            # taken by the storage is rolled back with a failed insert
+            with transaction.atomic():
+                message = Message.objects.create(
+                    id=direct_message_id(),
+                    room=room,
+                    sender=request.user,
+                    file=file,
+                    file_name=file.name
+                )
             
-            # Get the file URL
-            file_url = request.build_absolute_uri(settings.MEDIA_URL + str(message.file))
-            
-            # Send the file message via channels
-            from channels.layers import get_channel_layer
-            from asgiref.sync import async_to_sync
-            
-            channel_layer = get_channel_layer()
-            room_group_name = f'chat_{room_id}'
-            
-            async_to_sync(channel_layer.group_send)(
-                room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': '',
-                    'user_id': request.user.id,
-                    'message_id': message.id,
-                    'file_url': file_url,
-                    'file_name': file.name
-                }
-            )
-            
-            return Response({
-                'message_id': message.id,
-                'file_url': file_url,
-                'file_name': file.name
-            }, status=status.HTTP_201_CREATED)
+            return Response(send_file_message(request, message), status=status.HTTP_201_CREATED)
             
         except ChatRoom.DoesNotExist:
             return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Resumable uploads: POST rooms/<id>/uploads/ to start, PUT byte ranges to
+# rooms/<id>/uploads/<upload_id>/ (GET it to find where to resume), then POST
+# rooms/<id>/uploads/<upload_id>/complete/ to verify and post the message.
+class ChunkedUploadInitView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, room_id):
+        if not ChatRoom.objects.filter(id=room_id, members=request.user).exists():
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        
+        file_name = request.data.get('file_name')
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            return Response({'error': 'size is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not file_name:
+            return Response({'error': 'file_name is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < size <= max_upload_size():
+            return Response({'error': f'size must be between 1 and {max_upload_size()} bytes'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # The whole-file digest is checked again on completion
+            sha256 = parse_sha256(request.data.get('sha256'), 'sha256')
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        upload = ChunkedUpload.objects.create(
+            room_id=room_id,
+            uploader=request.user,
+            file_name=os.path.basename(file_name)[:255],
+            size=size,
+            sha256=sha256,
+        )
+        create_temp_file(upload)
+        
+        return Response({
+            'upload_id': upload.id,
+            'received': 0,
+            'chunk_size': max_chunk_size(),
+        }, status=status.HTTP_201_CREATED)
+
+class ChunkedUploadView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get_upload(self, request, room_id, upload_id):
+        return ChunkedUpload.objects.get(id=upload_id, room_id=room_id, uploader=request.user)
+    
+    def get(self, request, room_id, upload_id):
+        try:
+            upload = self.get_upload(request, room_id, upload_id)
+            return Response({'upload_id': upload.id, 'size': upload.size, 'received': upload.received})
+        except ChunkedUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    def put(self, request, room_id, upload_id):
+        try:
+            upload = self.get_upload(request, room_id, upload_id)
+            start, end = parse_content_range(request.headers.get('Content-Range'), upload.size)
+            
+            if start != upload.received:
+                return Response({'error': 'Chunk does not start at the resume offset', 'received': upload.received}, status=status.HTTP_409_CONFLICT)
+            
+            # Read the raw body as a stream; touching request.data would buffer it.
+            # The offset is claimed under a file lock before anything is written
+            write_chunk(upload, request, start, end, request.headers.get('X-Chunk-SHA256'))
+            
+            return Response({'upload_id': upload.id, 'received': end})
+            
+        except ChunkedUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        except UploadConflict as e:
+            try:
+                upload.refresh_from_db()
+            except ChunkedUpload.DoesNotExist:
+                # Completed or discarded while this chunk was on its way
+                return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+            return Response({'error': str(e), 'received': upload.received}, status=status.HTTP_409_CONFLICT)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    def delete(self, request, room_id, upload_id):
+        try:
+            upload = self.get_upload(request, room_id, upload_id)
+            discard_upload(upload)
+            upload.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        except ChunkedUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+
+class ChunkedUploadCompleteView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, room_id, upload_id):
+        # Membership may have been revoked since the upload started
+        if not ChatRoom.objects.filter(id=room_id, members=request.user).exists():
+            return Response({'error': 'Chat room not found or you do not have access'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            upload = ChunkedUpload.objects.get(id=upload_id, room_id=room_id, uploader=request.user)
+            
+            # A concurrent complete (or a late chunk) gets a 409, not a 500
+            with upload_lock(upload):
+                upload.refresh_from_db()
+                if upload.received != upload.size:
+                    return Response({'error': 'Upload is incomplete', 'received': upload.received}, status=status.HTTP_400_BAD_REQUEST)
+                
+                digest = file_sha256(temp_path(upload))
+                if digest != upload.sha256:
+                    return Response({'error': 'File checksum mismatch'}, status=status.HTTP_400_BAD_REQUEST)
+                
+                # The message only exists once the whole file has been verified
+                with transaction.atomic():
+                    message = Message.objects.create(
+                        id=direct_message_id(),
+                        room_id=room_id,
+                        sender=request.user,
+                        file=store_upload(upload, digest),
+                        file_name=upload.file_name
+                    )
+                    upload.delete()
+            
+            return Response(send_file_message(request, message), status=status.HTTP_201_CREATED)
+            
+        except ChunkedUpload.DoesNotExist:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        except UploadConflict as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+
+class MediaView(APIView):
+    # Profile pictures are public. Chat files and their previews are served
+    # with a valid signature from sign_url(), handed out only to room
+    # members, or else to an authenticated member of a room the file was
+    # posted in
+    permission_classes = [AllowAny]
+    
+    def get(self, request, path):
+        try:
+            name = normalize_name(path)
+            source = source_name(name)
+            file_name = None
+            
+            if source.startswith('chat_files/'):
+                if signature_valid(name, request.query_params):
+                    message = Message.objects.filter(file=source).values('file_name').first()
+                elif request.user.is_authenticated:
+                    # One file can back messages in several rooms (see chat/storage.py)
+                    message = Message.objects.filter(
+                        file=source, room__members=request.user
+                    ).values('file_name').first()
+                else:
+                    message = None
+                if message is None:
+                    raise MediaNotFound(name)
+                # Previews are WebP whatever the original was
+                if name == source:
+                    file_name = message['file_name']
+            
+            return serve_file(request, name, file_name=file_name)
+            
+        except MediaNotFound:
+            raise Http404('File not found')
@@ -0,0 +1,17 @@
+# users/authentication.py
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .token_blacklist import get_blacklist
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    """simplejwt's JWTAuthentication, refusing access tokens revoked by LogoutView."""
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        jti = token.get(api_settings.JTI_CLAIM)
+        if jti and get_blacklist().access_revoked(jti):
+            raise InvalidToken(_('Token has been revoked'))
+        return token
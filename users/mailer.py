@@ -0,0 +1,169 @@
+# users/mailer.py
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundMailer:
+    """
+    Sends email from a daemon thread so request handlers never wait on SMTP.
+
+    send() only puts the message on an in-process queue; nothing is written
+    to the database, and a code lost with its process is replaced by asking
+    for a new one. The worker collects up to batch_size messages (waiting at
+    most batch_window seconds for more after the first), sends them one by
+    one over an SMTP connection that stays open between batches, and closes
+    it after idle_timeout seconds without mail. A message that fails is
+    retried after backoff * 2 ** (attempts - 1) seconds on a fresh
+    connection without holding up the others, so what the server already
+    accepted is never sent again; after max_retries attempts it is logged
+    and dropped.
+
+    Works with any EMAIL_BACKEND, including locmem and console; call
+    flush() in tests to send everything that is due from the calling thread.
+    """
+
+    def __init__(self, batch_size=50, batch_window=0.1, max_retries=5, backoff=1.0, idle_timeout=30.0):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        # (message, attempts so far)
+        self._queue = queue.Queue()
+        # Heap of (due, sequence, message, attempts), guarded by _send_lock
+        self._retries = []
+        self._sequence = itertools.count()
+        self._send_lock = threading.Lock()
+        self._connection = None
+        self._last_sent = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='otp-mailer', daemon=True)
+                self._thread.start()
+
+    def send(self, message):
+        self.start()
+        self._queue.put((message, 0))
+
+    def flush(self):
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._send_lock:
+                batch += self._due_retries()
+                if not batch:
+                    return
+                self._send(batch)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _due_retries(self):
+        now = time.monotonic()
+        due = []
+        while self._retries and self._retries[0][0] <= now:
+            _, _, message, attempts = heapq.heappop(self._retries)
+            due.append((message, attempts))
+        return due
+
+    def _wait_time(self):
+        with self._send_lock:
+            if not self._retries:
+                return self.idle_timeout
+            return min(self.idle_timeout, max(0, self._retries[0][0] - time.monotonic()))
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _send(self, batch):
+        for message, attempts in batch:
+            try:
+                if self._connection is None:
+                    self._connection = get_connection(fail_silently=False)
+                    self._connection.open()
+                self._connection.send_messages([message])
+                self._last_sent = time.monotonic()
+            except Exception:
+                # The connection may be half-broken; the next message gets a new one
+                self._close()
+                self._retry(message, attempts + 1)
+
+    def _retry(self, message, attempts):
+        if attempts >= self.max_retries:
+            logger.exception('Giving up on an email to %s after %d attempts', message.to, attempts)
+            return
+        delay = self.backoff * (2 ** (attempts - 1))
+        logger.warning('Sending an email failed, retrying in %.1fs', delay, exc_info=True)
+        heapq.heappush(self._retries, (time.monotonic() + delay, next(self._sequence), message, attempts))
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._collect(self._queue.get(timeout=self._wait_time()))
+            except queue.Empty:
+                batch = []
+            with self._send_lock:
+                try:
+                    self._send(batch + self._due_retries())
+                except Exception:
+                    logger.exception('Sending queued email failed')
+                if self._connection is not None and time.monotonic() - self._last_sent > self.idle_timeout:
+                    # Idle: do not hold an SMTP connection open for nothing
+                    self._close()
+
+
+_mailer = None
+
+
+def get_mailer():
+    global _mailer
+    if _mailer is None:
+        _mailer = BackgroundMailer(
+            batch_size=getattr(settings, 'OTP_EMAIL_BATCH_SIZE', 50),
+            batch_window=getattr(settings, 'OTP_EMAIL_BATCH_WINDOW', 0.1),
+            max_retries=getattr(settings, 'OTP_EMAIL_MAX_RETRIES', 5),
+            backoff=getattr(settings, 'OTP_EMAIL_RETRY_BACKOFF', 1.0),
+            idle_timeout=getattr(settings, 'OTP_EMAIL_IDLE_TIMEOUT', 30.0),
+        )
+    return _mailer
+
+
+def queue_email(subject, body, from_email, recipient_list):
+    message = EmailMessage(subject, body, from_email, recipient_list)
+    if not getattr(settings, 'OTP_EMAIL_ASYNC', True):
+        message.send()
+        return
+    # Only mail codes that were actually committed
+    transaction.on_commit(lambda: get_mailer().send(message))
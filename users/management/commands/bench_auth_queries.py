@@ -0,0 +1,65 @@
+# users/management/commands/bench_auth_queries.py
+import uuid
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from users.models import User
+from users.otp_store import get_otp_store
+
+PROFILE_TABLE = 'users_profile'
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Count the SQL queries of the register, verify-otp and login requests, and how many '
+        'of them touch the profile table. Everything runs in a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show-sql', action='store_true', help='Print every captured query')
+
+    def step(self, name, call):
+        with CaptureQueriesContext(connection) as queries:
+            response = call()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name} failed with {response.status_code}: {response.content[:200]!r}')
+        sql = [query['sql'] for query in queries.captured_queries]
+        profile = sum(PROFILE_TABLE in statement for statement in sql)
+        self.stdout.write(f'{name:>10} {len(sql):>8} {profile:>16}')
+        if self.show_sql:
+            for statement in sql:
+                self.stdout.write(f'           {statement}')
+        return response, len(sql)
+
+    @override_settings(ALLOWED_HOSTS=['testserver'], OTP_EMAIL_ASYNC=False, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def handle(self, *args, **options):
+        self.show_sql = options['show_sql']
+        client = APIClient()
+        suffix = uuid.uuid4().hex[:12]
+        credentials = {'email': f'bench-{suffix}@example.com', 'username': f'bench-{suffix}', 'password': uuid.uuid4().hex}
+
+        self.stdout.write(f"{'request':>10} {'queries':>8} {'profile queries':>16}")
+        try:
+            with transaction.atomic():
+                response, total = self.step('register', lambda: client.post('/api/users/register/', credentials, format='json'))
+
+                # The code only goes out by email, so issue a known one
+                client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+                get_otp_store().issue(User.objects.get(email=credentials['email']).id, '123456')
+                _, count = self.step('verify', lambda: client.post('/api/users/verify-otp/', {'otp': '123456'}, format='json'))
+                total += count
+
+                client.credentials()
+                _, count = self.step('login', lambda: client.post('/api/users/token/', {
+                    'email': credentials['email'], 'password': credentials['password'],
+                }, format='json'))
+                total += count
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'{total} queries for the whole flow'))
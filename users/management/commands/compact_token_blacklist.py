@@ -0,0 +1,18 @@
+# users/management/commands/compact_token_blacklist.py
+from django.core.management.base import BaseCommand
+from users.token_blacklist import compact_expired_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired outstanding and blacklisted JWT refresh tokens in small batches. '
+        'Safe to run while the site is up, e.g. hourly from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Tokens deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        deleted = compact_expired_tokens(batch_size=options['batch_size'], pause=options['pause'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired tokens'))
@@ -0,0 +1,23 @@
+# users/management/commands/compute_friend_suggestions.py
+from django.core.management.base import BaseCommand
+from users.suggestions import DEFAULT_TOP_K, compute_suggestions, load_edges, store_suggestions
+
+
+class Command(BaseCommand):
+    help = 'Recompute the "people you may know" table from the friendship graph. Run periodically, e.g. from cron.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='Suggestions kept per user')
+
+    def handle(self, *args, **options):
+        friends, blocks, requests = load_edges()
+        users = 0
+
+        def counted(suggestions):
+            nonlocal users
+            for item in suggestions:
+                users += 1
+                yield item
+
+        store_suggestions(counted(compute_suggestions(friends, blocks, requests, top_k=options['top_k'])))
+        self.stdout.write(self.style.SUCCESS(f'Stored suggestions for {users} users'))
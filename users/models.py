@@ -30,17 +30,6 @@ class User(AbstractUser):
     objects = CustomUserManager()
 
 
-# users/models.py
-class OTP(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    otp = models.CharField(max_length=6)
-    created_at = models.DateTimeField(auto_now_add=True)
-    expires_at = models.DateTimeField()
-    
-    def is_expired(self):
-        from django.utils import timezone
-        return timezone.now() > self.expires_at
-
 # users/models.py
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
@@ -51,6 +40,40 @@ class Profile(models.Model):
     
     def __str__(self):
         return f"{self.user.username}'s Profile"
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_saved_values()
+        return instance
+    
+    def _remember_saved_values(self, fields=None):
+        # Prepared values, so a FileField is compared by name rather than by
+        # the FieldFile object that is mutated in place
+        saved = getattr(self, '_saved_values', {})
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if fields is None or field.name in fields or field.attname in fields:
+                saved[field.attname] = field.get_prep_value(field.value_from_object(self))
+        self._saved_values = saved
+    
+    def get_dirty_fields(self):
+        """Names of the fields that differ from what was last loaded or saved."""
+        saved = getattr(self, '_saved_values', {})
+        deferred = self.get_deferred_fields()
+        return [
+            field.name for field in self._meta.concrete_fields
+            if not field.primary_key and field.attname not in deferred and (
+                field.attname not in saved
+                or saved[field.attname] != field.get_prep_value(field.value_from_object(self))
+            )
+        ]
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._remember_saved_values(kwargs.get('update_fields'))
 
 # users/models.py
 class Report(models.Model):
@@ -72,3 +95,19 @@ class Report(models.Model):
     def __str__(self):
         return f"{self.reporter.username} reported {self.reported_user.username}"
 
+
+# users/models.py
+class FriendSuggestion(models.Model):
+    """Precomputed top-K "people you may know" row; see users/suggestions.py."""
+    user = models.ForeignKey(User, related_name='friend_suggestions', on_delete=models.CASCADE)
+    suggested = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    mutual_friends = models.PositiveIntegerField()
+    rank = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'rank'], name='users_suggestion_user_rank_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.suggested_id} for {self.user_id} ({self.mutual_friends} mutual)"
@@ -0,0 +1,99 @@
+# users/otp_store.py
+import hashlib
+import hmac
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+VERIFIED = 'verified'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+LOCKED = 'locked'
+
+
+class CacheOTPStore:
+    """
+    One-time codes kept in a Django cache with a native TTL.
+
+    Only an HMAC of the code is stored, next to an attempt counter. Every
+    verification first bumps the counter with an atomic incr and is refused
+    once it exceeds max_attempts, before the code is even compared, so
+    parallel guesses cannot slip past the limit. The counter lives for
+    lockout seconds from the first attempt and is not reset by issuing a new
+    code, so resending is no way around it either; resends themselves are
+    limited to one per resend_interval. The code and counter are deleted on
+    success. Nothing is written to the database and expired codes clean
+    themselves up.
+
+    Point the cache at Redis for multi-process deployments; locmem is fine
+    for development and tests.
+    """
+
+    def __init__(self, cache_alias='default', ttl=300, max_attempts=5, lockout=900, resend_interval=60):
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.lockout = max(lockout, ttl)
+        self.resend_interval = resend_interval
+
+    def _keys(self, user_id):
+        return f'otp:{user_id}:code', f'otp:{user_id}:attempts'
+
+    def _resend_key(self, user_id):
+        return f'otp:{user_id}:resend'
+
+    def _digest(self, user_id, code):
+        return hmac.new(settings.SECRET_KEY.encode(), f'{user_id}:{code}'.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id, code):
+        code_key, _ = self._keys(user_id)
+        self.cache.set(code_key, self._digest(user_id, code), timeout=self.ttl)
+        self.cache.set(self._resend_key(user_id), 1, timeout=self.resend_interval)
+
+    def allow_resend(self, user_id):
+        """Whether a new code may be issued now; at most one per resend_interval."""
+        return self.cache.add(self._resend_key(user_id), 1, timeout=self.resend_interval)
+
+    def _attempt(self, attempts_key):
+        # Count the attempt before looking at the code
+        self.cache.add(attempts_key, 0, timeout=self.lockout)
+        try:
+            return self.cache.incr(attempts_key)
+        except ValueError:
+            # Expired between the add and the increment: a fresh window
+            self.cache.add(attempts_key, 1, timeout=self.lockout)
+            return 1
+
+    def verify(self, user_id, code):
+        code_key, attempts_key = self._keys(user_id)
+        attempts = self._attempt(attempts_key)
+        if attempts > self.max_attempts:
+            return LOCKED
+        digest = self.cache.get(code_key)
+        if digest is None:
+            return EXPIRED
+        if hmac.compare_digest(digest, self._digest(user_id, code)):
+            # Single use
+            self.cache.delete_many([code_key, attempts_key])
+            return VERIFIED
+        return LOCKED if attempts >= self.max_attempts else INVALID
+
+    def discard(self, user_id):
+        self.cache.delete_many(self._keys(user_id))
+
+
+_store = None
+
+
+def get_otp_store():
+    global _store
+    if _store is None:
+        store_class = import_string(getattr(settings, 'OTP_STORE', 'users.otp_store.CacheOTPStore'))
+        _store = store_class(
+            cache_alias=getattr(settings, 'OTP_CACHE_ALIAS', 'default'),
+            ttl=getattr(settings, 'OTP_TTL', 300),
+            max_attempts=getattr(settings, 'OTP_MAX_ATTEMPTS', 5),
+            lockout=getattr(settings, 'OTP_LOCKOUT', 900),
+            resend_interval=getattr(settings, 'OTP_RESEND_INTERVAL', 60),
+        )
+    return _store
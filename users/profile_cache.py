@@ -0,0 +1,105 @@
+# users/profile_cache.py
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from chat.thumbnails import variant_sizes
+
+
+class ProfileCache:
+    """
+    Serialized profiles in a Django cache, keyed by user id and a version
+    stamp.
+
+    Each user has a version key holding a random stamp; the serialized
+    profile lives under profile:{user_id}:{stamp}. Invalidating replaces the
+    stamp, so a stale entry can never be read again and simply expires, and
+    a racing reader that serialized the old row writes under the old stamp
+    where nobody looks. If a version key is evicted a fresh stamp is made,
+    which also only costs a miss.
+
+    A bulk read is two get_many calls; whatever is missing is loaded with one
+    select_related query, serialized and written back with one set_many.
+    Profiles whose picture previews are not all there yet (still being
+    generated, or never will be for a file that is not an image) are cached
+    for pending_ttl seconds only, so new previews show up soon without such
+    profiles missing the cache on every read.
+    """
+
+    def __init__(self, cache_alias='default', ttl=600, pending_ttl=15):
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+        self.pending_ttl = min(pending_ttl, ttl)
+
+    def _version_key(self, user_id):
+        return f'profile-version:{user_id}'
+
+    def _data_key(self, user_id, version):
+        return f'profile:{user_id}:{version}'
+
+    def _versions(self, user_ids):
+        keys = {self._version_key(user_id): user_id for user_id in user_ids}
+        found = self.cache.get_many(keys)
+        versions = {keys[key]: version for key, version in found.items()}
+        missing = {key: uuid.uuid4().hex for key, user_id in keys.items() if user_id not in versions}
+        if missing:
+            # Outlive the data so an entry is never orphaned under a live stamp
+            self.cache.set_many(missing, timeout=self.ttl * 2)
+            versions.update((keys[key], version) for key, version in missing.items())
+        return versions
+
+    def invalidate(self, user_id):
+        self.cache.set(self._version_key(user_id), uuid.uuid4().hex, timeout=self.ttl * 2)
+
+    def get_many(self, user_ids):
+        """Serialized profiles by user id; unknown ids are left out."""
+        from .models import Profile
+        from .serializers import ProfileSerializer
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        versions = self._versions(user_ids)
+        keys = {self._data_key(user_id, versions[user_id]): user_id for user_id in user_ids}
+        profiles = {keys[key]: data for key, data in self.cache.get_many(keys).items()}
+
+        missing = user_ids - profiles.keys()
+        if missing:
+            complete, pending = {}, {}
+            for profile in Profile.objects.select_related('user').filter(user_id__in=missing):
+                data = dict(ProfileSerializer(profile).data)
+                profiles[profile.user_id] = data
+                key = self._data_key(profile.user_id, versions[profile.user_id])
+                if not profile.profile_picture or len(data['profile_picture_variants']) == len(variant_sizes()):
+                    complete[key] = data
+                else:
+                    pending[key] = data
+            if complete:
+                self.cache.set_many(complete, timeout=self.ttl)
+            if pending:
+                self.cache.set_many(pending, timeout=self.pending_ttl)
+        return profiles
+
+    def get(self, user_id):
+        return self.get_many([user_id]).get(user_id)
+
+
+# Only the profile's owner sees these; everyone else gets the rest
+PRIVATE_FIELDS = ('email', 'date_of_birth', 'phone_number')
+
+
+def public_profile(data):
+    return {field: value for field, value in data.items() if field not in PRIVATE_FIELDS}
+
+
+_cache = None
+
+
+def get_profile_cache():
+    global _cache
+    if _cache is None:
+        _cache = ProfileCache(
+            cache_alias=getattr(settings, 'PROFILE_CACHE_ALIAS', 'default'),
+            ttl=getattr(settings, 'PROFILE_CACHE_TTL', 600),
+            pending_ttl=getattr(settings, 'PROFILE_CACHE_PENDING_TTL', 15),
+        )
+    return _cache
@@ -2,16 +2,40 @@
 from rest_framework import serializers
 
 from rest_framework import serializers
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.thumbnails import variant_urls
 from .models import Profile, User
+from .token_blacklist import get_blacklist
 
 class ProfileSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
     email = serializers.EmailField(source='user.email', read_only=True)
+    profile_picture_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Profile
-        fields = ['username', 'email', 'bio', 'profile_picture', 'date_of_birth', 'phone_number']
+        fields = ['username', 'email', 'bio', 'profile_picture', 'profile_picture_variants', 'date_of_birth', 'phone_number']
         read_only_fields = ['username', 'email']
+    
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # Write only the columns this request changed (see Profile.get_dirty_fields)
+        dirty = instance.get_dirty_fields()
+        if dirty:
+            instance.save(update_fields=dirty)
+        return instance
+    
+    def get_profile_picture_variants(self, obj):
+        # Thumbnails and WebP versions, listed once they have been generated
+        picture = obj.profile_picture
+        if not picture:
+            return {}
+        return variant_urls(picture.storage, picture.name, only_existing=True)
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
@@ -30,3 +54,14 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
 
 class OTPVerificationSerializer(serializers.Serializer):
     otp = serializers.CharField(max_length=6)
+
+
+class CachedBlacklistRefreshToken(RefreshToken):
+    def check_blacklist(self):
+        # Bloom filter first; the blacklist table is only read on a hit
+        jti = self.payload[api_settings.JTI_CLAIM]
+        if get_blacklist().is_blacklisted(jti):
+            raise TokenError(_("Token is blacklisted"))
+
+class CachedTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = CachedBlacklistRefreshToken
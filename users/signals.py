@@ -1,6 +1,11 @@
 # users/signals.py
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from chat.thumbnails import delete_variants, is_image, schedule_variants
+from .profile_cache import get_profile_cache
+from .token_blacklist import get_blacklist
 from .models import User, Profile
 
 @receiver(post_save, sender=User)
@@ -9,5 +14,50 @@ def create_user_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+def save_user_profile(sender, instance, created, **kwargs):
+    # Only a profile that was loaded through this user and then changed is
+    # written; saving a user (is_verified, last_login) never reads or
+    # writes the profile row
+    if created or not User.profile.related.is_cached(instance):
+        return
+    dirty = instance.profile.get_dirty_fields()
+    if dirty:
+        instance.profile.save(update_fields=dirty)
+
+# Fields of User that are part of the serialized profile
+PROFILE_USER_FIELDS = {'username', 'email'}
+
+@receiver(post_save, sender=User)
+def invalidate_cached_profile(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or PROFILE_USER_FIELDS & set(update_fields):
+        get_profile_cache().invalidate(instance.pk)
+
+@receiver(post_save, sender=Profile)
+def invalidate_cached_profile_row(sender, instance, **kwargs):
+    get_profile_cache().invalidate(instance.user_id)
+
+@receiver(post_save, sender=Profile)
+def generate_profile_picture_previews(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'profile_picture' not in update_fields:
+        return
+    picture = instance.profile_picture
+    # Profile.save() records the new values only after post_save, so this is
+    # still the picture the row had before
+    previous = getattr(instance, '_saved_values', {}).get('profile_picture')
+    if previous and previous != picture.name:
+        storage = picture.storage
+        transaction.on_commit(lambda: delete_variants(storage, previous))
+    if is_image(picture):
+        schedule_variants(picture)
+
+@receiver(post_delete, sender=Profile)
+def delete_profile_picture_previews(sender, instance, **kwargs):
+    picture = instance.profile_picture
+    if picture:
+        storage, name = picture.storage, picture.name
+        transaction.on_commit(lambda: delete_variants(storage, name))
+
+@receiver(post_save, sender=BlacklistedToken)
+def add_to_blacklist_filter(sender, instance, created, **kwargs):
+    if created:
+        get_blacklist().add(instance.token.jti)
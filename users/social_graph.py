@@ -0,0 +1,192 @@
+# users/social_graph.py
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from django.conf import settings
+
+FRIENDS = 'friends'
+FOLLOWING = 'following'
+BLOCKING = 'blocking'
+BLOCKED_BY = 'blocked_by'
+
+
+def _index(ids, user_id):
+    position = bisect_left(ids, user_id)
+    return position, position < len(ids) and ids[position] == user_id
+
+
+def load_relations(user_id):
+    """Read a user's relationships from the django-friendship tables."""
+    from friendship.models import Block, Follow, Friend
+
+    def ids(queryset, field):
+        return array('q', sorted(queryset.values_list(field, flat=True)))
+
+    return {
+        # Friendships are stored in both directions
+        FRIENDS: ids(Friend.objects.filter(to_user_id=user_id), 'from_user_id'),
+        FOLLOWING: ids(Follow.objects.filter(follower_id=user_id), 'followee_id'),
+        BLOCKING: ids(Block.objects.filter(blocker_id=user_id), 'blocked_id'),
+        BLOCKED_BY: ids(Block.objects.filter(blocked_id=user_id), 'blocker_id'),
+    }
+
+
+class SocialGraphCache:
+    """
+    Per-user friend, following and block sets as sorted int arrays.
+
+    A user's relationships are loaded in one go on first use and kept in a
+    bounded LRU; checks after that are a binary search in memory. Views that
+    change a relationship write the change through to both users' cached
+    arrays, and entries are reloaded after ttl seconds so changes made by
+    other processes show up without any cross-process invalidation.
+
+    Being up to ttl seconds behind other processes, it serves reads that
+    tolerate that: presence visibility, suggestion filtering and the checks
+    that turn away a repeated mutation before it reaches the database.
+    Mutations themselves are decided by the database.
+    """
+
+    def __init__(self, max_users=10000, ttl=60.0):
+        self.max_users = max_users
+        self.ttl = ttl
+        # user_id -> (loaded_at, {kind: array})
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def relations(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+        relations = load_relations(user_id)
+        with self._lock:
+            self._entries[user_id] = (now, relations)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return relations
+
+    def has(self, user_id, kind, other_id):
+        return _index(self.relations(user_id)[kind], other_id)[1]
+
+    def ids(self, user_id, kind):
+        return self.relations(user_id)[kind]
+
+    def add(self, user_id, kind, other_id):
+        # Write-through: only users already cached are touched
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                ids = entry[1][kind]
+                position, found = _index(ids, other_id)
+                if not found:
+                    ids.insert(position, other_id)
+
+    def remove(self, user_id, kind, other_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                ids = entry[1][kind]
+                position, found = _index(ids, other_id)
+                if found:
+                    del ids[position]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_graph = None
+
+
+def get_graph():
+    global _graph
+    if _graph is None:
+        _graph = SocialGraphCache(
+            max_users=getattr(settings, 'SOCIAL_GRAPH_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'SOCIAL_GRAPH_CACHE_TTL', 60.0),
+        )
+    return _graph
+
+
+# Checks against the cache, possibly up to ttl seconds stale
+
+def are_friends(user_id, other_id):
+    return get_graph().has(user_id, FRIENDS, other_id)
+
+
+def follows(user_id, other_id):
+    return get_graph().has(user_id, FOLLOWING, other_id)
+
+
+def blocks(user_id, other_id):
+    """Has user_id blocked other_id?"""
+    return get_graph().has(user_id, BLOCKING, other_id)
+
+
+def blocked_either_way(user_id, other_id):
+    graph = get_graph()
+    return graph.has(user_id, BLOCKING, other_id) or graph.has(user_id, BLOCKED_BY, other_id)
+
+
+# Read from the database; mutations decide from these, never from the cache,
+# which may be up to ttl seconds behind changes made by other processes
+
+def block_exists(user_id, other_id):
+    """Has either user blocked the other, according to the database?"""
+    from django.db.models import Q
+    from friendship.models import Block
+    return Block.objects.filter(
+        Q(blocker_id=user_id, blocked_id=other_id) | Q(blocker_id=other_id, blocked_id=user_id)
+    ).exists()
+
+
+def block_ids(user_id):
+    """Ids of the users blocking or blocked by user_id, according to the database."""
+    from friendship.models import Block
+    blocking = Block.objects.filter(blocker_id=user_id).values_list('blocked_id', flat=True)
+    blocked_by = Block.objects.filter(blocked_id=user_id).values_list('blocker_id', flat=True)
+    return frozenset(blocking.union(blocked_by))
+
+
+# Write-through after a mutation; both users' entries are kept in step
+
+def friendship_added(user_id, other_id):
+    graph = get_graph()
+    graph.add(user_id, FRIENDS, other_id)
+    graph.add(other_id, FRIENDS, user_id)
+
+
+def friendship_removed(user_id, other_id):
+    graph = get_graph()
+    graph.remove(user_id, FRIENDS, other_id)
+    graph.remove(other_id, FRIENDS, user_id)
+
+
+def follow_added(follower_id, followee_id):
+    get_graph().add(follower_id, FOLLOWING, followee_id)
+
+
+def follow_removed(follower_id, followee_id):
+    get_graph().remove(follower_id, FOLLOWING, followee_id)
+
+
+def block_added(blocker_id, blocked_id):
+    graph = get_graph()
+    graph.add(blocker_id, BLOCKING, blocked_id)
+    graph.add(blocked_id, BLOCKED_BY, blocker_id)
+
+
+def block_removed(blocker_id, blocked_id):
+    graph = get_graph()
+    graph.remove(blocker_id, BLOCKING, blocked_id)
+    graph.remove(blocked_id, BLOCKED_BY, blocker_id)
@@ -0,0 +1,141 @@
+# users/suggestions.py
+from django.db import transaction
+from . import social_graph
+from .models import FriendSuggestion
+
+DEFAULT_TOP_K = 20
+CHUNK_ROWS = 2048
+
+
+def load_edges():
+    """Friend, block and pending-request pairs as lists of (user_id, user_id)."""
+    from friendship.models import Block, Friend, FriendshipRequest
+    return (
+        # Friendships are stored in both directions already
+        list(Friend.objects.values_list('from_user_id', 'to_user_id')),
+        list(Block.objects.values_list('blocker_id', 'blocked_id')),
+        list(FriendshipRequest.objects.values_list('from_user_id', 'to_user_id')),
+    )
+
+
+def compute_suggestions(friends, blocks=(), requests=(), top_k=DEFAULT_TOP_K, chunk_rows=CHUNK_ROWS):
+    """
+    Yield (user_id, [(suggested_id, mutual_friends), ...]) per user with at
+    least one suggestion, best first.
+
+    With A the symmetric friendship adjacency matrix, (A @ A)[u, v] is the
+    number of friends u and v have in common, and its non-zeros are u's
+    2-hop neighbourhood. The product is computed with scipy.sparse one block
+    of rows at a time so memory stays bounded. Friends, the user themselves,
+    and anyone blocked or with a pending request in either direction are
+    masked out before the top K are picked.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    if not friends:
+        return
+    user_ids = np.unique(np.array(friends, dtype=np.int64).ravel())
+    size = len(user_ids)
+
+    def matrix(pairs, symmetric):
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        # Users without friends have no row; pairs touching them are irrelevant
+        pairs = pairs[np.isin(pairs, user_ids).all(axis=1)]
+        rows = np.searchsorted(user_ids, pairs[:, 0])
+        cols = np.searchsorted(user_ids, pairs[:, 1])
+        if symmetric:
+            rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        result = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(size, size)
+        )
+        # Duplicate pairs sum up; only presence matters
+        result.data[:] = 1
+        return result
+
+    adjacency = matrix(friends, symmetric=True)
+    excluded = (adjacency + matrix(blocks, symmetric=True) + matrix(requests, symmetric=True)).tocsr()
+
+    for start in range(0, size, chunk_rows):
+        stop = min(start + chunk_rows, size)
+        mutual = (adjacency[start:stop] @ adjacency).tocsr()
+        mutual.setdiag(0, k=start)
+        # Zero out excluded pairs, then drop the explicit zeros
+        mutual = mutual - mutual.multiply(excluded[start:stop] > 0)
+        mutual.eliminate_zeros()
+
+        for row in range(stop - start):
+            begin, end = mutual.indptr[row], mutual.indptr[row + 1]
+            if begin == end:
+                continue
+            columns = mutual.indices[begin:end]
+            counts = mutual.data[begin:end]
+            if len(counts) > top_k:
+                best = np.argpartition(-counts, top_k - 1)[:top_k]
+                columns, counts = columns[best], counts[best]
+            # Most mutual friends first, lower user id on ties for stable output
+            order = np.lexsort((user_ids[columns], -counts))
+            yield int(user_ids[start + row]), [
+                (int(user_ids[columns[i]]), int(counts[i])) for i in order
+            ]
+
+
+def store_suggestions(suggestions, batch_size=5000):
+    """
+    Replace the stored top-K table with the given suggestions.
+
+    Users are swapped a batch at a time, each batch in its own short
+    transaction that deletes and reinserts just those users' rows, so
+    readers never find a user without suggestions mid-run and no lock is
+    held on the whole table. Users who got no suggestions this run are
+    cleared at the end.
+    """
+    seen = set()
+    users, rows = [], []
+
+    def swap():
+        with transaction.atomic():
+            FriendSuggestion.objects.filter(user_id__in=users).delete()
+            FriendSuggestion.objects.bulk_create(rows, batch_size=batch_size)
+
+    for user_id, suggested in suggestions:
+        seen.add(user_id)
+        users.append(user_id)
+        rows.extend(
+            FriendSuggestion(user_id=user_id, suggested_id=suggested_id, mutual_friends=mutual, rank=rank)
+            for rank, (suggested_id, mutual) in enumerate(suggested)
+        )
+        if len(rows) >= batch_size:
+            swap()
+            users, rows = [], []
+    if users:
+        swap()
+
+    stale = sorted(set(FriendSuggestion.objects.values_list('user_id', flat=True).distinct()) - seen)
+    for start in range(0, len(stale), batch_size):
+        FriendSuggestion.objects.filter(user_id__in=stale[start:start + batch_size]).delete()
+
+
+def drop_suggestion(user_id, other_id):
+    # Once two users are friends, blocked or have a pending request, neither
+    # should keep suggesting the other until the next run
+    FriendSuggestion.objects.filter(user_id=user_id, suggested_id=other_id).delete()
+    FriendSuggestion.objects.filter(user_id=other_id, suggested_id=user_id).delete()
+
+
+def suggestions_for(user_id):
+    """
+    The stored suggestions for one user: a single (user, rank) index range
+    read. Users the social graph cache knows to be friends or blocked since
+    the last run are left out.
+    """
+    rows = (
+        FriendSuggestion.objects.filter(user_id=user_id)
+        .order_by('rank')
+        .values('suggested_id', 'suggested__username', 'mutual_friends')
+    )
+    return [
+        row for row in rows
+        if not social_graph.are_friends(user_id, row['suggested_id'])
+        and not social_graph.blocked_either_way(user_id, row['suggested_id'])
+    ]
@@ -1,3 +1,283 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from . import social_graph
+from .mailer import BackgroundMailer, queue_email
+from .models import FriendSuggestion, Profile
+from .profile_cache import ProfileCache
+from .otp_store import INVALID, LOCKED, VERIFIED, CacheOTPStore
+from .token_blacklist import BlacklistFilter, BloomFilter
+from .suggestions import store_suggestions
 
-# Create your tests here.
+User = get_user_model()
+
+LOCAL_LAYERS = {'default': {'BACKEND': 'chat.layers.LocalFirstChannelLayer'}}
+
+
+def make_user(name, **extra):
+    return User.objects.create_user(email=f'{name}@example.com', username=name, password='pw', **extra)
+
+
+@override_settings(CHANNEL_LAYERS=LOCAL_LAYERS)
+class RelationshipMutationTests(TestCase):
+    def setUp(self):
+        social_graph.get_graph().clear()
+        self.addCleanup(social_graph.get_graph().clear)
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def befriend(self):
+        from friendship.models import Friend
+        Friend.objects.create(from_user=self.alice, to_user=self.bob)
+        Friend.objects.create(from_user=self.bob, to_user=self.alice)
+
+    def test_block_removes_a_friendship_the_cache_has_not_seen(self):
+        from friendship.models import Friend
+        # Cached before another process made them friends
+        self.assertFalse(social_graph.are_friends(self.alice.id, self.bob.id))
+        self.befriend()
+        response = self.client.post(f'/api/users/block/{self.bob.id}/')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(Friend.objects.filter(from_user=self.alice, to_user=self.bob).exists())
+        self.assertTrue(social_graph.blocks(self.alice.id, self.bob.id))
+
+    def test_repeated_mutations_are_client_errors(self):
+        self.assertEqual(self.client.post(f'/api/users/follow/{self.bob.id}/').status_code, 201)
+        social_graph.get_graph().clear()
+        self.assertEqual(self.client.post(f'/api/users/follow/{self.bob.id}/').status_code, 400)
+        self.assertEqual(self.client.post(f'/api/users/block/{self.bob.id}/').status_code, 201)
+        self.assertEqual(self.client.post(f'/api/users/block/{self.bob.id}/').status_code, 400)
+        self.assertEqual(self.client.delete(f'/api/users/block/{self.bob.id}/').status_code, 200)
+        self.assertEqual(self.client.delete(f'/api/users/block/{self.bob.id}/').status_code, 400)
+
+    def test_repeats_are_turned_away_from_the_cache(self):
+        from friendship.models import Block, Follow
+        self.assertEqual(self.client.post(f'/api/users/follow/{self.bob.id}/').status_code, 201)
+        self.assertEqual(self.client.post(f'/api/users/block/{self.bob.id}/').status_code, 201)
+        with mock.patch.object(Follow.objects, 'add_follower') as add_follower, \
+                mock.patch.object(Block.objects, 'add_block') as add_block:
+            self.assertEqual(self.client.post(f'/api/users/block/{self.bob.id}/').status_code, 400)
+            Follow.objects.create(follower=self.alice, followee=self.bob)
+            social_graph.follow_added(self.alice.id, self.bob.id)
+            self.assertEqual(self.client.post(f'/api/users/follow/{self.bob.id}/').status_code, 400)
+        add_block.assert_not_called()
+        add_follower.assert_not_called()
+
+    def test_suggestions_leave_out_new_friends(self):
+        carol = make_user('carol')
+        FriendSuggestion.objects.create(user=self.alice, suggested=self.bob, mutual_friends=1, rank=0)
+        FriendSuggestion.objects.create(user=self.alice, suggested=carol, mutual_friends=1, rank=1)
+        # Made friends without the view, so the stored row is still there
+        self.befriend()
+        response = self.client.get('/api/users/friend-suggestions/')
+        self.assertEqual([row['suggested_id'] for row in response.data], [carol.id])
+
+    def test_friend_request_to_a_friend_is_rejected(self):
+        self.assertFalse(social_graph.are_friends(self.alice.id, self.bob.id))
+        self.befriend()
+        response = self.client.post(f'/api/users/friend-request/{self.bob.id}/')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(social_graph.are_friends(self.alice.id, self.bob.id))
+
+
+class StoreSuggestionsTests(TestCase):
+    def test_rows_are_swapped_per_user_and_stale_users_cleared(self):
+        alice, bob, carol, dave = (make_user(name) for name in ('alice', 'bob', 'carol', 'dave'))
+        store_suggestions([(alice.id, [(carol.id, 2)]), (bob.id, [(dave.id, 1)])])
+        store_suggestions([(alice.id, [(dave.id, 3), (carol.id, 1)])], batch_size=1)
+        self.assertEqual(
+            list(FriendSuggestion.objects.order_by('user_id', 'rank').values_list('user_id', 'suggested_id', 'rank')),
+            [(alice.id, dave.id, 0), (alice.id, carol.id, 1)],
+        )
+
+
+class FlakyBackend(EmailBackend):
+    """locmem backend whose first 'fail' message raises, like a dropped SMTP connection."""
+    failed = False
+
+    def send_messages(self, messages):
+        if messages[0].subject == 'fail' and not FlakyBackend.failed:
+            FlakyBackend.failed = True
+            raise ConnectionError('connection reset')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', OTP_EMAIL_ASYNC=True)
+class MailerTests(TestCase):
+    def setUp(self):
+        self.mailer = BackgroundMailer(backoff=60)
+
+    def queue(self, subject):
+        # Handed over on commit; the worker thread is not started so flush() sends
+        with mock.patch('users.mailer.get_mailer', return_value=self.mailer), \
+                mock.patch.object(self.mailer, 'start'), self.captureOnCommitCallbacks(execute=True):
+            queue_email(subject, 'body', 'noreply@example.com', ['user@example.com'])
+
+    def test_queued_mail_never_touches_the_database(self):
+        with self.assertNumQueries(0):
+            self.queue('code')
+            self.assertEqual(mail.outbox, [])
+            self.mailer.flush()
+        self.assertEqual([message.subject for message in mail.outbox], ['code'])
+
+    @override_settings(EMAIL_BACKEND='users.tests.FlakyBackend')
+    def test_retry_does_not_resend_delivered_messages(self):
+        FlakyBackend.failed = False
+        for subject in ('sent', 'fail', 'later'):
+            self.queue(subject)
+        self.mailer.flush()
+        self.assertEqual([message.subject for message in mail.outbox], ['sent', 'later'])
+        [(_, _, failed, attempts)] = self.mailer._retries
+        self.assertEqual((failed.subject, attempts), ('fail', 1))
+
+        with mock.patch('users.mailer.time.monotonic', return_value=time.monotonic() + 61):
+            self.mailer.flush()
+        self.assertEqual([message.subject for message in mail.outbox], ['sent', 'later', 'fail'])
+        self.assertEqual(self.mailer._retries, [])
+
+
+class OTPStoreTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.store = CacheOTPStore(max_attempts=3)
+
+    def test_attempts_are_counted_before_the_code_is_compared(self):
+        self.store.issue(1, '123456')
+        self.assertEqual([self.store.verify(1, '000000') for _ in range(3)], [INVALID, INVALID, LOCKED])
+        self.assertEqual(self.store.verify(1, '123456'), LOCKED)
+
+    def test_a_new_code_does_not_reset_the_attempts(self):
+        self.store.issue(1, '123456')
+        for _ in range(3):
+            self.store.verify(1, '000000')
+        self.store.issue(1, '654321')
+        self.assertEqual(self.store.verify(1, '654321'), LOCKED)
+
+    def test_success_clears_the_attempts(self):
+        self.store.issue(1, '123456')
+        self.store.verify(1, '000000')
+        self.assertEqual(self.store.verify(1, '123456'), VERIFIED)
+        self.store.issue(1, '111111')
+        self.assertEqual([self.store.verify(1, '000000') for _ in range(2)], [INVALID, INVALID])
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', OTP_EMAIL_ASYNC=False)
+    def test_resend_is_rate_limited(self):
+        user = make_user('alice')
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch('users.views.get_otp_store', return_value=self.store), \
+                mock.patch('users.utils.get_otp_store', return_value=self.store):
+            self.assertEqual(client.post('/api/users/resend-otp/').status_code, 200)
+            self.assertEqual(client.post('/api/users/resend-otp/').status_code, 429)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class LogoutTests(TestCase):
+    def test_logout_revokes_both_tokens(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        user = make_user('alice')
+        refresh = RefreshToken.for_user(user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.assertEqual(client.get('/api/users/profile/').status_code, 200)
+        response = client.post('/api/users/logout/', {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get('/api/users/profile/').status_code, 401)
+        client.credentials()
+        response = client.post('/api/users/token/refresh/', {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class BlacklistFilterTests(TestCase):
+    def test_stale_filter_is_rebuilt_once_while_others_use_the_old_one(self):
+        blacklist = BlacklistFilter(refresh=60)
+        old, new = BloomFilter(10), BloomFilter(10)
+        blacklist._filter, blacklist._built_at = old, -1000
+        building, release = threading.Event(), threading.Event()
+
+        def slow_build():
+            building.set()
+            release.wait(5)
+            return new
+
+        with mock.patch.object(blacklist, '_build', side_effect=slow_build) as build:
+            rebuilder = threading.Thread(target=blacklist._current)
+            rebuilder.start()
+            building.wait(5)
+            self.assertIs(blacklist._current(), old)
+            release.set()
+            rebuilder.join(5)
+            self.assertIs(blacklist._current(), new)
+        self.assertEqual(build.call_count, 1)
+
+
+class ProfileTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        Profile.objects.filter(user=self.bob).update(phone_number='555-0100')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_other_users_contact_details_are_hidden(self):
+        with mock.patch('users.views.get_profile_cache', return_value=ProfileCache()):
+            response = self.client.get(f'/api/users/profiles/?ids={self.alice.id},{self.bob.id}')
+            other = self.client.get(f'/api/users/profile/{self.bob.id}/')
+        self.assertEqual(response.data[str(self.alice.id)]['email'], 'alice@example.com')
+        for data in (response.data[str(self.bob.id)], other.data):
+            self.assertEqual(data['username'], 'bob')
+            for field in ('email', 'phone_number', 'date_of_birth'):
+                self.assertNotIn(field, data)
+
+    def test_profiles_without_previews_are_still_cached(self):
+        # Not an image, so its previews will never exist
+        Profile.objects.filter(user=self.bob).update(profile_picture='profile_pictures/notes.txt')
+        cache = ProfileCache(pending_ttl=15)
+        with mock.patch.object(cache.cache, 'set_many', wraps=cache.cache.set_many) as set_many:
+            cache.get(self.bob.id)
+        self.assertEqual(set_many.call_args.kwargs['timeout'], 15)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get(self.bob.id)['username'], 'bob')
+
+    def test_profile_update_is_not_invalidated_twice(self):
+        with mock.patch('users.signals.get_profile_cache') as signal_cache, \
+                mock.patch('users.views.get_profile_cache') as view_cache:
+            response = self.client.put('/api/users/profile/', {'bio': 'hi'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        signal_cache.return_value.invalidate.assert_called_with(self.alice.id)
+        view_cache.return_value.invalidate.assert_not_called()
+
+
+class ProfileUpdateFieldsTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def updates(self, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put('/api/users/profile/', data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries if query['sql'].startswith('UPDATE') and 'users_profile' in query['sql']]
+
+    def test_only_changed_columns_are_written(self):
+        [update] = self.updates({'bio': 'hello'})
+        self.assertIn('bio', update)
+        self.assertNotIn('phone_number', update)
+        self.assertNotIn('profile_picture', update)
+        self.assertEqual(Profile.objects.get(user=self.alice).bio, 'hello')
+
+    def test_unchanged_profile_is_not_written(self):
+        self.updates({'bio': 'hello'})
+        self.assertEqual(self.updates({'bio': 'hello'}), [])
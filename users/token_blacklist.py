@@ -0,0 +1,163 @@
+# users/token_blacklist.py
+import hashlib
+import math
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings; no false negatives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def _bridge_key(jti):
+    return f'jwt-blacklisted:{jti}'
+
+
+def _revoked_access_key(jti):
+    return f'jwt-revoked-access:{jti}'
+
+
+class BlacklistFilter:
+    """
+    Answers "is this refresh token blacklisted?" mostly without the database.
+
+    Each process keeps a Bloom filter of the JTIs of unexpired blacklisted
+    tokens, rebuilt in one streaming query every refresh seconds. A miss in
+    the filter is final unless the token was blacklisted after the last
+    rebuild, which the shared cache bridges: every new blacklist entry is
+    also written there for two refresh periods. A hit in the filter, real or
+    false positive, is confirmed against BlacklistedToken.
+
+    Rebuilds are single-flight: the first thread to find the filter stale
+    rebuilds it while every other thread keeps using the old one, so an
+    expiry never sends a burst of identical queries to the database. Only
+    the very first build, with no filter to fall back on, is waited for.
+    """
+
+    def __init__(self, cache_alias='default', refresh=300.0, error_rate=0.01):
+        self.cache = caches[cache_alias]
+        self.refresh = refresh
+        self.error_rate = error_rate
+        self._filter = None
+        self._built_at = None
+        self._lock = threading.Lock()
+        # Held by whichever thread is rebuilding
+        self._build_lock = threading.Lock()
+
+    def _build(self):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        jtis = BlacklistedToken.objects.filter(
+            token__expires_at__gt=timezone.now()
+        ).values_list('token__jti', flat=True)
+        count = jtis.count()
+        # Headroom so tokens added before the next rebuild keep the error rate
+        bloom = BloomFilter(max(count * 2, 1024), self.error_rate)
+        for jti in jtis.iterator(chunk_size=5000):
+            bloom.add(jti)
+        return bloom
+
+    def _current(self):
+        with self._lock:
+            bloom = self._filter
+            if bloom is not None and time.monotonic() - self._built_at < self.refresh:
+                return bloom
+        # Stale: one thread rebuilds, the rest serve the old filter meanwhile
+        if not self._build_lock.acquire(blocking=bloom is None):
+            return bloom
+        try:
+            with self._lock:
+                if self._filter is not None and time.monotonic() - self._built_at < self.refresh:
+                    # Rebuilt while we waited for the lock
+                    return self._filter
+            bloom = self._build()
+            with self._lock:
+                self._filter = bloom
+                self._built_at = time.monotonic()
+            return bloom
+        finally:
+            self._build_lock.release()
+
+    def add(self, jti):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+        self.cache.set(_bridge_key(jti), True, timeout=int(self.refresh * 2))
+
+    def revoke_access(self, jti, expires_at):
+        """
+        Revoke an access token (exp as a Unix time). Only refresh tokens go
+        in the blacklist table, so a revoked access token is remembered in
+        the shared cache until it would have expired anyway.
+        """
+        timeout = int(expires_at - time.time()) + 1
+        if timeout > 0:
+            self.cache.set(_revoked_access_key(jti), True, timeout=timeout)
+
+    def access_revoked(self, jti):
+        return self.cache.get(_revoked_access_key(jti)) is not None
+
+    def is_blacklisted(self, jti):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        if jti in self._current():
+            return BlacklistedToken.objects.filter(token__jti=jti).exists()
+        return self.cache.get(_bridge_key(jti)) is not None
+
+
+_blacklist = None
+
+
+def get_blacklist():
+    global _blacklist
+    if _blacklist is None:
+        _blacklist = BlacklistFilter(
+            cache_alias=getattr(settings, 'JWT_BLACKLIST_CACHE_ALIAS', 'default'),
+            refresh=getattr(settings, 'JWT_BLACKLIST_FILTER_REFRESH', 300.0),
+            error_rate=getattr(settings, 'JWT_BLACKLIST_FILTER_ERROR_RATE', 0.01),
+        )
+    return _blacklist
+
+
+def compact_expired_tokens(batch_size=1000, pause=0.05, now=None):
+    """
+    Delete outstanding tokens (and, by cascade, their blacklist rows) whose
+    expiry has passed, batch_size rows per short transaction with a pause in
+    between, so the tables are never locked for long. Returns the number of
+    outstanding tokens deleted.
+    """
+    from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        ids = list(
+            OutstandingToken.objects.filter(expires_at__lte=now)
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
@@ -1,8 +1,8 @@
 from django.urls import path
 from .views import (
-    UserRegistrationView, OTPVerificationView, ResendOTPView,
+    UserRegistrationView, OTPVerificationView, ResendOTPView, LogoutView,
     FriendRequestView, FriendRequestActionView, FollowUserView,
-    BlockUserView, ReportUserView, ProfileView,
+    BlockUserView, ReportUserView, ProfileView, ProfileListView, FriendSuggestionView,
 )
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
@@ -14,14 +14,17 @@ urlpatterns = [
     path('resend-otp/', ResendOTPView.as_view(), name='resend-otp'),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('logout/', LogoutView.as_view(), name='logout'),
     
     # Profile
     path('profile/', ProfileView.as_view(), name='profile'),
     path('profile/<int:user_id>/', ProfileView.as_view(), name='user-profile'),
+    path('profiles/', ProfileListView.as_view(), name='profile-list'),
     
     # Friend Requests
     path('friend-request/<int:to_user_id>/', FriendRequestView.as_view(), name='friend-request'),
     path('friend-request-action/<int:request_id>/', FriendRequestActionView.as_view(), name='friend-request-action'),
+    path('friend-suggestions/', FriendSuggestionView.as_view(), name='friend-suggestions'),
     
     # Follow/Unfollow
     path('follow/<int:to_user_id>/', FollowUserView.as_view(), name='follow-user'),
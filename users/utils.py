@@ -1,31 +1,27 @@
 # users/utils.py
-import random
-from django.utils import timezone
-import datetime
-from django.core.mail import send_mail
+import secrets
 from django.conf import settings
+from .mailer import queue_email
+from .otp_store import get_otp_store
 
 def generate_otp():
-    return ''.join([str(random.randint(0, 9)) for _ in range(6)])
+    return ''.join(str(secrets.randbelow(10)) for _ in range(6))
 
 def send_otp_email(user, otp):
+    minutes = get_otp_store().ttl // 60
     subject = 'Email Verification OTP'
-    message = f'Hi {user.username}, here is your OTP for email verification: {otp}. This OTP will expire in 5 minutes.'
+    message = f'Hi {user.username}, here is your OTP for email verification: {otp}. This OTP will expire in {minutes} minutes.'
     from_email = settings.EMAIL_HOST_USER
     recipient_list = [user.email]
-    send_mail(subject, message, from_email, recipient_list)
+    # Handed to a background thread; the request never waits on SMTP
+    queue_email(subject, message, from_email, recipient_list)
 
 def create_otp_for_user(user):
-    from .models import OTP
-    
-    # Delete any existing OTPs for this user
-    OTP.objects.filter(user=user).delete()
-    
+    # Replaces any code issued before; stored hashed with a TTL, not in the DB
     otp_code = generate_otp()
-    expires_at = timezone.now() + datetime.timedelta(minutes=5)
-    otp_obj = OTP.objects.create(user=user, otp=otp_code, expires_at=expires_at)
+    get_otp_store().issue(user.id, otp_code)
     
     # Send the OTP via email
     send_otp_email(user, otp_code)
     
-    return otp_obj
+    return otp_code
@@ -2,10 +2,14 @@
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated  # Add this import
-from .serializers import UserRegistrationSerializer, OTPVerificationSerializer
-from .models import User, OTP, Report  # Add Report model import
+from .serializers import CachedBlacklistRefreshToken, UserRegistrationSerializer, OTPVerificationSerializer
+from .models import User, Report  # Add Report model import
+from .otp_store import EXPIRED, INVALID, LOCKED, get_otp_store
+from .token_blacklist import get_blacklist
 from .utils import create_otp_for_user
 
 # users/views.py
@@ -15,34 +19,50 @@ from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from .models import User, Profile
 from .serializers import ProfileSerializer  # You'll need to create this serializer
+from .profile_cache import get_profile_cache, public_profile
 
 class ProfileView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, user_id=None):
-        if user_id:
-            # Get another user's profile
-            try:
-                profile = Profile.objects.get(user_id=user_id)
-                serializer = ProfileSerializer(profile)
-                return Response(serializer.data)
-            except Profile.DoesNotExist:
-                return Response({"error": "Profile not found"}, status=status.HTTP_404_NOT_FOUND)
-        else:
-            # Get the authenticated user's profile
-            profile = request.user.profile
-            serializer = ProfileSerializer(profile)
-            return Response(serializer.data)
+        # Served from the profile cache; another user's or our own
+        user_id = user_id or request.user.id
+        data = get_profile_cache().get(user_id)
+        if data is None:
+            return Response({"error": "Profile not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data if user_id == request.user.id else public_profile(data))
     
     def put(self, request):
         # Update the authenticated user's profile
         profile = request.user.profile
         serializer = ProfileSerializer(profile, data=request.data, partial=True)
         if serializer.is_valid():
+            # The post_save signal invalidates the cached profile
             serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class ProfileListView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    # Bulk lookup: GET profiles/?ids=1,2,3
+    max_ids = 200
+    
+    def get(self, request):
+        try:
+            user_ids = {int(user_id) for user_id in request.query_params.get('ids', '').split(',') if user_id}
+        except ValueError:
+            return Response({'error': 'ids must be a comma separated list of user ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(user_ids) > self.max_ids:
+            return Response({'error': f'At most {self.max_ids} ids per request'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Contact details and birth dates are only shown to their owner
+        profiles = get_profile_cache().get_many(user_ids)
+        return Response({
+            str(user_id): profiles[user_id] if user_id == request.user.id else public_profile(profiles[user_id])
+            for user_id in sorted(profiles)
+        })
+
 class UserRegistrationView(APIView):
     def post(self, request):
         serializer = UserRegistrationSerializer(data=request.data)
@@ -63,6 +83,28 @@ class UserRegistrationView(APIView):
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class LogoutView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        # Blacklist the refresh token, if given, and revoke the access token
+        # this request was made with; both stop working on the REST API and
+        # for new WebSocket connections
+        raw_refresh = request.data.get('refresh')
+        if raw_refresh:
+            try:
+                refresh = CachedBlacklistRefreshToken(raw_refresh)
+            except TokenError:
+                return Response({'error': 'Invalid refresh token'}, status=status.HTTP_400_BAD_REQUEST)
+            if str(refresh.get(api_settings.USER_ID_CLAIM)) != str(getattr(request.user, api_settings.USER_ID_FIELD)):
+                return Response({'error': 'Invalid refresh token'}, status=status.HTTP_400_BAD_REQUEST)
+            refresh.blacklist()
+        
+        access = request.auth
+        if access is not None:
+            get_blacklist().revoke_access(access[api_settings.JTI_CLAIM], access['exp'])
+        return Response({'message': 'Logged out'}, status=status.HTTP_200_OK)
+
 class OTPVerificationView(APIView):
     def post(self, request):
         serializer = OTPVerificationSerializer(data=request.data)
@@ -73,20 +115,20 @@ class OTPVerificationView(APIView):
             try:
                 # Get the user from the token
                 user = request.user
-                otp_obj = OTP.objects.filter(user=user, otp=otp_code).first()
+                result = get_otp_store().verify(user.id, otp_code)
                 
-                if not otp_obj:
+                if result == INVALID:
                     return Response({'error': 'Invalid OTP'}, status=status.HTTP_400_BAD_REQUEST)
                 
-                if otp_obj.is_expired():
+                if result == EXPIRED:
                     return Response({'error': 'OTP has expired'}, status=status.HTTP_400_BAD_REQUEST)
                 
-                # Mark user as verified
-                user.is_verified = True
-                user.save()
+                if result == LOCKED:
+                    return Response({'error': 'Too many attempts, try again later'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
                 
-                # Delete the OTP
-                otp_obj.delete()
+                # Mark user as verified; the code was used up by verify()
+                user.is_verified = True
+                user.save(update_fields=['is_verified'])
                 
                 return Response({'message': 'Email verified successfully'}, status=status.HTTP_200_OK)
                 
@@ -102,13 +144,37 @@ class ResendOTPView(APIView):
         if user.is_verified:
             return Response({'message': 'User is already verified'}, status=status.HTTP_400_BAD_REQUEST)
         
+        # A new code does not reset the attempt counter, and codes are
+        # issued at most once per OTP_RESEND_INTERVAL
+        if not get_otp_store().allow_resend(user.id):
+            return Response({'error': 'An OTP was sent recently, try again later'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        
         create_otp_for_user(user)
         
         return Response({'message': 'New OTP sent successfully'}, status=status.HTTP_200_OK)
 
 # users/views.py
 from friendship.models import Friend, Follow, FriendshipRequest, Block
-from friendship.exceptions import AlreadyExistsError
+from friendship.exceptions import AlreadyExistsError, AlreadyFriendsError
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from chat.presence import user_group
+from . import social_graph
+from .suggestions import drop_suggestion, suggestions_for
+
+def notify_block_changed(blocker_id, blocked_id, active):
+    # Open sockets of both users filter each other's messages in memory;
+    # tell them so they never have to query blocks per message
+    event = {
+        'type': 'block_changed',
+        'blocker_id': blocker_id,
+        'blocked_id': blocked_id,
+        'active': active,
+        'blocked': social_graph.block_exists(blocker_id, blocked_id),
+    }
+    channel_layer = get_channel_layer()
+    for user_id in (blocker_id, blocked_id):
+        async_to_sync(channel_layer.group_send)(user_group(user_id), event)
 
 class FriendRequestView(APIView):
     permission_classes = [IsAuthenticated]
@@ -121,18 +187,22 @@ class FriendRequestView(APIView):
             if request.user == to_user:
                 return Response({'error': 'You cannot send a friend request to yourself'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Check if a friendship already exists
-            if Friend.objects.are_friends(request.user, to_user):
+            # A repeat is turned away from the social graph cache before any
+            # query; otherwise the database decides, as the cache may not have
+            # seen changes made by other processes yet
+            if social_graph.are_friends(request.user.id, to_user.id):
                 return Response({'error': 'You are already friends with this user'}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Check if the user is blocked
-            if Block.objects.is_blocked(request.user, to_user):
+            if social_graph.block_exists(request.user.id, to_user.id):
                 return Response({'error': 'You cannot send a friend request to a blocked user'}, status=status.HTTP_400_BAD_REQUEST)
             
             # Send friend request
             try:
                 Friend.objects.add_friend(request.user, to_user, message=request.data.get('message', ''))
+                drop_suggestion(request.user.id, to_user.id)
                 return Response({'message': 'Friend request sent successfully'}, status=status.HTTP_201_CREATED)
+            except AlreadyFriendsError:
+                social_graph.friendship_added(request.user.id, to_user.id)
+                return Response({'error': 'You are already friends with this user'}, status=status.HTTP_400_BAD_REQUEST)
             except AlreadyExistsError:
                 return Response({'error': 'Friend request already sent'}, status=status.HTTP_400_BAD_REQUEST)
                 
@@ -149,6 +219,8 @@ class FriendRequestActionView(APIView):
             
             if action == 'accept':
                 friendship_request.accept()
+                social_graph.friendship_added(friendship_request.from_user_id, friendship_request.to_user_id)
+                drop_suggestion(friendship_request.from_user_id, friendship_request.to_user_id)
                 return Response({'message': 'Friend request accepted'}, status=status.HTTP_200_OK)
             elif action == 'reject':
                 friendship_request.reject()
@@ -163,6 +235,15 @@ class FriendRequestActionView(APIView):
             return Response({'error': 'Friend request not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
+# users/views.py
+class FriendSuggestionView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        # Precomputed by the compute_friend_suggestions command
+        return Response(suggestions_for(request.user.id))
+
+
 # users/views.py
 class FollowUserView(APIView):
     permission_classes = [IsAuthenticated]
@@ -175,12 +256,16 @@ class FollowUserView(APIView):
             if request.user == to_user:
                 return Response({'error': 'You cannot follow yourself'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Check if already following
-            if Follow.objects.follows(request.user, to_user):
+            if social_graph.follows(request.user.id, to_user.id):
                 return Response({'error': 'You are already following this user'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Follow the user
-            Follow.objects.add_follower(request.user, to_user)
+            # Follow the user; the database decides whether it already exists
+            try:
+                Follow.objects.add_follower(request.user, to_user)
+            except AlreadyExistsError:
+                social_graph.follow_added(request.user.id, to_user.id)
+                return Response({'error': 'You are already following this user'}, status=status.HTTP_400_BAD_REQUEST)
+            social_graph.follow_added(request.user.id, to_user.id)
             
             return Response({'message': 'User followed successfully'}, status=status.HTTP_201_CREATED)
                 
@@ -191,13 +276,12 @@ class FollowUserView(APIView):
         try:
             to_user = User.objects.get(id=to_user_id)
             
-            # Check if following
-            if not Follow.objects.follows(request.user, to_user):
+            # Unfollow the user; removing reports whether there was a follow
+            removed = Follow.objects.remove_follower(request.user, to_user)
+            social_graph.follow_removed(request.user.id, to_user.id)
+            if not removed:
                 return Response({'error': 'You are not following this user'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Unfollow the user
-            Follow.objects.remove_follower(request.user, to_user)
-            
             return Response({'message': 'User unfollowed successfully'}, status=status.HTTP_200_OK)
                 
         except User.DoesNotExist:
@@ -216,20 +300,25 @@ class BlockUserView(APIView):
             if request.user == to_user:
                 return Response({'error': 'You cannot block yourself'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Check if already blocked
-            if Block.objects.is_blocked(request.user, to_user):
+            if social_graph.blocks(request.user.id, to_user.id):
                 return Response({'error': 'You have already blocked this user'}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Block the user
-            Block.objects.add_block(request.user, to_user)
-            
-            # Remove any friendship
-            if Friend.objects.are_friends(request.user, to_user):
-                Friend.objects.remove_friend(request.user, to_user)
+            # Block the user; the database decides whether it already exists
+            try:
+                Block.objects.add_block(request.user, to_user)
+            except AlreadyExistsError:
+                social_graph.block_added(request.user.id, to_user.id)
+                return Response({'error': 'You have already blocked this user'}, status=status.HTTP_400_BAD_REQUEST)
+            social_graph.block_added(request.user.id, to_user.id)
+            drop_suggestion(request.user.id, to_user.id)
             
-            # Remove any follow relationship
-            if Follow.objects.follows(request.user, to_user):
-                Follow.objects.remove_follower(request.user, to_user)
+            # Remove any friendship and follow relationship; both are no-ops
+            # when there is none, so the possibly stale cache is not consulted
+            Friend.objects.remove_friend(request.user, to_user)
+            social_graph.friendship_removed(request.user.id, to_user.id)
+            Follow.objects.remove_follower(request.user, to_user)
+            social_graph.follow_removed(request.user.id, to_user.id)
+            notify_block_changed(request.user.id, to_user.id, True)
             
             return Response({'message': 'User blocked successfully'}, status=status.HTTP_201_CREATED)
                 
@@ -240,12 +329,12 @@ class BlockUserView(APIView):
         try:
             to_user = User.objects.get(id=to_user_id)
             
-            # Check if blocked
-            if not Block.objects.is_blocked(request.user, to_user):
+            # Unblock the user; removing reports whether there was a block
+            removed = Block.objects.remove_block(request.user, to_user)
+            social_graph.block_removed(request.user.id, to_user.id)
+            if not removed:
                 return Response({'error': 'This user is not blocked'}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Unblock the user
-            Block.objects.remove_block(request.user, to_user)
+            notify_block_changed(request.user.id, to_user.id, False)
             
             return Response({'message': 'User unblocked successfully'}, status=status.HTTP_200_OK)
                 